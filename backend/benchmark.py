@@ -0,0 +1,1411 @@
+"""Benchmarks used to measure the performance of endpoints in api.py.
+
+Each benchmark seeds a fresh sqlite db in a temporary directory and prints
+one json object per measurement so results can be compared between commits.
+
+Usage: benchmark.py [-h] [--sizes SIZES] [--repeat REPEAT]
+                    [--concurrency CONCURRENCY] [benchmark ...]
+
+Attributes:
+    LOAD_CONCURRENCY: An int representing the default number of concurrent
+        clients in the load benchmark
+    BENCHMARKS: A dict mapping benchmark names to the functions running them
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import NullPool
+from werkzeug.test import EnvironBuilder
+
+from jwks_stub import BARISTA_PERMISSIONS, MANAGER_PERMISSIONS, StubJWKSServer
+from src.api import app, encode_cursor, menu_cache
+from src.asgi import asgi
+from src.auth import auth
+from src.compression import compression
+from src.database.models import (
+    Drink,
+    Ingredient,
+    db,
+    ingredient_index,
+    migrate_db,
+    rebuild_documents,
+    rebuild_search_index,
+    setup_db,
+)
+from src.serializer import serializer
+
+SEED_BATCH_SIZE = 10000
+LOAD_CONCURRENCY = 8
+UPLOAD_CHUNKS = 4
+UPLOAD_DELAY = 0.05
+COLORS = ["#e8ddb8", "#743315", "#371808", "#67bf57", "#f4f6ea"]
+NAMES = ["Milk", "Chocolate", "Espresso", "Matcha", "Foam", "Water"]
+STARTUP_SCRIPT = """
+import json, os, time
+start = time.perf_counter()
+from src.api import create_app
+imported = time.perf_counter()
+app = create_app({"SQLALCHEMY_DATABASE_URI": os.environ["STARTUP_DB"]})
+created = time.perf_counter()
+client = app.test_client()
+client.get("/drinks")
+first = time.perf_counter()
+client.get("/drinks")
+second = time.perf_counter()
+client.get("/drinks-detail", headers={"Authorization": os.environ["TOKEN"]})
+authenticated = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "create_app_ms": (created - imported) * 1000,
+    "first_request_ms": (first - created) * 1000,
+    "warm_request_ms": (second - first) * 1000,
+    "first_auth_request_ms": (authenticated - second) * 1000,
+}))
+"""
+
+
+def seed_db(
+    db_path, drinks, ingredients_per_drink=3, engine_options=None, pragmas=None
+):
+    """Creates a db populated with the given number of drinks.
+
+    Args:
+        db_path: A str representing the location of the db to create
+        drinks: An int representing the number of drinks to insert
+        ingredients_per_drink: An int representing the size of each recipe
+        engine_options: A dict of engine options passed to setup_db
+        pragmas: A dict of sqlite pragmas passed to setup_db
+    """
+    setup_db(app, db_path, engine_options, pragmas)
+
+    with app.app_context():
+        db.drop_all()
+        migrate_db()
+
+        for start in range(1, drinks + 1, SEED_BATCH_SIZE):
+            stop = min(start + SEED_BATCH_SIZE, drinks + 1)
+            db.session.execute(
+                Drink.__table__.insert(),
+                [{"id": i, "title": f"Drink {i}"} for i in range(start, stop)],
+            )
+            db.session.execute(
+                Ingredient.__table__.insert(),
+                [
+                    {
+                        "name": NAMES[(i + j) % len(NAMES)],
+                        "parts": j + 1,
+                        "color": COLORS[(i + j) % len(COLORS)],
+                        "drink_id": i,
+                    }
+                    for i in range(start, stop)
+                    for j in range(ingredients_per_drink)
+                ],
+            )
+            db.session.commit()
+
+        rebuild_search_index()
+        rebuild_documents()
+        db.session.remove()
+
+    menu_cache.clear()
+    ingredient_index.clear()
+
+
+def start_auth():
+    """Points token verification at a local stub of Auth0.
+
+    Returns:
+        server: The running StubJWKSServer
+        headers: A dict of auth headers carrying a manager token
+    """
+    server = StubJWKSServer()
+    server.start()
+    auth.jwks_cache = auth.JWKSCache(server.url)
+    token = server.mint_token(MANAGER_PERMISSIONS)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    return server, headers
+
+
+class NDJSONDrinks:
+    """A file-like object generating newline delimited drinks on demand.
+
+    Attributes:
+        count: An int representing the number of drinks to generate
+    """
+
+    def __init__(self, count):
+        """Set-up for NDJSONDrinks."""
+        self.count = count
+        self._next = 0
+        self._buffer = b""
+
+    def read(self, size=-1):
+        """Reads up to size bytes of generated drinks.
+
+        Args:
+            size: An int representing the most bytes to return
+
+        Returns:
+            data: A bytes object of generated drinks
+        """
+        while (
+            size < 0 or len(self._buffer) < size
+        ) and self._next < self.count:
+            i = self._next
+            drink = {
+                "title": f"Drink {i}",
+                "recipe": [
+                    {"name": NAMES[(i + j) % len(NAMES)], "parts": j + 1}
+                    for j in range(3)
+                ],
+            }
+            self._buffer += json.dumps(drink).encode() + b"\n"
+            self._next += 1
+
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+
+        return data
+
+
+def time_request(client, url, repeat, **kwargs):
+    """Times repeated GET requests to a url.
+
+    Args:
+        client: A flask test client
+        url: A str representing the url to request
+        repeat: An int representing the number of timed requests
+        kwargs: Any extra arguments passed to the test client
+
+    Returns:
+        latency: A dict of latency percentiles in milliseconds
+    """
+    timings = []
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url, **kwargs)
+        timings.append((time.perf_counter() - start) * 1000)
+        assert response.status_code == 200, response.status_code
+
+    return summarize(timings)
+
+
+def summarize(timings):
+    """Summarizes a list of timings.
+
+    Args:
+        timings: A list of floats representing timings in milliseconds
+
+    Returns:
+        summary: A dict of the p50, p95 and p99 timings in milliseconds
+    """
+    if len(timings) < 2:
+        timings = timings * 2
+
+    quantiles = statistics.quantiles(timings, n=100, method="inclusive")
+    summary = {
+        "p50_ms": round(quantiles[49], 3),
+        "p95_ms": round(quantiles[94], 3),
+        "p99_ms": round(quantiles[98], 3),
+    }
+
+    return summary
+
+
+def bench_pagination(sizes, repeat, workdir):
+    """Measures page latency at the start, middle and end of the menu.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per page
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'pagination.db')}", size)
+        client = app.test_client()
+
+        for position in ("first", "middle", "last"):
+            url = "/drinks?limit=50"
+            after = {"first": 0, "middle": size // 2, "last": size - 50}
+            if after[position] > 0:
+                url = f"{url}&cursor={encode_cursor(after[position])}"
+
+            result = {
+                "benchmark": "pagination",
+                "drinks": size,
+                "page": position,
+            }
+            result.update(time_request(client, url, repeat))
+
+            yield result
+
+
+def bench_menu(sizes, repeat, workdir):
+    """Measures full menu latency when rebuilt, cached and not modified.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'menu.db')}", size)
+        client = app.test_client()
+        etag = client.get("/drinks").headers["ETag"]
+
+        timings = []
+        for _ in range(repeat):
+            menu_cache.clear()
+            start = time.perf_counter()
+            client.get("/drinks")
+            timings.append((time.perf_counter() - start) * 1000)
+        cases = {
+            "uncached": summarize(timings),
+            "cached": time_request(client, "/drinks", repeat),
+        }
+
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            response = client.get("/drinks", headers={"If-None-Match": etag})
+            timings.append((time.perf_counter() - start) * 1000)
+            assert response.status_code == 304, response.status_code
+        cases["not_modified"] = summarize(timings)
+
+        for case, latency in cases.items():
+            result = {"benchmark": "menu", "drinks": size, "case": case}
+            result.update(latency)
+
+            yield result
+
+
+def bench_writes(sizes, repeat, workdir):  # pylint: disable=unused-argument
+    """Measures drink creation latency as recipes grow.
+
+    Compares committing the drink and each ingredient separately with
+    committing the whole drink as a single transaction.
+
+    Args:
+        sizes: unused
+        repeat: An int representing the number of drinks created per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    seed_db(f"sqlite:///{os.path.join(workdir, 'writes.db')}", 0)
+
+    for recipe_size in (1, 5, 20, 50):
+        for mode in ("per_row", "single"):
+            timings = []
+
+            with app.app_context():
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    drink = Drink(title="Benchmark")
+                    recipe = [
+                        Ingredient(name=NAMES[j % len(NAMES)], parts=1)
+                        for j in range(recipe_size)
+                    ]
+
+                    if mode == "per_row":
+                        drink.insert()
+                        for ingredient in recipe:
+                            ingredient.drink = drink
+                            ingredient.insert()
+                    else:
+                        drink.recipe = recipe
+                        drink.insert()
+
+                    timings.append((time.perf_counter() - start) * 1000)
+
+                db.session.remove()
+
+            result = {
+                "benchmark": "writes",
+                "recipe_size": recipe_size,
+                "mode": mode,
+            }
+            result.update(summarize(timings))
+
+            yield result
+
+
+def bench_bulk(sizes, repeat, workdir):  # pylint: disable=unused-argument
+    """Measures importing whole menus through the bulk endpoint.
+
+    Args:
+        sizes: A list of ints representing the number of drinks to import
+        repeat: unused
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server, headers = start_auth()
+    db_path = f"sqlite:///{os.path.join(workdir, 'bulk.db')}"
+
+    try:
+        for size in sizes:
+            result = {"benchmark": "bulk", "drinks": size}
+
+            for traced in (False, True):
+                seed_db(db_path, 0)
+                # The test client needs a seekable body, so call the wsgi app
+                # directly to stream the drinks as they are generated
+                environ = EnvironBuilder(
+                    path="/drinks/bulk",
+                    method="POST",
+                    headers=headers,
+                    content_type="application/x-ndjson",
+                ).get_environ()
+                environ["wsgi.input"] = NDJSONDrinks(size)
+                environ["wsgi.input_terminated"] = True
+                if traced:
+                    tracemalloc.start()
+                start = time.perf_counter()
+                body = b"".join(app(environ, lambda *args: None))
+                elapsed = time.perf_counter() - start
+                response = json.loads(body)
+                assert len(response["created"]) == size
+
+                if traced:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    result["peak_memory_mb"] = round(peak / 2 ** 20, 3)
+                else:
+                    result["seconds"] = round(elapsed, 3)
+                    result["drinks_per_second"] = round(size / elapsed)
+
+            yield result
+    finally:
+        server.stop()
+
+
+def bench_stream(sizes, repeat, workdir):
+    """Measures time to first byte, total time and memory of drinks detail.
+
+    Compares the json response with the newline delimited json stream.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server, headers = start_auth()
+
+    try:
+        for size in sizes:
+            seed_db(f"sqlite:///{os.path.join(workdir, 'stream.db')}", size)
+
+            for mode, accept in (
+                ("json", "application/json"),
+                ("ndjson", "application/x-ndjson"),
+            ):
+                environ = EnvironBuilder(
+                    path="/drinks-detail",
+                    headers=dict(headers, Accept=accept),
+                ).get_environ()
+                first_byte = []
+                total = []
+
+                for _ in range(repeat):
+                    menu_cache.clear()
+                    start = time.perf_counter()
+                    body = iter(app(dict(environ), lambda *args: None))
+                    next(body)
+                    first_byte.append((time.perf_counter() - start) * 1000)
+                    for _ in body:
+                        pass
+                    total.append((time.perf_counter() - start) * 1000)
+
+                menu_cache.clear()
+                tracemalloc.start()
+                for _ in app(dict(environ), lambda *args: None):
+                    pass
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                result = {
+                    "benchmark": "stream",
+                    "drinks": size,
+                    "mode": mode,
+                    "ttfb_p50_ms": summarize(first_byte)["p50_ms"],
+                    "total_p50_ms": summarize(total)["p50_ms"],
+                    "peak_memory_mb": round(peak / 2 ** 20, 3),
+                }
+
+                yield result
+    finally:
+        server.stop()
+
+
+SQLITE_DEFAULTS = {
+    "journal_mode": "DELETE",
+    "synchronous": "FULL",
+    "busy_timeout": 0,
+    "cache_size": None,
+    "mmap_size": None,
+}
+
+
+def read_pages(size, repeat, counts, lock):
+    """Reads pages of drinks, counting successes and failures.
+
+    Args:
+        size: An int representing the number of drinks in the db
+        repeat: An int representing the number of pages to read
+        counts: A dict of operation counts to update
+        lock: A threading.Lock guarding counts
+    """
+    client = app.test_client()
+
+    for i in range(repeat):
+        cursor = encode_cursor(i * 7 % max(size - 50, 1))
+        response = client.get(f"/drinks?limit=50&cursor={cursor}")
+        key = "reads" if response.status_code == 200 else "errors"
+        with lock:
+            counts[key] += 1
+
+
+def write_titles(size, repeat, counts, lock):
+    """Renames drinks one transaction at a time, counting failures.
+
+    Args:
+        size: An int representing the number of drinks in the db
+        repeat: An int representing the number of drinks to rename
+        counts: A dict of operation counts to update
+        lock: A threading.Lock guarding counts
+    """
+    for i in range(repeat):
+        with app.app_context():
+            try:
+                drink = Drink.query.get(i % size + 1)
+                drink.title = f"Drink {i}"
+                drink.update()
+                key = "writes"
+            except OperationalError:
+                key = "errors"
+            db.session.remove()
+        with lock:
+            counts[key] += 1
+
+
+def bench_concurrency(sizes, repeat, workdir):
+    """Measures throughput of four readers and a writer running together.
+
+    Compares sqlite's defaults with the tuned pragmas and connection pool.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of operations per thread
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    configs = {
+        "defaults": ({"poolclass": NullPool}, SQLITE_DEFAULTS),
+        "tuned": ({}, {}),
+    }
+
+    for size in sizes:
+        for config, (engine_options, pragmas) in configs.items():
+            db_path = f"sqlite:///{os.path.join(workdir, config)}.db"
+            seed_db(
+                db_path, size, engine_options=engine_options, pragmas=pragmas
+            )
+            counts = {"reads": 0, "writes": 0, "errors": 0}
+            args = (size, repeat, counts, threading.Lock())
+            threads = [
+                threading.Thread(target=read_pages, args=args)
+                for _ in range(4)
+            ]
+            threads.append(threading.Thread(target=write_titles, args=args))
+
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            result = {
+                "benchmark": "concurrency",
+                "drinks": size,
+                "config": config,
+                "reads_per_second": round(counts["reads"] / elapsed),
+                "writes_per_second": round(counts["writes"] / elapsed),
+                "errors": counts["errors"],
+            }
+
+            yield result
+
+
+class QueryCounter:
+    """Counts the sql statements each thread sends to the db.
+
+    Attributes:
+        engine: The sqlalchemy engine being counted
+    """
+
+    def __init__(self, engine):
+        """Set-up for QueryCounter."""
+        self.engine = engine
+        self._local = threading.local()
+
+    def __enter__(self):
+        """Starts counting statements."""
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        """Stops counting statements."""
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+    def reset(self):
+        """Restarts the count of the current thread.
+
+        Returns:
+            count: An int representing the count before the reset
+        """
+        count = getattr(self._local, "count", 0)
+        self._local.count = 0
+
+        return count
+
+    def _count(self, *args):  # pylint: disable=unused-argument
+        self._local.count = getattr(self._local, "count", 0) + 1
+
+
+def load_requests(size, repeat, headers, created_ids):
+    """Builds the requests each worker sends for every route under load.
+
+    Args:
+        size: An int representing the number of drinks in the db
+        repeat: An int representing the number of requests per worker
+        headers: A dict of auth headers carrying a manager token
+        created_ids: A list of the drink ids made by the create route, which
+            the delete route removes
+
+    Returns:
+        routes: A dict mapping route names to functions that take a worker
+            and request number and return the args of a test client call
+    """
+    recipe = [{"name": "Espresso", "parts": 1, "color": COLORS[2]}]
+
+    def drink_id(worker, i):
+        return (worker * repeat + i) * 7919 % size + 1
+
+    routes = {
+        "list": lambda worker, i: ("GET", "/drinks", {}),
+        "detail": lambda worker, i: (
+            "GET",
+            "/drinks-detail?limit=50&cursor="
+            f"{encode_cursor(drink_id(worker, i))}",
+            {"headers": headers},
+        ),
+        "search": lambda worker, i: (
+            "GET",
+            f"/drinks/search?q={NAMES[i % len(NAMES)]}",
+            {},
+        ),
+        "create": lambda worker, i: (
+            "POST",
+            "/drinks",
+            {
+                "headers": headers,
+                "json": {"title": f"Load {worker} {i}", "recipe": recipe},
+            },
+        ),
+        "patch": lambda worker, i: (
+            "PATCH",
+            f"/drinks/{drink_id(worker, i)}",
+            {"headers": headers, "json": {"title": f"Patched {worker} {i}"}},
+        ),
+        "delete": lambda worker, i: (
+            "DELETE",
+            f"/drinks/{created_ids[worker * repeat + i]}",
+            {"headers": headers},
+        ),
+    }
+
+    return routes
+
+
+def run_load(build_request, concurrency, repeat, counter, created_ids):
+    """Sends requests from several threads at once and measures them.
+
+    Args:
+        build_request: A function taking a worker and request number and
+            returning the method, url and keyword args of the request
+        concurrency: An int representing the number of concurrent workers
+        repeat: An int representing the number of requests per worker
+        counter: A QueryCounter counting the statements of each request
+        created_ids: A list collecting the ids of any drinks created
+
+    Returns:
+        stats: A dict of the latency percentiles, throughput, statements
+            per request and errors
+    """
+    timings = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+
+    def work(worker):
+        client = app.test_client()
+        for i in range(repeat):
+            method, url, kwargs = build_request(worker, i)
+            counter.reset()
+            start = time.perf_counter()
+            response = client.open(url, method=method, **kwargs)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                timings.append(elapsed)
+                queries.append(counter.reset())
+                if response.status_code != 200:
+                    errors.append(response.status_code)
+                elif "created_drink_id" in response.json:
+                    created_ids.append(response.json["created_drink_id"])
+
+    threads = [
+        threading.Thread(target=work, args=(worker,))
+        for worker in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = summarize(timings)
+    stats.update(
+        {
+            "requests_per_second": round(len(timings) / elapsed, 1),
+            "queries_per_request": round(statistics.mean(queries), 2),
+            "errors": len(errors),
+        }
+    )
+
+    return stats
+
+
+def bench_load(sizes, repeat, workdir, concurrency=LOAD_CONCURRENCY):
+    """Drives every route from concurrent clients with minted tokens.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of requests per client
+        workdir: A str representing a directory for the seeded dbs
+        concurrency: An int representing the number of concurrent clients
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server, headers = start_auth()
+
+    try:
+        for size in sizes:
+            seed_db(f"sqlite:///{os.path.join(workdir, 'load.db')}", size)
+            created_ids = []
+            routes = load_requests(size, repeat, headers, created_ids)
+
+            with app.app_context():
+                engine = db.engine
+
+            with QueryCounter(engine) as counter:
+                for route, build_request in routes.items():
+                    result = {
+                        "benchmark": "load",
+                        "drinks": size,
+                        "route": route,
+                        "concurrency": concurrency,
+                        "requests": concurrency * repeat,
+                    }
+                    result.update(
+                        run_load(
+                            build_request,
+                            concurrency,
+                            repeat,
+                            counter,
+                            created_ids,
+                        )
+                    )
+
+                    yield result
+    finally:
+        server.stop()
+
+
+class SlowUpload(io.RawIOBase):
+    """A request body arriving in chunks, as from a client on a slow link.
+
+    Attributes:
+        chunks: A list of bytes objects the body arrives in
+        delay: A float representing the seconds to wait for each chunk after
+            the first
+    """
+
+    def __init__(self, body, chunks=UPLOAD_CHUNKS, delay=UPLOAD_DELAY):
+        """Set-up for SlowUpload."""
+        super().__init__()
+        size = -(-len(body) // chunks)
+        self.chunks = [body[i : i + size] for i in range(0, len(body), size)]
+        self.delay = delay
+        self._sent = 0
+
+    def readable(self):
+        """Returns True as the body can be read."""
+        return True
+
+    def readinto(self, buffer):
+        """Waits for the next chunk of the body and reads it into a buffer.
+
+        Args:
+            buffer: A writable bytes-like object to fill
+
+        Returns:
+            size: An int representing the number of bytes read
+        """
+        if self._sent == len(self.chunks):
+            return 0
+
+        if self._sent:
+            time.sleep(self.delay)
+        chunk = self.chunks[self._sent]
+        buffer[: len(chunk)] = chunk
+        self._sent += 1
+
+        return len(chunk)
+
+
+def wsgi_upload(headers, body):
+    """Sends a slowly uploaded request to the app as a WSGI server would.
+
+    The worker thread is held while the body arrives.
+
+    Args:
+        headers: A dict of the request headers
+        body: A bytes object representing the request body
+
+    Returns:
+        status: An int representing the response status code
+    """
+    environ = EnvironBuilder(
+        path="/drinks",
+        method="POST",
+        headers=headers,
+        content_length=len(body),
+        content_type="application/json",
+    ).get_environ()
+    environ["wsgi.input"] = io.BufferedReader(SlowUpload(body))
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+
+    for _ in app(environ, start_response):
+        pass
+
+    return response["status"]
+
+
+async def asgi_upload(asgi_app, headers, body):
+    """Sends a slowly uploaded request to the app as an ASGI server would.
+
+    Args:
+        asgi_app: An AsgiApp serving the app
+        headers: A dict of the request headers
+        body: A bytes object representing the request body
+
+    Returns:
+        status: An int representing the response status code
+    """
+    chunks = SlowUpload(body).chunks
+    received = 0
+    response = {}
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/drinks",
+        "query_string": b"",
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in dict(
+                headers, **{"Content-Type": "application/json"}
+            ).items()
+        ],
+    }
+
+    async def receive():
+        nonlocal received
+        if received:
+            await asyncio.sleep(UPLOAD_DELAY)
+        received += 1
+        return {
+            "type": "http.request",
+            "body": chunks[received - 1],
+            "more_body": received < len(chunks),
+        }
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+
+    await asgi_app(scope, receive, send)
+
+    return response["status"]
+
+
+async def drive_clients(send_request, clients, total):
+    """Sends requests from concurrent clients and measures them.
+
+    Args:
+        send_request: A coroutine function taking a request number and
+            returning the response status code
+        clients: An int representing the number of concurrent clients
+        total: An int representing the number of requests to send
+
+    Returns:
+        stats: A dict of the latency percentiles, throughput and errors
+    """
+    numbers = iter(range(total))
+    timings = []
+    errors = []
+
+    async def client():
+        for i in numbers:
+            start = time.perf_counter()
+            status = await send_request(i)
+            timings.append((time.perf_counter() - start) * 1000)
+            if status != 200:
+                errors.append(status)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - start
+
+    stats = summarize(timings)
+    stats["requests_per_second"] = round(total / elapsed, 1)
+    stats["errors"] = len(errors)
+
+    return stats
+
+
+def upload_sender(mode, prefix, asgi_app, headers):
+    """Builds the coroutine function a client uploads drinks with.
+
+    Args:
+        mode: A str representing how the app is served, wsgi or asgi
+        prefix: A str making the titles of the uploaded drinks unique
+        asgi_app: An AsgiApp whose threads handle the requests
+        headers: A dict of auth headers carrying a manager token
+
+    Returns:
+        send_request: A coroutine function taking a request number and
+            returning the response status code
+    """
+
+    async def send_request(i):
+        body = json.dumps(
+            {
+                "title": f"{prefix} {i}",
+                "recipe": [{"name": "Milk", "parts": 1}],
+            }
+        ).encode()
+
+        if mode == "asgi":
+            return await asgi_upload(asgi_app, headers, body)
+
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(
+            asgi_app.executor, wsgi_upload, headers, body
+        )
+
+    return send_request
+
+
+def bench_asgi(sizes, repeat, workdir, concurrency=LOAD_CONCURRENCY):
+    """Compares how many slow clients WSGI and ASGI serve at once.
+
+    Each client uploads a new drink in UPLOAD_CHUNKS chunks UPLOAD_DELAY
+    seconds apart. Both modes handle requests on ASGI_THREADS threads, but
+    under WSGI a thread waits for the whole upload.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of requests per client at
+            the lowest concurrency, the same total is sent at every level
+        workdir: A str representing a directory for the seeded dbs
+        concurrency: An int representing the lowest number of concurrent
+            clients, each level is 4 times the last
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server, headers = start_auth()
+    total = concurrency * repeat
+
+    try:
+        for size in sizes:
+            seed_db(f"sqlite:///{os.path.join(workdir, 'asgi.db')}", size)
+
+            for clients in (concurrency, concurrency * 4, concurrency * 16):
+                for mode in ("wsgi", "asgi"):
+                    asgi_app = asgi.AsgiApp(app)
+
+                    send_request = upload_sender(
+                        mode, f"{mode} {clients}", asgi_app, headers
+                    )
+                    result = {
+                        "benchmark": "asgi",
+                        "drinks": size,
+                        "mode": mode,
+                        "clients": clients,
+                        "threads": asgi.ASGI_THREADS,
+                        "requests": total,
+                    }
+                    stats = drive_clients(send_request, clients, total)
+                    result.update(asyncio.run(stats))
+                    asgi_app.executor.shutdown()
+
+                    yield result
+    finally:
+        server.stop()
+
+
+def bench_indexes(sizes, repeat, workdir):
+    """Measures recipe lookup latency before and after indexing drink_id.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed, each
+            drink having three ingredients
+        repeat: An int representing the number of timed lookups per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'indexes.db')}", size)
+
+        with app.app_context():
+            db.session.execute("DROP INDEX ix_ingredients_drink_id")
+            db.session.commit()
+
+            for case in ("before", "after"):
+                if case == "after":
+                    migrate_db()
+
+                timings = []
+                for i in range(repeat):
+                    drink_id = i * 7919 % size + 1
+                    start = time.perf_counter()
+                    Ingredient.query.filter_by(drink_id=drink_id).all()
+                    timings.append((time.perf_counter() - start) * 1000)
+
+                result = {
+                    "benchmark": "indexes",
+                    "drinks": size,
+                    "ingredients": size * 3,
+                    "case": case,
+                }
+                result.update(summarize(timings))
+
+                yield result
+
+            db.session.remove()
+
+
+def bench_search(sizes, repeat, workdir):
+    """Measures search latency for rare, common and prefix terms.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per query
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'search.db')}", size)
+        client = app.test_client()
+        queries = {
+            "title": f"drink {size // 2}",
+            "ingredient": NAMES[0],
+            "prefix": NAMES[0][:3],
+        }
+
+        for case, query in queries.items():
+            result = {"benchmark": "search", "drinks": size, "query": case}
+            result.update(
+                time_request(client, f"/drinks/search?q={query}", repeat)
+            )
+
+            yield result
+
+
+def bench_filters(sizes, repeat, workdir):
+    """Measures ingredient filter latency once the index is loaded.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per filter
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'filters.db')}", size)
+        client = app.test_client()
+        filters = {
+            "include": f"ingredient={NAMES[0]}",
+            "and": f"ingredient={NAMES[0]}&ingredient={NAMES[1]}",
+            "or": f"ingredient={NAMES[0]}|{NAMES[3]}",
+            "exclude": f"exclude_ingredient={NAMES[0]}",
+        }
+
+        for case, query in filters.items():
+            url = f"/drinks?{query}&limit=50"
+            client.get(url)
+            result = {"benchmark": "filters", "drinks": size, "filter": case}
+            result.update(time_request(client, url, repeat))
+
+            yield result
+
+
+def bench_compression(sizes, repeat, workdir):
+    """Measures the size of the detailed menu and its cost per encoding.
+
+    Compressing is timed on its own, as a cached menu only pays for it once.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed requests per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server, headers = start_auth()
+
+    try:
+        for size in sizes:
+            seed_db(
+                f"sqlite:///{os.path.join(workdir, 'compression.db')}", size
+            )
+            client = app.test_client()
+            body = client.get("/drinks-detail", headers=headers).data
+
+            for encoding in ("identity",) + compression.ENCODINGS:
+                result = {
+                    "benchmark": "compression",
+                    "drinks": size,
+                    "encoding": encoding,
+                    "bytes": len(body),
+                }
+
+                if encoding != "identity":
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        compressed = compression.compress(body, encoding)
+                        timings.append((time.perf_counter() - start) * 1000)
+                    result["bytes"] = len(compressed)
+                    result["compress_p50_ms"] = summarize(timings)["p50_ms"]
+
+                result.update(
+                    time_request(
+                        client,
+                        "/drinks-detail",
+                        repeat,
+                        headers={**headers, "Accept-Encoding": encoding},
+                    )
+                )
+
+                yield result
+    finally:
+        server.stop()
+
+
+def bench_serialize(sizes, repeat, workdir):  # pylint: disable=unused-argument
+    """Measures serializing the full menu with each json serializer.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to serialize
+        repeat: An int representing the number of timed serializations
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    names = ["json"] + (["orjson"] if serializer.orjson else [])
+    previous = serializer.get_serializer()
+
+    for size in sizes:
+        menu = {
+            "success": True,
+            "drinks": [
+                {
+                    "id": i + 1,
+                    "title": f"Drink {i}",
+                    "recipe": [
+                        {
+                            "name": NAMES[(i + j) % len(NAMES)],
+                            "color": COLORS[(i + j) % len(COLORS)],
+                            "parts": j + 1,
+                        }
+                        for j in range(3)
+                    ],
+                }
+                for i in range(size)
+            ],
+            "next_cursor": None,
+        }
+
+        with app.app_context():
+            for name in names:
+                serializer.set_serializer(name)
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    serializer.dumps(menu)
+                    timings.append((time.perf_counter() - start) * 1000)
+                result = {
+                    "benchmark": "serialize",
+                    "drinks": size,
+                    "serializer": name,
+                }
+                result.update(summarize(timings))
+
+                yield result
+
+    serializer.set_serializer(previous)
+
+
+def format_orm(format_name):
+    """Formats every drink by loading the drinks and recipes as objects.
+
+    Args:
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        drinks: A list of dicts representing the formatted drinks
+    """
+    drinks = Drink.query.options(selectinload(Drink.recipe)).order_by(Drink.id)
+
+    return [getattr(drink, format_name)() for drink in drinks]
+
+
+def format_core(format_name):
+    """Formats every drink straight from its rows.
+
+    Args:
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        drinks: A list of dicts representing the formatted drinks
+    """
+    return [drink for _, drink in Drink.format_page(format_name)]
+
+
+def bench_formatting(sizes, repeat, workdir):
+    """Measures time and memory per drink of formatting the full menu.
+
+    Compares loading the drinks as objects with formatting their rows.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of timed formats per case
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    for size in sizes:
+        seed_db(f"sqlite:///{os.path.join(workdir, 'formatting.db')}", size)
+
+        with app.app_context():
+            for mode, format_drinks in (
+                ("orm", format_orm),
+                ("core", format_core),
+            ):
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    format_drinks("long_format")
+                    timings.append((time.perf_counter() - start) * 1000)
+                    db.session.remove()
+
+                tracemalloc.start()
+                format_drinks("long_format")
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                db.session.remove()
+
+                result = {
+                    "benchmark": "formatting",
+                    "drinks": size,
+                    "mode": mode,
+                    "peak_bytes_per_drink": round(peak / size),
+                }
+                result.update(summarize(timings))
+
+                yield result
+
+
+def bench_startup(sizes, repeat, workdir):
+    """Measures import, app creation and first request latency.
+
+    Every run starts a new interpreter, so nothing is imported, connected or
+    cached beforehand. The first authenticated request also imports jose and
+    fetches the key set from a local stub of Auth0.
+
+    Args:
+        sizes: A list of ints representing the menu sizes to seed
+        repeat: An int representing the number of interpreters started per
+            size
+        workdir: A str representing a directory for the seeded dbs
+
+    Yields:
+        result: A dict describing one measurement
+    """
+    server = StubJWKSServer()
+    server.start()
+    token = server.mint_token(BARISTA_PERMISSIONS)
+
+    try:
+        for size in sizes:
+            db_path = f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+            seed_db(db_path, size)
+            env = dict(
+                os.environ,
+                STARTUP_DB=db_path,
+                TOKEN=f"Bearer {token}",
+                JWKS_URL=server.url,
+                JWKS_PREFETCH="0",
+            )
+            runs = []
+
+            for _ in range(repeat):
+                output = subprocess.run(
+                    [sys.executable, "-c", STARTUP_SCRIPT],
+                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                runs.append(json.loads(output.splitlines()[-1]))
+
+            result = {"benchmark": "startup", "drinks": size, "runs": repeat}
+            for name in runs[0]:
+                result[name] = round(
+                    statistics.median(run[name] for run in runs), 3
+                )
+
+            yield result
+    finally:
+        server.stop()
+
+
+BENCHMARKS = {
+    "pagination": bench_pagination,
+    "menu": bench_menu,
+    "writes": bench_writes,
+    "bulk": bench_bulk,
+    "stream": bench_stream,
+    "concurrency": bench_concurrency,
+    "indexes": bench_indexes,
+    "search": bench_search,
+    "filters": bench_filters,
+    "serialize": bench_serialize,
+    "formatting": bench_formatting,
+    "compression": bench_compression,
+    "load": bench_load,
+    "asgi": bench_asgi,
+    "startup": bench_startup,
+}
+
+
+def main(argv=None):
+    """Runs the requested benchmarks and prints their results.
+
+    Args:
+        argv: A list of str representing the command line arguments
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        metavar="benchmark",
+        help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1000,10000,100000",
+        help="comma separated menu sizes to seed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="timed requests per measurement (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=LOAD_CONCURRENCY,
+        help="concurrent clients under load (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    sizes = [int(size) for size in args.sizes.split(",")]
+    app.config["DEBUG"] = False
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in args.benchmarks or BENCHMARKS:
+            options = {}
+            if name in ("load", "asgi"):
+                options["concurrency"] = args.concurrency
+            for result in BENCHMARKS[name](
+                sizes, args.repeat, workdir, **options
+            ):
+                print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+"""A local stand-in for Auth0 used to test and benchmark authentication.
+
+Serves a json web key set over http and mints RS256 access tokens signed with
+the matching private key, so authenticated endpoints can be exercised without
+real Auth0 tokens.
+
+Classes:
+    StubJWKSServer()
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import rsa
+from jose import jwk, jwt
+
+from src.auth.auth import ALGORITHMS, API_IDENTIFIER, AUTH0_DOMAIN
+
+BARISTA_PERMISSIONS = ["get:drinks-detail"]
+MANAGER_PERMISSIONS = [
+    "get:drinks-detail",
+    "post:drinks",
+    "patch:drinks",
+    "delete:drinks",
+]
+
+_key_pair = None
+
+
+def get_key_pair():
+    """Returns an rsa key pair, generating it on first use.
+
+    Key generation is slow, so one key pair is shared by every stub server in
+    the process.
+
+    Returns:
+        key_pair: A tuple of the rsa public and private keys
+    """
+    global _key_pair  # pylint: disable=global-statement
+
+    if _key_pair is None:
+        _key_pair = rsa.newkeys(2048)
+
+    return _key_pair
+
+
+class _JWKSHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the key set of the owning server."""
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        """Counts each new connection made to the server."""
+        super().setup()
+        with self.server.lock:
+            self.server.connection_count += 1
+
+    def do_GET(self):  # noqa: N802
+        """Serves the json web key set, or a 503 while unavailable."""
+        with self.server.lock:
+            self.server.fetch_count += 1
+
+        if not self.server.available:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        body = json.dumps(self.server.jwks).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Silences the default request logging."""
+
+
+class StubJWKSServer(ThreadingHTTPServer):
+    """A threaded http server publishing a freshly generated rsa key.
+
+    Attributes:
+        kid: A str representing the key id of the published key
+        jwks: A dict representing the json web key set being served
+        fetch_count: An int representing the number of key set requests
+        connection_count: An int representing the number of connections
+        available: A bool representing whether key set requests succeed
+        lock: A threading.Lock guarding the counters
+    """
+
+    daemon_threads = True
+
+    def __init__(self, kid="stub-key"):
+        """Set-up for StubJWKSServer."""
+        super().__init__(("127.0.0.1", 0), _JWKSHandler)
+        public_key, private_key = get_key_pair()
+        self._private_key = private_key.save_pkcs1().decode()
+        key = jwk.construct(public_key.save_pkcs1().decode(), ALGORITHMS[0])
+        key = key.to_dict()
+        self.kid = kid
+        self.jwks = {
+            "keys": [
+                {
+                    "kty": key["kty"],
+                    "kid": kid,
+                    "use": "sig",
+                    "n": key["n"].decode(),
+                    "e": key["e"].decode(),
+                }
+            ]
+        }
+        self.fetch_count = 0
+        self.connection_count = 0
+        self.available = True
+        self.lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        """A str representing the location of the served key set."""
+        host, port = self.server_address
+        return f"http://{host}:{port}/.well-known/jwks.json"
+
+    def start(self):
+        """Starts serving requests on a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving requests and closes the socket."""
+        self.shutdown()
+        self.server_close()
+
+    def mint_token(self, permissions, expires_in=3600, kid=None, **claims):
+        """Creates an access token signed with the served key.
+
+        Args:
+            permissions: A list of str representing the granted permissions
+            expires_in: An int representing the lifetime of the token in
+                seconds
+            kid: A str representing the key id to put in the token header
+                (default: the key id of the served key)
+            claims: Any extra claims to add to the token
+
+        Returns:
+            token: A str representing the signed access token
+        """
+        now = int(time.time())
+        payload = {
+            "iss": f"https://{AUTH0_DOMAIN}/",
+            "sub": "auth0|stub",
+            "aud": API_IDENTIFIER,
+            "iat": now,
+            "exp": now + expires_in,
+            "permissions": permissions,
+        }
+        payload.update(claims)
+        token = jwt.encode(
+            payload,
+            self._private_key,
+            algorithm=ALGORITHMS[0],
+            headers={"kid": kid or self.kid},
+        )
+
+        return token
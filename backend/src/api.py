@@ -6,23 +6,480 @@ privileges can create new drinks, those with patch privileges can edit drinks,
 and those with delete privileges can delete drinks.
 
 Usage: flask run
+       uvicorn src.api:asgi_app
+       uvicorn --factory src.api:create_asgi_app
+       flask purge-orphans [--batch-size N] [--vacuum full|incremental]
+       flask rebuild-documents
+       flask copy-replica [--interval SECONDS]
 
 Attributes:
-    app: A flask Flask object creating the flask app
+    MAX_PAGE_SIZE: An int representing the largest page of drinks that can be
+        requested with the limit query parameter
+    PAGE_ARGS: A tuple of the query parameters that select part of the menu
+    SEARCH_PAGE_SIZE: An int representing the number of matches returned by
+        a search without a limit
+    STREAM_CHUNK_SIZE: An int representing the number of drinks loaded at a
+        time when streaming drinks
+    blueprint: A flask Blueprint holding the routes, error handlers and
+        commands of the API
+    menu_cache: A ResponseCache holding the serialized full menu
+    app: A flask Flask object created by create_app on first use
+    asgi_app: An AsgiApp serving app to ASGI servers, created on first use
 """
 
-from flask import Flask, abort, jsonify, request
+import base64
+import binascii
+import bisect
+import functools
+import threading
+import time
+from itertools import chain
+
+import click
+from flask import (
+    Blueprint,
+    Flask,
+    abort,
+    current_app,
+    json,
+    request,
+    stream_with_context,
+)
 from flask_cors import CORS
 
+from src.auth import auth
 from src.auth.auth import AuthError, requires_auth
-from src.database.models import Drink, Ingredient, setup_db
+from src.bulk.bulk import import_drinks, iter_json_array, iter_ndjson
+from src.cache.cache import ResponseCache
+from src.compression import compression
+from src.database.models import (
+    DB_PATH,
+    ORPHAN_BATCH_SIZE,
+    REPLICA_DB_PATH,
+    Drink,
+    DrinkDocument,
+    Ingredient,
+    MenuVersion,
+    copy_to_replica,
+    db,
+    init_db,
+    load_ingredient_index,
+    purge_orphaned_ingredients,
+    reads_from_replica,
+    rebuild_documents,
+    vacuum_db,
+)
+from src.metrics import metrics
+from src.serializer import serializer
+from src.serializer.serializer import jsonify
+from src.timing import timing
+
+MAX_PAGE_SIZE = 1000
+SEARCH_PAGE_SIZE = 20
+PAGE_ARGS = ("limit", "cursor", "ingredient", "exclude_ingredient")
+STREAM_CHUNK_SIZE = 500
+
+blueprint = Blueprint("cafe", __name__, cli_group=None)
+menu_cache = ResponseCache()
+metrics.registry.add_collector(
+    metrics.cache_collector({"menu": menu_cache, "token": auth.token_cache})
+)
+_default_app_lock = threading.Lock()
+
+
+def create_app(config=None):
+    """Creates a flask app serving the API.
+
+    Nothing connects to the db until the app first uses it, so an app
+    created before a server forks doesn't share connections with its
+    workers.
 
-app = Flask(__name__)
-setup_db(app)
-CORS(app)
+    Args:
+        config: A dict of config overriding the defaults, with the db to use
+            under SQLALCHEMY_DATABASE_URI and its read-only replica under
+            REPLICA_DATABASE_URI (default: None)
+
+    Returns:
+        app: A flask app
+    """
+    app = Flask(__name__)
+    app.config.update(config or {})
+    init_db(
+        app,
+        app.config.get("SQLALCHEMY_DATABASE_URI", DB_PATH),
+        replica_path=app.config.get("REPLICA_DATABASE_URI", REPLICA_DB_PATH),
+    )
+    CORS(app)
+    timing.init_app(app)
+    compression.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(blueprint)
+
+    return app
+
+
+def create_asgi_app(app=None):
+    """Creates an app serving the API to ASGI servers.
+
+    Args:
+        app: A flask app to serve, or None to create one with create_app
+            (default: None)
+
+    Returns:
+        asgi_app: An AsgiApp serving the flask app
+    """
+    from src.asgi import asgi  # pylint: disable=import-outside-toplevel
+
+    return asgi.AsgiApp(app or create_app())
+
+
+def __getattr__(name):
+    """Creates the default app, or its ASGI interface, on first use.
+
+    Importing the module doesn't create an app or bind a db, so servers and
+    tests that build their own apps with create_app don't pay for it.
+
+    Args:
+        name: A str naming the module attribute looked up
+
+    Returns:
+        app: The default flask app, or the AsgiApp serving it
+
+    Raises:
+        AttributeError: The module has no such attribute
+    """
+    if name not in ("app", "asgi_app"):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    with _default_app_lock:
+        if "app" not in globals():
+            globals()["app"] = create_app()
+        if name == "asgi_app" and "asgi_app" not in globals():
+            globals()["asgi_app"] = create_asgi_app(globals()["app"])
+
+    return globals()[name]
+
+
+def encode_cursor(drink_id):
+    """Encodes the id of the last drink on a page as an opaque cursor.
+
+    Args:
+        drink_id: An int representing the id of the last drink on a page
+
+    Returns:
+        cursor: A str representing the position after the given drink
+    """
+    cursor = base64.urlsafe_b64encode(str(drink_id).encode()).decode()
+
+    return cursor.rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor created by encode_cursor.
+
+    Args:
+        cursor: A str representing a position in the list of drinks
+
+    Returns:
+        drink_id: An int representing the id of the last drink already seen
+    """
+    padding = "=" * (-len(cursor) % 4)
+
+    try:
+        drink_id = int(base64.urlsafe_b64decode(cursor + padding).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        abort(400)
+
+    # sqlite integers are signed 64-bit, larger ones can't be bound
+    if not 0 <= drink_id < 2 ** 63:
+        abort(400)
+
+    return drink_id
+
+
+def get_limit(default=None):
+    """Reads the page size from the limit arg.
+
+    Args:
+        default: An int representing the page size when no limit is given
+            (default: None)
+
+    Returns:
+        limit: An int representing the page size, or the default
+    """
+    limit = request.args.get("limit")
+
+    if limit is None:
+        return default
+
+    try:
+        limit = int(limit)
+    except ValueError:
+        abort(400)
+
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+
+    return limit
+
+
+def get_ingredient_filters():
+    """Reads the ingredient and exclude_ingredient args.
+
+    Each ingredient arg lists alternatives separated by '|', a drink has to
+    use one of them for every ingredient arg given. Blank names are
+    rejected with a 400 rather than matching nothing.
+
+    Returns:
+        include: A list of lists of str representing the ingredient groups
+        exclude: A list of str representing the ingredients to leave out
+    """
+    include = [
+        names.split("|") for names in request.args.getlist("ingredient")
+    ]
+    exclude = [
+        name
+        for names in request.args.getlist("exclude_ingredient")
+        for name in names.split("|")
+    ]
+
+    if any(not name.strip() for name in chain(exclude, *include)):
+        abort(400)
+
+    return include, exclude
+
+
+def find_drink_ids(include, exclude, cursor, limit):
+    """Finds the ids of a page of the drinks matching the ingredient filters.
+
+    The matching ids come from set operations on the ingredient index, so
+    no drinks are read from the db.
+
+    Args:
+        include: A list of lists of str representing the ingredient groups
+        exclude: A list of str representing the ingredients to leave out
+        cursor: A str representing the cursor of the page, or None
+        limit: An int representing the page size, or None for every match
+
+    Returns:
+        drink_ids: A list of ints representing the drinks on the page
+        next_cursor: A str representing the cursor for the next page, or None
+            if this is the last page
+    """
+    drink_ids = load_ingredient_index().find(include, exclude)
+    next_cursor = None
+
+    if cursor is not None:
+        start = bisect.bisect_right(drink_ids, decode_cursor(cursor))
+        drink_ids = drink_ids[start:]
+
+    if limit is not None and len(drink_ids) > limit:
+        drink_ids = drink_ids[:limit]
+        next_cursor = encode_cursor(drink_ids[-1])
+
+    return drink_ids, next_cursor
+
+
+def paginate_drinks(page, get_many):
+    """Retrieves the page of drinks requested by the query args.
+
+    Pages are found by seeking past the id in the cursor rather than with an
+    offset, so every page costs the same to fetch. Without a limit every
+    drink is returned.
+
+    Args:
+        page: A function taking the id a page starts after, or None, and the
+            most drinks to return, or None, and returning a list of tuples of
+            a drink id and the drink
+        get_many: A function taking a list of drink ids and returning their
+            drinks in the order given
+
+    Returns:
+        drinks: A list of the drinks on the requested page
+        next_cursor: A str representing the cursor for the next page, or None
+            if this is the last page
+    """
+    limit = get_limit()
+    cursor = request.args.get("cursor")
+    include, exclude = get_ingredient_filters()
+
+    if include or exclude:
+        drink_ids, next_cursor = find_drink_ids(
+            include, exclude, cursor, limit
+        )
+
+        return get_many(drink_ids), next_cursor
+
+    rows = page(
+        None if cursor is None else decode_cursor(cursor),
+        None if limit is None else limit + 1,
+    )
+    next_cursor = None
+
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0])
+
+    return [drink for _, drink in rows], next_cursor
+
+
+def wants_stream():
+    """Checks whether the client asked for drinks as newline delimited json.
+
+    Returns:
+        stream: A bool representing whether to stream the drinks
+    """
+    if request.args.get("stream") == "1":
+        return True
+
+    best_match = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
+    )
+
+    return best_match == "application/x-ndjson"
+
+
+def stream_response(format_name):
+    """Streams every drink in the given format, one json object per line.
+
+    Drinks are formatted STREAM_CHUNK_SIZE at a time by seeking past the
+    last id, so memory use doesn't grow with the size of the menu.
+
+    Args:
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        response: A newline delimited json response streaming the drinks
+    """
+
+    def generate():
+        last_id = None
+
+        while True:
+            drinks = Drink.format_page(format_name, last_id, STREAM_CHUNK_SIZE)
+
+            if not drinks:
+                return
 
+            yield "".join(json.dumps(drink) + "\n" for _, drink in drinks)
+            last_id = drinks[-1][0]
 
-@app.after_request
+    response = current_app.response_class(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+
+    return response
+
+
+def drinks_response(drinks, next_cursor):
+    """Serializes a list of formatted drinks.
+
+    Args:
+        drinks: A list of dicts representing the drinks to list
+        next_cursor: A str representing the cursor for the next page, or None
+
+    Returns:
+        response: A json object representing the drinks
+    """
+    with timing.phase("serialize"):
+        response = jsonify(
+            {"success": True, "drinks": drinks, "next_cursor": next_cursor}
+        )
+
+    return response
+
+
+def documents_response(documents, next_cursor):
+    """Lists stored drink documents without decoding them.
+
+    Args:
+        documents: A list of str representing the drinks as canonical json
+        next_cursor: A str representing the cursor for the next page, or None
+
+    Returns:
+        response: A json object representing the drinks, the same as
+            drinks_response would build
+    """
+    with timing.phase("serialize"):
+        body = "".join(
+            (
+                '{"drinks":[',
+                ",".join(documents),
+                '],"next_cursor":',
+                json.dumps(next_cursor),
+                ',"success":true}\n',
+            )
+        )
+
+    return current_app.response_class(
+        body, mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
+
+
+def page_response(format_name):
+    """Builds the response listing the page of drinks the args request.
+
+    The stored drink documents are served as they are when responses are
+    canonical json. Otherwise the drinks are formatted straight from their
+    rows, without loading them as objects.
+
+    Args:
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        response: A json object representing the requested drinks
+    """
+    if serializer.is_canonical():
+        documents, next_cursor = paginate_drinks(
+            functools.partial(DrinkDocument.page, format_name),
+            functools.partial(DrinkDocument.get_many, format_name),
+        )
+
+        return documents_response(documents, next_cursor)
+
+    drinks, next_cursor = paginate_drinks(
+        functools.partial(Drink.format_page, format_name),
+        functools.partial(Drink.format_many, format_name),
+    )
+
+    return drinks_response(drinks, next_cursor)
+
+
+def menu_response(format_name):
+    """Builds the response listing the drinks in the given format.
+
+    The full menu is served from menu_cache until the menu version changes
+    and carries an etag, so clients that already have it get a 304. The
+    cached body keeps its compressed variants too. Paged and filtered
+    requests are not cached.
+
+    Args:
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        response: A json object representing the requested drinks
+    """
+    if any(arg in request.args for arg in PAGE_ARGS):
+        return page_response(format_name)
+
+    key = (str(db.session.get_bind().url), format_name)
+    version = MenuVersion.current()
+    cached_body = menu_cache.get(key, version)
+
+    if cached_body is None:
+        body = page_response(format_name).get_data()
+        cached_body = menu_cache.put(key, version, body)
+
+    response = current_app.response_class(
+        cached_body.body, mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
+    response.set_etag(cached_body.etag)
+    response.compressed_variants = cached_body.compressed_variants
+
+    return response.make_conditional(request)
+
+
+@blueprint.after_app_request
 def after_request(response):
     """Adds response headers after request.
 
@@ -42,40 +499,95 @@ def after_request(response):
     return response
 
 
-@app.route("/drinks", methods=["GET"])
+@blueprint.route("/metrics", methods=["GET"])
+def get_metrics():
+    """Route handler for endpoint exposing metrics to prometheus.
+
+    Returns:
+        response: The metrics of every worker process in the prometheus text
+            format
+    """
+    response = current_app.response_class(
+        metrics.registry.render(), mimetype="text/plain"
+    )
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+
+    return response
+
+
+@blueprint.route("/drinks", methods=["GET"])
+@reads_from_replica
 def get_drinks():
     """Route handler for endpoint showing all drinks in short form.
 
+    Accepts optional 'limit' and 'cursor' query parameters to page through
+    the drinks, and 'ingredient' and 'exclude_ingredient' query parameters
+    to filter them. The full menu honors 'If-None-Match'.
+
     Returns:
         response: A json object representing all drinks
     """
-    drinks = Drink.query.order_by(Drink.id).all()
-    drinks = [drink.short_format() for drink in drinks]
+    response = menu_response("short_format")
+
+    return response
+
+
+@blueprint.route("/drinks/search", methods=["GET"])
+def search_drinks():
+    """Route handler for endpoint searching drinks by title and ingredients.
+
+    Requires a 'q' query parameter of the words to search for, each of which
+    may be the start of a word. Accepts optional 'limit' and 'cursor' query
+    parameters to page through the matches, best match first.
+
+    Returns:
+        response: A json object representing the matching drinks in short
+            form
+    """
+    terms = request.args.get("q", "")
 
-    response = jsonify({"success": True, "drinks": drinks})
+    if not terms.strip():
+        abort(400)
+
+    limit = get_limit(SEARCH_PAGE_SIZE)
+    cursor = request.args.get("cursor")
+    offset = 0 if cursor is None else decode_cursor(cursor)
+    drink_ids = Drink.search(terms, limit + 1, offset)
+    next_cursor = None
+
+    if len(drink_ids) > limit:
+        drink_ids = drink_ids[:limit]
+        next_cursor = encode_cursor(offset + limit)
+
+    drinks = Drink.format_many("short_format", drink_ids)
+    response = drinks_response(drinks, next_cursor)
 
     return response
 
 
-@app.route("/drinks-detail")
+@blueprint.route("/drinks-detail")
+@reads_from_replica
 @requires_auth("get:drinks-detail")
 def get_drinks_detail():
     """Route handler for endpoint showing all drinks in long form.
 
-    Requires 'get:drinks-detail' permission
+    Requires 'get:drinks-detail' permission. Accepts optional 'limit' and
+    'cursor' query parameters to page through the drinks. The full menu
+    honors 'If-None-Match'. With 'Accept: application/x-ndjson' or
+    'stream=1' every drink is streamed as a json object per line instead.
 
     Returns:
         response: A json object representing all drinks
     """
-    drinks = Drink.query.order_by(Drink.id).all()
-    drinks = [drink.long_format() for drink in drinks]
+    if wants_stream():
+        return stream_response("long_format")
 
-    response = jsonify({"success": True, "drinks": drinks})
+    response = menu_response("long_format")
 
     return response
 
 
-@app.route("/drinks", methods=["POST"])
+@blueprint.route("/drinks", methods=["POST"])
 @requires_auth("post:drinks")
 def create_drink():
     """Route handler for endpoint to create a drink.
@@ -86,7 +598,6 @@ def create_drink():
     try:
 
         drink = Drink(title=request.json.get("title"))
-        drink.insert()
 
         for ingredient in request.json.get("recipe"):
 
@@ -94,10 +605,11 @@ def create_drink():
                 name=ingredient.get("name"),
                 parts=ingredient.get("parts"),
                 color=ingredient.get("color"),
-                drink_id=drink.id,
             )
 
-            ingredient.insert()
+            drink.recipe.append(ingredient)
+
+        drink.insert()
 
         response = jsonify(
             {
@@ -109,12 +621,41 @@ def create_drink():
         )
 
     except AttributeError:
+        db.session.rollback()
+        abort(400)
+
+    return response
+
+
+@blueprint.route("/drinks/bulk", methods=["POST"])
+@requires_auth("post:drinks")
+def create_drinks_bulk():
+    """Route handler for endpoint to create many drinks at once.
+
+    Requires 'post:drinks' permission. The body is either a json array of
+    drinks or, with a 'Content-Type' of 'application/x-ndjson', one drink per
+    line. It is parsed as it is read and drinks are inserted in batches.
+
+    Returns:
+        response: A json object mapping the index of each created drink to
+            its id and describing the items that could not be created
+    """
+    if request.mimetype in ("application/x-ndjson", "application/jsonl"):
+        items = iter_ndjson(request.stream)
+    else:
+        items = iter_json_array(request.stream)
+
+    try:
+        created, errors = import_drinks(items)
+    except ValueError:
         abort(400)
 
+    response = jsonify({"success": True, "created": created, "errors": errors})
+
     return response
 
 
-@app.route("/drinks/<int:drink_id>", methods=["PATCH"])
+@blueprint.route("/drinks/<int:drink_id>", methods=["PATCH"])
 @requires_auth("patch:drinks")
 def patch_book_rating(drink_id):
     """Route handler for endpoint updating the a single drink.
@@ -140,24 +681,12 @@ def patch_book_rating(drink_id):
             drink.title = title
 
         if recipe is not None:
-
-            for ingredient in drink.recipe:
-                ingredient.delete()
-
-            for ingredient in request.json.get("recipe"):
-
-                ingredient = Ingredient(
-                    name=ingredient.get("name"),
-                    parts=ingredient.get("parts"),
-                    color=ingredient.get("color"),
-                    drink_id=drink.id,
-                )
-
-                ingredient.insert()
+            drink.update_recipe(recipe)
 
         drink.update()
 
     except AttributeError:
+        db.session.rollback()
         abort(400)
 
     response = jsonify(
@@ -172,7 +701,7 @@ def patch_book_rating(drink_id):
     return response
 
 
-@app.route("/drinks/<int:drink_id>", methods=["DELETE"])
+@blueprint.route("/drinks/<int:drink_id>", methods=["DELETE"])
 @requires_auth("delete:drinks")
 def delete_drink(drink_id):
     """Route handler for endpoint to delete a single drink.
@@ -203,7 +732,7 @@ def delete_drink(drink_id):
     return response
 
 
-@app.errorhandler(400)
+@blueprint.app_errorhandler(400)
 def bad_request(error):  # pylint: disable=unused-argument
     """Error handler for 400 bad request.
 
@@ -223,7 +752,7 @@ def bad_request(error):  # pylint: disable=unused-argument
     return response, 400
 
 
-@app.errorhandler(404)
+@blueprint.app_errorhandler(404)
 def not_found(error):  # pylint: disable=unused-argument
     """Error handler for 404 not found.
 
@@ -243,7 +772,7 @@ def not_found(error):  # pylint: disable=unused-argument
     return response, 404
 
 
-@app.errorhandler(405)
+@blueprint.app_errorhandler(405)
 def method_not_allowed(error):  # pylint: disable=unused-argument
     """Error handler for 405 method not allowed.
 
@@ -263,7 +792,7 @@ def method_not_allowed(error):  # pylint: disable=unused-argument
     return response, 405
 
 
-@app.errorhandler(422)
+@blueprint.app_errorhandler(422)
 def unprocessable_entity(error):  # pylint: disable=unused-argument
     """Error handler for 422 unprocessable entity.
 
@@ -283,7 +812,7 @@ def unprocessable_entity(error):  # pylint: disable=unused-argument
     return response, 422
 
 
-@app.errorhandler(500)
+@blueprint.app_errorhandler(500)
 def internal_server_error(error):  # pylint: disable=unused-argument
     """Error handler for 500 internal server error.
 
@@ -303,7 +832,7 @@ def internal_server_error(error):  # pylint: disable=unused-argument
     return response, 500
 
 
-@app.errorhandler(AuthError)
+@blueprint.app_errorhandler(AuthError)
 def authorization_error(error):
     """Error handler for authorization error.
 
@@ -313,8 +842,74 @@ def authorization_error(error):
     Returns:
         Response: A json object with the error code and message
     """
+    metrics.record_auth_failure(error.error["error_code"])
     error.error["success"] = False
     response = jsonify(error.error)
     response.status_code = error.status_code
 
     return response
+
+
+@blueprint.cli.command("purge-orphans")
+@click.option(
+    "--batch-size",
+    default=ORPHAN_BATCH_SIZE,
+    show_default=True,
+    help="Orphaned ingredients deleted per transaction.",
+)
+@click.option(
+    "--vacuum",
+    type=click.Choice(["none", "full", "incremental"]),
+    default="none",
+    show_default=True,
+    help="How to return the freed space to the file system.",
+)
+def purge_orphans(batch_size, vacuum):
+    """Deletes the ingredients left behind by deleted drinks.
+
+    Args:
+        batch_size: An int representing the most orphans deleted per
+            transaction
+        vacuum: A str representing how to vacuum the db afterwards
+    """
+    purged = purge_orphaned_ingredients(batch_size)
+    reclaimed = 0
+
+    if vacuum != "none":
+        reclaimed = vacuum_db(incremental=vacuum == "incremental")
+
+    click.echo(
+        f"Purged {purged} orphaned ingredients, reclaimed {reclaimed} bytes"
+    )
+
+
+@blueprint.cli.command("rebuild-documents")
+def rebuild_drink_documents():
+    """Rebuilds the stored drink documents from the drinks and recipes."""
+    rebuilt = rebuild_documents()
+
+    click.echo(f"Rebuilt the documents of {rebuilt} drinks")
+
+
+@blueprint.cli.command("copy-replica")
+@click.option(
+    "--interval",
+    type=float,
+    default=None,
+    help="Seconds between copies, to keep copying until stopped.",
+)
+def copy_replica(interval):
+    """Copies the db over its read-only replica.
+
+    Args:
+        interval: A float representing the seconds to wait between copies,
+            or None to copy once
+    """
+    while True:
+        copy_to_replica()
+        click.echo("Copied the db to the replica")
+
+        if interval is None:
+            return
+
+        time.sleep(interval)
@@ -0,0 +1,325 @@
+"""An ASGI interface serving the flask app from a pool of threads.
+
+Request bodies are read on the event loop, and the key a request's token is
+signed with is fetched there without blocking if it isn't cached, so slow
+clients and Auth0 only hold a coroutine. Each request is then handled by the
+unchanged flask app on a bounded pool of threads, with the same routes, error
+handlers and request hooks as under WSGI. Responses of a known length are
+sent from the loop once the thread is done with them. Streamed responses
+hold their thread until they are sent, as the session they read drinks with
+belongs to that thread.
+
+Attributes:
+    ASGI_THREADS: An int representing the number of threads handling requests
+    ASGI_BUFFER_SIZE: An int representing the most bytes of a request body
+        read on the event loop, the rest is read by the thread handling it
+
+Classes:
+    ReceiveStream()
+    AsgiApp()
+"""
+
+import asyncio
+import io
+import itertools
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from src.auth import auth
+
+ASGI_THREADS = int(os.getenv("ASGI_THREADS", "8"))
+ASGI_BUFFER_SIZE = int(os.getenv("ASGI_BUFFER_SIZE", str(1 << 20)))
+
+
+class ReceiveStream(io.RawIOBase):
+    """A request body a thread reads from the event loop.
+
+    Attributes:
+        loop: The event loop receiving the request
+    """
+
+    def __init__(self, body, receive=None, loop=None):
+        """Set-up for ReceiveStream.
+
+        Args:
+            body: A bytes object representing the part of the body already
+                read
+            receive: The ASGI receive callable for the rest of the body, or
+                None if it has all been read
+            loop: The event loop receive is awaited on
+        """
+        super().__init__()
+        self.loop = loop
+        self._chunk = memoryview(body)
+        self._receive = receive
+
+    def readable(self):
+        """Returns True as the body can be read."""
+        return True
+
+    def readinto(self, buffer):
+        """Reads the next bytes of the body into a buffer.
+
+        Args:
+            buffer: A writable bytes-like object to fill
+
+        Returns:
+            size: An int representing the number of bytes read, 0 at the end
+                of the body
+        """
+        while not self._chunk and self._receive is not None:
+            message = asyncio.run_coroutine_threadsafe(
+                self._receive(), self.loop
+            ).result()
+            self._chunk = memoryview(message.get("body", b""))
+            if not message.get("more_body"):
+                self._receive = None
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+
+        return size
+
+
+async def read_body(receive, limit=None):
+    """Reads a request body on the event loop, up to a limit.
+
+    Args:
+        receive: The ASGI receive callable of the request
+        limit: An int representing the most bytes to read before returning,
+            or None to read the whole body
+
+    Returns:
+        body: A bytes object representing the body read, or None if the
+            client disconnected
+        more: A bool representing whether there is more of the body to read
+    """
+    chunks = []
+    size = 0
+
+    while limit is None or size < limit:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None, False
+        chunk = message.get("body", b"")
+        chunks.append(chunk)
+        size += len(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks), False
+
+    return b"".join(chunks), True
+
+
+def build_environ(scope, wsgi_input):
+    """Builds the WSGI environ of an ASGI http request.
+
+    Args:
+        scope: A dict representing the ASGI connection scope
+        wsgi_input: A file-like object to read the request body from
+
+    Returns:
+        environ: A dict representing the WSGI environ
+    """
+    root_path = scope.get("root_path", "")
+    path = scope["path"]
+    if path.startswith(root_path):
+        path = path[len(root_path) :]
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path.encode().decode("latin-1"),
+        "PATH_INFO": path.encode().decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1] or 80),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": wsgi_input,
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+    for name, value in scope.get("headers", ()):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        if key not in ("CONTENT_LENGTH", "CONTENT_TYPE"):
+            key = f"HTTP_{key}"
+        value = value.decode("latin-1")
+        if key in environ:
+            separator = "; " if key == "HTTP_COOKIE" else ","
+            value = f"{environ[key]}{separator}{value}"
+        environ[key] = value
+
+    return environ
+
+
+class AsgiApp:
+    """An ASGI app handing each request to a WSGI app on a pool of threads.
+
+    Attributes:
+        wsgi_app: The WSGI app handling each request
+        executor: A ThreadPoolExecutor running the WSGI app
+        prefetch_keys: A bool representing whether token keys are fetched on
+            the event loop and kept fresh by it
+    """
+
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, prefetch_keys=True):
+        """Set-up for AsgiApp."""
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="asgi")
+        self.prefetch_keys = prefetch_keys
+
+    async def __call__(self, scope, receive, send):
+        """Handles an ASGI connection.
+
+        Args:
+            scope: A dict representing the ASGI connection scope
+            receive: The ASGI receive callable of the connection
+            send: The ASGI send callable of the connection
+
+        Raises:
+            ValueError: The connection is neither http nor lifespan
+        """
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+        else:
+            raise ValueError(f"unsupported scope type: {scope['type']}")
+
+    async def handle_lifespan(self, receive, send):
+        """Keeps the key set fresh on the loop while the server runs.
+
+        Args:
+            receive: The ASGI receive callable of the lifespan
+            send: The ASGI send callable of the lifespan
+        """
+        refresher = None
+
+        while True:
+            message = await receive()
+
+            if message["type"] == "lifespan.startup":
+                if self.prefetch_keys and auth.jwks_cache.prefetch:
+                    refresher = asyncio.ensure_future(
+                        auth.jwks_cache.run_refresher_async()
+                    )
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if refresher is not None:
+                    refresher.cancel()
+                    await asyncio.gather(refresher, return_exceptions=True)
+                self.executor.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        """Handles an http request with the WSGI app.
+
+        Args:
+            scope: A dict representing the ASGI connection scope
+            receive: The ASGI receive callable of the request
+            send: The ASGI send callable of the request
+        """
+        loop = asyncio.get_running_loop()
+        body, more = await read_body(receive, ASGI_BUFFER_SIZE)
+
+        if body is None:
+            return
+
+        wsgi_input = io.BufferedReader(
+            ReceiveStream(body, receive if more else None, loop)
+        )
+        environ = build_environ(scope, wsgi_input)
+
+        if self.prefetch_keys:
+            await auth.fetch_token_key_async(environ.get("HTTP_AUTHORIZATION"))
+
+        start, chunks = await loop.run_in_executor(
+            self.executor, self.run_wsgi, environ, send, loop
+        )
+
+        if start is not None:
+            await send(start)
+            for chunk in chunks:
+                if chunk:
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": True,
+                        }
+                    )
+        await send({"type": "http.response.body", "body": b""})
+
+    def run_wsgi(self, environ, send, loop):
+        """Calls the WSGI app in a worker thread.
+
+        A response of a known length is returned to be sent from the loop.
+        Any other response is streamed from this thread as it is produced.
+        Data given to the write callable start_response returns is sent
+        ahead of the app's iterable.
+
+        Args:
+            environ: A dict representing the WSGI environ of the request
+            send: The ASGI send callable of the request
+            loop: The event loop the request is sent on
+
+        Returns:
+            start: A dict representing the ASGI response start message, or
+                None if the response was streamed
+            chunks: A list of bytes objects representing the response body
+        """
+        response = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            response["start"] = {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+            return written.append
+
+        iterable = self.wsgi_app(environ, start_response)
+
+        try:
+            iterator = iter(iterable)
+            first = next(iterator, b"")
+            chunks = [*written, first]
+            start = response["start"]
+
+            if any(name == b"content-length" for name, _ in start["headers"]):
+                chunks.extend(iterator)
+                return start, chunks
+
+            def send_now(message):
+                asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+            send_now(start)
+            for chunk in itertools.chain(chunks, iterator):
+                if chunk:
+                    send_now(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": True,
+                        }
+                    )
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+        return None, []
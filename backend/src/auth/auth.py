@@ -5,21 +5,59 @@ Attributes:
     ALGORITHMS: A list representing the accepted encryption algorithms for the
         access token
     API_IDENTIFIER: A str representing the unique identifier for the Auth0 api
+    JWKS_URL: A str representing the location of the Auth0 json web key set
+    JWKS_CACHE_TTL: A float representing the number of seconds a fetched key
+        set is trusted before it is fetched again
+    JWKS_MIN_REFRESH_INTERVAL: A float representing the minimum number of
+        seconds between refreshes triggered by an unknown key id
+    JWKS_REFRESH_AHEAD: A float representing the number of seconds before a
+        key set goes stale that the background thread refreshes it
+    JWKS_MAX_STALE: A float representing the number of seconds past the ttl
+        that a key set that could not be refreshed is still trusted
+    JWKS_SNAPSHOT_PATH: A str representing the file the key set is persisted
+        to so new processes can skip fetching it, or None
+    JWKS_PREFETCH: A bool representing whether the key set is kept fresh by a
+        background thread
+    TOKEN_CACHE_SIZE: An int representing the maximum number of verified
+        tokens kept in the token cache
+    jwks_cache: A JWKSCache shared by every request in the process
+    token_cache: A TokenCache shared by every request in the process
 
 Classes:
     AuthError()
+    JWKSCache()
+    TokenCache()
 """
 
+import asyncio
+import hashlib
 import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 
 from flask import request
-from jose import jwt
-from six.moves.urllib.request import urlopen
+from six.moves import http_client
+from six.moves.urllib.parse import urlsplit
+
+from src.timing import timing
 
 AUTH0_DOMAIN = "full-stack-cafe.auth0.com"
 ALGORITHMS = ["RS256"]
 API_IDENTIFIER = "http://127.0.0.1/"
+JWKS_URL = os.getenv(
+    "JWKS_URL", f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+)
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "600"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+JWKS_REFRESH_AHEAD = float(os.getenv("JWKS_REFRESH_AHEAD", "60"))
+JWKS_MAX_STALE = float(os.getenv("JWKS_MAX_STALE", "600"))
+JWKS_SNAPSHOT_PATH = os.getenv("JWKS_SNAPSHOT_PATH") or None
+JWKS_PREFETCH = os.getenv("JWKS_PREFETCH", "1") == "1"
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1024"))
 
 
 class AuthError(Exception):
@@ -37,6 +75,570 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+class JWKSCache:
+    """A process-wide cache of the rsa keys published by Auth0.
+
+    The key set is fetched at most once per ttl. A token signed with a key id
+    that is not in the cache forces an early refresh, but those refreshes are
+    rate limited so that tokens with bogus key ids can't hammer Auth0. All
+    fetches reuse a single keep-alive connection.
+
+    With a snapshot path, every fetched key set is also written to disk and a
+    new process starts from the snapshot instead of fetching. With prefetch
+    on, a background thread refreshes the key set before it goes stale, so
+    requests only wait on Auth0 for a key id they have never seen. Under an
+    event loop, the key set can instead be fetched and kept fresh without
+    blocking, with get_key_async and run_refresher_async.
+
+    While Auth0 can't be reached, the last key set fetched is trusted for
+    max_stale seconds past its ttl. After that, lookups refresh it themselves,
+    at most once per min_refresh_interval, and find no keys until a refresh
+    succeeds, so a key revoked upstream stops being trusted.
+
+    Attributes:
+        url: A str representing the location of the json web key set
+        ttl: A float representing the number of seconds a key set is fresh
+        min_refresh_interval: A float representing the minimum number of
+            seconds between two fetches
+        clock: A callable returning the current unix time in seconds
+        snapshot_path: A str representing the file the key set is persisted
+            to, or None to keep it in memory only
+        prefetch: A bool representing whether a background thread keeps the
+            key set fresh
+        refresh_ahead: A float representing the number of seconds before the
+            key set goes stale that the background thread refreshes it
+        max_stale: A float representing the number of seconds past the ttl
+            that a key set that could not be refreshed is still trusted
+        fetch_count: An int representing the number of fetches performed
+    """
+
+    def __init__(
+        self,
+        url,
+        ttl=JWKS_CACHE_TTL,
+        min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+        clock=time.time,
+        snapshot_path=None,
+        prefetch=False,
+        refresh_ahead=JWKS_REFRESH_AHEAD,
+        max_stale=JWKS_MAX_STALE,
+    ):
+        """Set-up for JWKSCache."""
+        self.url = url
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self.snapshot_path = snapshot_path
+        self.prefetch = prefetch
+        self.refresh_ahead = refresh_ahead
+        self.max_stale = max_stale
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._connection = None
+        self._refresher = None
+        self._refresher_pid = None
+        self._stop = threading.Event()
+        self._async_lock = None
+        self._async_lock_loop = None
+        self._refreshing_async = False
+
+        if snapshot_path:
+            self.load_snapshot()
+
+    def get_key(self, kid):
+        """Retrieves the rsa key with the given key id.
+
+        Args:
+            kid: A str representing the key id from the token header
+
+        Returns:
+            rsa_key: A dict representing the rsa key, or None if Auth0 does
+                not publish a key with that id
+        """
+        if self.prefetch:
+            self.start_refresher()
+
+        if kid not in self._keys or self._needs_refresh(kid):
+            with self._lock:
+                if self._needs_refresh(kid):
+                    self.refresh()
+
+        return self._trusted_key(kid)
+
+    async def get_key_async(self, kid):
+        """Retrieves the rsa key with the given key id without blocking.
+
+        Args:
+            kid: A str representing the key id from the token header
+
+        Returns:
+            rsa_key: A dict representing the rsa key, or None if Auth0 does
+                not publish a key with that id
+        """
+        if kid not in self._keys or self._needs_refresh(kid):
+            async with self._get_async_lock():
+                if self._needs_refresh(kid):
+                    await self.refresh_async()
+
+        return self._trusted_key(kid)
+
+    def refresh(self):
+        """Fetches the key set from Auth0 and replaces the cached keys.
+
+        Returns:
+            refreshed: A bool representing whether the fetch succeeded
+        """
+        fetched_at = self._fetched_at = self.clock()
+        self.fetch_count += 1
+
+        try:
+            jwks = self._fetch()
+        except (OSError, http_client.HTTPException, ValueError):
+            self._close()
+            if not self._keys:
+                raise
+            return False
+
+        self._store(jwks, fetched_at)
+
+        return True
+
+    async def refresh_async(self):
+        """Fetches the key set like refresh, without blocking the event loop.
+
+        Returns:
+            refreshed: A bool representing whether the fetch succeeded
+        """
+        fetched_at = self._fetched_at = self.clock()
+        self.fetch_count += 1
+
+        try:
+            jwks = await asyncio.wait_for(self._fetch_async(), timeout=10)
+        except (OSError, asyncio.TimeoutError, ValueError):
+            if not self._keys:
+                raise
+            return False
+
+        self._store(jwks, fetched_at)
+
+        return True
+
+    def load(self, jwks):
+        """Replaces the cached keys with those from the given key set.
+
+        Args:
+            jwks: A dict representing a json web key set
+        """
+        self._keys = {
+            key["kid"]: {
+                "kty": key["kty"],
+                "kid": key["kid"],
+                "use": key["use"],
+                "n": key["n"],
+                "e": key["e"],
+            }
+            for key in jwks["keys"]
+        }
+
+    def load_snapshot(self):
+        """Replaces the cached keys with the snapshot, if it is newer.
+
+        Returns:
+            loaded: A bool representing whether the snapshot was loaded
+        """
+        try:
+            with open(self.snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            fetched_at = min(float(snapshot["fetched_at"]), self.clock())
+            if self._fetched_at is not None and fetched_at <= self._fetched_at:
+                return False
+            self.load(snapshot["jwks"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self._fetched_at = self._loaded_at = fetched_at
+
+        return True
+
+    def save_snapshot(self, jwks, fetched_at):
+        """Atomically writes the key set to the snapshot path.
+
+        The snapshot is only readable by the current user, as anyone able to
+        change it could get their own keys trusted.
+
+        Args:
+            jwks: A dict representing a json web key set
+            fetched_at: A float representing when the key set was fetched
+        """
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as snapshot_file:
+                json.dump(
+                    {"fetched_at": fetched_at, "jwks": jwks}, snapshot_file
+                )
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            # A missing snapshot only costs the next process a fetch
+            pass
+
+    def prefetch_now(self):
+        """Refreshes the key set if it is due to be refreshed ahead of time.
+
+        Another process may already have refreshed the snapshot, in which
+        case it is loaded rather than fetching again.
+
+        Returns:
+            refreshed: A bool representing whether the key set is up to date
+        """
+        with self._lock:
+            if not self._is_refresh_due():
+                return True
+            try:
+                return self.refresh()
+            except (OSError, http_client.HTTPException, ValueError):
+                return False
+
+    async def prefetch_async(self):
+        """Refreshes the key set ahead of time like prefetch_now, on a loop.
+
+        Returns:
+            refreshed: A bool representing whether the key set is up to date
+        """
+        async with self._get_async_lock():
+            if not self._is_refresh_due():
+                return True
+            try:
+                return await self.refresh_async()
+            except (OSError, asyncio.TimeoutError, ValueError):
+                return False
+
+    def next_refresh_in(self):
+        """Calculates when the background thread should next refresh.
+
+        Returns:
+            delay: A float representing the number of seconds until the next
+                refresh is due
+        """
+        if self._fetched_at is None:
+            return 0.0
+
+        due_at = self._fetched_at + self.ttl - self.refresh_ahead
+
+        return max(due_at - self.clock(), 0.0)
+
+    def start_refresher(self):
+        """Starts the background thread in this process if it isn't running.
+
+        The check runs on every lookup, so a worker forked from a process
+        that already had a refresher starts its own.
+        """
+        if self._refresher_pid == os.getpid() or self._refreshing_async:
+            return
+
+        with self._lock:
+            if self._refresher_pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._refresher = threading.Thread(
+                target=self._run_refresher,
+                args=(self._stop,),
+                name="jwks-refresher",
+                daemon=True,
+            )
+            self._refresher_pid = os.getpid()
+            self._refresher.start()
+
+    def stop_refresher(self):
+        """Stops the background thread and waits for it to finish."""
+        self._stop.set()
+
+        if self._refresher is not None and self._refresher_pid == os.getpid():
+            self._refresher.join()
+
+        self._refresher = None
+        self._refresher_pid = None
+
+    def clear(self):
+        """Drops the cached keys and stops the refresher and connection."""
+        self.stop_refresher()
+
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = self._loaded_at = None
+            self._close()
+
+    async def run_refresher_async(self):
+        """Keeps the key set fresh from the event loop until cancelled.
+
+        While it runs, lookups in this process don't start the background
+        thread.
+        """
+        self._refreshing_async = True
+
+        try:
+            while True:
+                if await self.prefetch_async():
+                    delay = self.next_refresh_in()
+                else:
+                    delay = self.min_refresh_interval
+                await asyncio.sleep(max(delay, 0.1))
+        finally:
+            self._refreshing_async = False
+
+    def _run_refresher(self, stop):
+        while not stop.is_set():
+            if self.prefetch_now():
+                delay = self.next_refresh_in()
+            else:
+                delay = self.min_refresh_interval
+            stop.wait(max(delay, 0.1))
+
+    def _needs_refresh(self, kid):
+        if kid in self._keys and not self._is_expired():
+            return self._is_stale() and not self._is_prefetching()
+        return self._is_stale() or self._can_refresh()
+
+    def _trusted_key(self, kid):
+        if self._is_expired():
+            return None
+        return self._keys.get(kid)
+
+    def _is_prefetching(self):
+        return self.prefetch and (
+            self._refresher_pid == os.getpid() or self._refreshing_async
+        )
+
+    def _is_refresh_due(self):
+        # Another process may already have refreshed the snapshot
+        if self.next_refresh_in() > 0:
+            return False
+        if self.snapshot_path and self.load_snapshot():
+            return self.next_refresh_in() <= 0
+        return True
+
+    def _store(self, jwks, fetched_at):
+        self.load(jwks)
+        self._loaded_at = fetched_at
+
+        if self.snapshot_path:
+            self.save_snapshot(jwks, fetched_at)
+
+    def _get_async_lock(self):
+        loop = asyncio.get_running_loop()
+
+        if self._async_lock_loop is not loop:
+            self._async_lock = asyncio.Lock()
+            self._async_lock_loop = loop
+
+        return self._async_lock
+
+    def _is_stale(self):
+        return (
+            self._fetched_at is None
+            or self.clock() - self._fetched_at >= self.ttl
+        )
+
+    def _is_expired(self):
+        return (
+            self._loaded_at is None
+            or self.clock() - self._loaded_at >= self.ttl + self.max_stale
+        )
+
+    def _can_refresh(self):
+        return self.clock() - self._fetched_at >= self.min_refresh_interval
+
+    def _fetch(self):
+        url = urlsplit(self.url)
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+
+        for attempt in range(2):
+            connection = self._get_connection(url)
+            try:
+                connection.request("GET", path)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (OSError, http_client.HTTPException):
+                # The server may have dropped an idle keep-alive connection
+                self._close()
+                if attempt:
+                    raise
+
+        if response.status != 200:
+            raise ValueError(f"Unexpected status {response.status} from jwks")
+
+        return json.loads(body)
+
+    async def _fetch_async(self):
+        url = urlsplit(self.url)
+        path = url.path or "/"
+        if url.query:
+            path = f"{path}?{url.query}"
+        https = url.scheme == "https"
+
+        reader, writer = await asyncio.open_connection(
+            url.hostname, url.port or (443 if https else 80), ssl=https or None
+        )
+        try:
+            # An http/1.0 request is answered without chunking and closed
+            writer.write(
+                f"GET {path} HTTP/1.0\r\nHost: {url.netloc}\r\n\r\n".encode()
+            )
+            response = await reader.read()
+        finally:
+            writer.close()
+
+        head, _, body = response.partition(b"\r\n\r\n")
+        fields = head.split(b" ", 2)
+        status = fields[1].decode("latin-1") if len(fields) > 1 else ""
+
+        if status != "200":
+            raise ValueError(f"Unexpected status {status} from jwks")
+
+        return json.loads(body)
+
+    def _get_connection(self, url):
+        if self._connection is None:
+            if url.scheme == "https":
+                connection_class = http_client.HTTPSConnection
+            else:
+                connection_class = http_client.HTTPConnection
+            self._connection = connection_class(url.netloc, timeout=10)
+
+        return self._connection
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+class TokenCache:
+    """A bounded lru cache of verified access token payloads.
+
+    Entries are keyed by a digest of the token so raw tokens are never kept in
+    memory, and an entry is never returned once its token has expired.
+
+    Attributes:
+        max_size: An int representing the maximum number of cached payloads
+        clock: A callable returning the current unix time in seconds
+        hits: An int representing the number of lookups that were cached
+        misses: An int representing the number of lookups that were not
+        evictions: An int representing the number of payloads dropped to make
+            room for new ones
+        expirations: An int representing the number of payloads dropped
+            because their token expired
+    """
+
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, clock=time.time):
+        """Set-up for TokenCache."""
+        self.max_size = max_size
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._payloads = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, token):
+        """Retrieves the verified payload of the given token.
+
+        Args:
+            token: A str representing the access token
+
+        Returns:
+            payload: A dict representing the decoded and verified access
+                token, or None if it is not cached or has expired
+        """
+        key = self._digest(token)
+
+        with self._lock:
+            payload = self._payloads.get(key)
+
+            if payload is not None and payload["exp"] <= self.clock():
+                del self._payloads[key]
+                self.expirations += 1
+                payload = None
+
+            if payload is None:
+                self.misses += 1
+                return None
+
+            self._payloads.move_to_end(key)
+            self.hits += 1
+
+        return payload
+
+    def put(self, token, payload):
+        """Caches the verified payload of the given token until it expires.
+
+        Args:
+            token: A str representing the access token
+            payload: A dict representing the decoded and verified access token
+        """
+        expires_at = payload.get("exp")
+
+        if self.max_size <= 0 or not isinstance(expires_at, (int, float)):
+            return
+
+        key = self._digest(token)
+
+        with self._lock:
+            self._payloads[key] = payload
+            self._payloads.move_to_end(key)
+
+            while len(self._payloads) > self.max_size:
+                self._payloads.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Drops every cached payload and resets the counters."""
+        with self._lock:
+            self._payloads.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.expirations = 0
+
+    def stats(self):
+        """Reports the size and effectiveness of the cache.
+
+        Returns:
+            stats: A dict of the cache size, capacity and counters
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            stats = {
+                "size": len(self._payloads),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+        return stats
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode()).digest()
+
+
+jwks_cache = JWKSCache(
+    JWKS_URL, snapshot_path=JWKS_SNAPSHOT_PATH, prefetch=JWKS_PREFETCH
+)
+token_cache = TokenCache()
+
+
 def get_token_auth_header():
     """Obtains the access token from the Authorization Header.
 
@@ -86,6 +688,35 @@ def get_token_auth_header():
     return token
 
 
+async def fetch_token_key_async(authorization):
+    """Fetches the key a request's token is signed with, if it isn't cached.
+
+    An event loop can call this before handing the request to a thread, so
+    the thread finds the key cached instead of waiting on Auth0. Malformed
+    headers and failed fetches are left for requires_auth to report.
+
+    Args:
+        authorization: A str representing the request's Authorization header,
+            or None
+    """
+    parts = (authorization or "").split()
+
+    if len(parts) != 2 or parts[0].lower() != "bearer":
+        return
+
+    from jose import jwt  # pylint: disable=import-outside-toplevel
+
+    try:
+        kid = jwt.get_unverified_header(parts[1]).get("kid")
+    except jwt.JWTError:
+        return
+
+    try:
+        await jwks_cache.get_key_async(kid)
+    except (OSError, asyncio.TimeoutError, ValueError):
+        pass
+
+
 def get_token_rsa_key(token):
     """Retrieves the rsa key of the provided access token.
 
@@ -95,8 +726,7 @@ def get_token_rsa_key(token):
     Returns:
         rsa_key: A dict representing the rsa key for the the given token
     """
-    jsonurl = urlopen(f"https://{AUTH0_DOMAIN}/.well-known/jwks.json")
-    jwks = json.loads(jsonurl.read())
+    from jose import jwt  # pylint: disable=import-outside-toplevel
 
     try:
         unverified_header = jwt.get_unverified_header(token)
@@ -122,16 +752,7 @@ def get_token_rsa_key(token):
             401,
         )
 
-    rsa_key = {}
-    for key in jwks["keys"]:
-        if key["kid"] == unverified_header["kid"]:
-            rsa_key = {
-                "kty": key["kty"],
-                "kid": key["kid"],
-                "use": key["use"],
-                "n": key["n"],
-                "e": key["e"],
-            }
+    rsa_key = jwks_cache.get_key(unverified_header.get("kid"))
 
     if not rsa_key:
         raise AuthError(
@@ -155,6 +776,8 @@ def verify_decode_jwt(token, rsa_key):
     Returns:
         payload: A dict representing the decoded and verified access token
     """
+    from jose import jwt  # pylint: disable=import-outside-toplevel
+
     try:
         payload = jwt.decode(
             token,
@@ -237,10 +860,20 @@ def requires_auth(permission=""):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            rsa_key = get_token_rsa_key(token)
-            payload = verify_decode_jwt(token, rsa_key)
-            check_permissions(permission, payload)
+            with timing.phase("auth-header"):
+                token = get_token_auth_header()
+                payload = token_cache.get(token)
+
+            if payload is None:
+                with timing.phase("auth-key"):
+                    rsa_key = get_token_rsa_key(token)
+                with timing.phase("auth-decode"):
+                    payload = verify_decode_jwt(token, rsa_key)
+                    token_cache.put(token, payload)
+
+            with timing.phase("auth-permissions"):
+                check_permissions(permission, payload)
+
             return f(*args, **kwargs)
 
         return wrapper
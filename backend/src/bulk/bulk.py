@@ -0,0 +1,351 @@
+"""Logic for importing many drinks from a single streamed request body.
+
+The body is parsed incrementally, either as a json array or as newline
+delimited json, and drinks are written in batches so memory use stays bounded
+no matter how large the body is.
+
+Attributes:
+    CHUNK_SIZE: An int representing the number of bytes read from the body
+        at a time
+    MAX_ITEM_SIZE: An int representing the largest number of characters a
+        single drink may take up in the body
+    BATCH_SIZE: An int representing the number of drinks inserted per
+        transaction
+    MAX_TEXT_LENGTH: An int representing the most characters a title,
+        ingredient name or color may have, the size of their columns
+"""
+
+import codecs
+import json
+
+from sqlalchemy import func
+
+from src.database.models import (
+    Drink,
+    Ingredient,
+    MenuVersion,
+    commit_session,
+    db,
+    refresh_documents,
+    reindex_drinks,
+)
+
+CHUNK_SIZE = 64 * 1024
+MAX_ITEM_SIZE = 1024 * 1024
+BATCH_SIZE = 1000
+MAX_TEXT_LENGTH = 80
+
+_WHITESPACE = " \t\n\r"
+
+
+def iter_text(stream, chunk_size=CHUNK_SIZE):
+    """Reads a binary stream as utf-8 text a chunk at a time.
+
+    Args:
+        stream: A file-like object to read bytes from
+        chunk_size: An int representing the number of bytes read at a time
+
+    Yields:
+        text: A str representing the next decoded chunk
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    while True:
+        chunk = stream.read(chunk_size)
+        text = decoder.decode(chunk, final=not chunk)
+
+        if text:
+            yield text
+        if not chunk:
+            return
+
+
+class _JSONArrayReader:
+    """Reads the items of a json array from a stream as they arrive."""
+
+    def __init__(self, stream, chunk_size):
+        """Set-up for _JSONArrayReader."""
+        self._chunks = iter_text(stream, chunk_size)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._eof = False
+
+    def __iter__(self):
+        """Yields each item of the array."""
+        if self._peek() != "[":
+            raise ValueError("Expected a json array")
+        self._position += 1
+
+        if self._peek() == "]":
+            self._position += 1
+        else:
+            yield self._decode()
+            while self._read_separator() == ",":
+                yield self._decode()
+
+        if self._peek():
+            raise ValueError("Unexpected data after json array")
+
+    def _read_separator(self):
+        char = self._peek()
+        self._position += 1
+
+        if not char:
+            raise ValueError("Unexpected end of json array")
+        if char not in ",]":
+            raise ValueError(f"Expected ',' or ']' but found {char!r}")
+
+        return char
+
+    def _fill(self):
+        chunk = next(self._chunks, None)
+
+        if chunk is None:
+            self._eof = True
+            return False
+        if len(self._buffer) - self._position > MAX_ITEM_SIZE:
+            raise ValueError("Array item is too large")
+
+        self._buffer = self._buffer[self._position :] + chunk
+        self._position = 0
+
+        return True
+
+    def _peek(self):
+        while True:
+            while (
+                self._position < len(self._buffer)
+                and self._buffer[self._position] in _WHITESPACE
+            ):
+                self._position += 1
+
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._fill():
+                return ""
+
+    def _decode(self):
+        if not self._peek():
+            raise ValueError("Unexpected end of json array")
+
+        while True:
+            try:
+                item, end = self._decoder.raw_decode(
+                    self._buffer, self._position
+                )
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+            else:
+                # A value running to the end of the buffer may be truncated
+                if end < len(self._buffer) or self._eof:
+                    self._position = end
+                    return item
+
+            self._fill()
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE):
+    """Parses the items of a json array from a stream one at a time.
+
+    Args:
+        stream: A file-like object containing a json array
+        chunk_size: An int representing the number of bytes read at a time
+
+    Yields:
+        item: The next decoded item of the array
+
+    Raises:
+        ValueError: The stream is not a well-formed json array
+    """
+    yield from _JSONArrayReader(stream, chunk_size)
+
+
+def iter_ndjson(stream, chunk_size=CHUNK_SIZE):
+    """Parses newline delimited json from a stream one line at a time.
+
+    Args:
+        stream: A file-like object containing one json value per line
+        chunk_size: An int representing the number of bytes read at a time
+
+    Yields:
+        item: The decoded value of the next non-blank line
+
+    Raises:
+        ValueError: A line is not well-formed json
+    """
+    buffer = ""
+
+    for chunk in iter_text(stream, chunk_size):
+        buffer += chunk
+        *lines, buffer = buffer.split("\n")
+
+        if len(buffer) > MAX_ITEM_SIZE:
+            raise ValueError("Line is too large")
+
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+def validate_drink(item):
+    """Checks that an item describes a drink that can be created.
+
+    Args:
+        item: The decoded item to check
+
+    Returns:
+        description: A str describing what is wrong with the item, or None if
+            it is a valid drink
+    """
+    if not isinstance(item, dict):
+        return "Drink must be an object"
+
+    title = item.get("title")
+
+    if not isinstance(title, str):
+        return "Drink must have a title"
+    if len(title) > MAX_TEXT_LENGTH:
+        return f"Title must be at most {MAX_TEXT_LENGTH} characters"
+
+    recipe = item.get("recipe")
+
+    if not isinstance(recipe, list) or not all(
+        isinstance(ingredient, dict) for ingredient in recipe
+    ):
+        return "Drink must have a recipe made of ingredient objects"
+
+    for ingredient in recipe:
+        description = validate_ingredient(ingredient)
+        if description is not None:
+            return description
+
+    return None
+
+
+def validate_ingredient(ingredient):
+    """Checks that an ingredient object can be stored.
+
+    Args:
+        ingredient: A dict representing the ingredient to check
+
+    Returns:
+        description: A str describing what is wrong with the ingredient, or
+            None if it is valid
+    """
+    for field in ("name", "color"):
+        value = ingredient.get(field)
+        if value is not None and not isinstance(value, str):
+            return f"Ingredient {field} must be a string"
+        if value is not None and len(value) > MAX_TEXT_LENGTH:
+            return (
+                f"Ingredient {field} must be at most {MAX_TEXT_LENGTH} "
+                "characters"
+            )
+
+    parts = ingredient.get("parts")
+
+    if not isinstance(parts, int) or isinstance(parts, bool):
+        return "Ingredient parts must be an integer"
+
+    return None
+
+
+def insert_batch(batch):
+    """Inserts a batch of drinks and their recipes in one transaction.
+
+    The menu version is bumped first, which takes the db write lock, so the
+    ids handed out after the current largest id can't be claimed by a
+    concurrent writer before the batch is committed.
+
+    Args:
+        batch: A list of tuples of the index and the item of each drink
+
+    Returns:
+        created: A list of dicts mapping each index to the created drink id
+    """
+    MenuVersion.bump(db.session)
+    first_id = (db.session.query(func.max(Drink.id)).scalar() or 0) + 1
+    drinks = []
+    ingredients = []
+    created = []
+
+    for drink_id, (index, item) in enumerate(batch, first_id):
+        drinks.append({"id": drink_id, "title": item["title"]})
+        ingredients.extend(
+            {
+                "name": ingredient.get("name"),
+                "parts": ingredient.get("parts"),
+                "color": ingredient.get("color"),
+                "drink_id": drink_id,
+            }
+            for ingredient in item["recipe"]
+        )
+        created.append({"index": index, "drink_id": drink_id})
+
+    db.session.execute(Drink.__table__.insert(), drinks)
+    if ingredients:
+        db.session.execute(Ingredient.__table__.insert(), ingredients)
+    drink_ids = [item["drink_id"] for item in created]
+    reindex_drinks(db.session, drink_ids)
+    refresh_documents(db.session, drink_ids)
+    commit_session()
+
+    return created
+
+
+def import_drinks(items, batch_size=BATCH_SIZE):
+    """Creates a drink for every valid item, a batch at a time.
+
+    Batches are committed as they fill up, so drinks before a malformed part
+    of the body stay created.
+
+    Args:
+        items: An iterable of the decoded items to import
+        batch_size: An int representing the number of drinks per transaction
+
+    Returns:
+        created: A list of dicts mapping item indexes to created drink ids
+        errors: A list of dicts describing the items that were not created
+
+    Raises:
+        ValueError: The body could not be parsed up to its first item
+    """
+    created = []
+    errors = []
+    batch = []
+    index = 0
+    items = iter(items)
+
+    while True:
+        try:
+            item = next(items)
+        except StopIteration:
+            break
+        except ValueError as error:
+            if index == 0:
+                raise
+            errors.append({"index": index, "description": str(error)})
+            break
+
+        description = validate_drink(item)
+
+        if description is None:
+            batch.append((index, item))
+        else:
+            errors.append({"index": index, "description": description})
+
+        if len(batch) >= batch_size:
+            created.extend(insert_batch(batch))
+            batch = []
+
+        index += 1
+
+    if batch:
+        created.extend(insert_batch(batch))
+
+    return created, errors
@@ -0,0 +1,91 @@
+"""An in-process cache of serialized response bodies.
+
+Classes:
+    CachedBody()
+    ResponseCache()
+"""
+
+import hashlib
+import threading
+
+
+class CachedBody:
+    """A serialized response body and the version of the data it was built at.
+
+    Attributes:
+        version: An int representing the data version the body was built at
+        body: A bytes object representing the serialized response body
+        etag: A str representing a strong entity tag for the body
+        compressed_variants: A dict mapping encodings to the body compressed
+            with them, filled in as they are requested
+    """
+
+    __slots__ = ("version", "body", "etag", "compressed_variants")
+
+    def __init__(self, version, body):
+        """Set-up for CachedBody."""
+        self.version = version
+        self.body = body
+        self.etag = hashlib.sha256(body).hexdigest()
+        self.compressed_variants = {}
+
+
+class ResponseCache:
+    """Caches serialized response bodies until the data version changes.
+
+    Attributes:
+        hits: An int representing the number of lookups that were cached
+        misses: An int representing the number of lookups that were not
+    """
+
+    def __init__(self):
+        """Set-up for ResponseCache."""
+        self.hits = 0
+        self.misses = 0
+        self._bodies = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """Retrieves a cached body if it was built at the given version.
+
+        Args:
+            key: A hashable representing the cached response
+            version: An int representing the current data version
+
+        Returns:
+            cached_body: A CachedBody, or None if there is no body cached for
+                the current version
+        """
+        cached_body = self._bodies.get(key)
+
+        with self._lock:
+            if cached_body is None or cached_body.version != version:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+
+        return cached_body
+
+    def put(self, key, version, body):
+        """Caches a body built at the given version.
+
+        Args:
+            key: A hashable representing the cached response
+            version: An int representing the data version the body was built at
+            body: A bytes object representing the serialized response body
+
+        Returns:
+            cached_body: The CachedBody that was stored
+        """
+        cached_body = CachedBody(version, body)
+        self._bodies[key] = cached_body
+
+        return cached_body
+
+    def clear(self):
+        """Drops every cached body and resets the counters."""
+        with self._lock:
+            self._bodies.clear()
+            self.hits = 0
+            self.misses = 0
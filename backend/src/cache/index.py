@@ -0,0 +1,144 @@
+"""An in-process inverted index from ingredient names to drinks.
+
+Classes:
+    IngredientIndex()
+"""
+
+import threading
+
+
+def normalize_ingredient(name):
+    """Normalizes an ingredient name so spelling variants index together.
+
+    Args:
+        name: A str representing the ingredient name, or None
+
+    Returns:
+        name: A str representing the casefolded name with its whitespace
+            collapsed
+    """
+    return " ".join((name or "").split()).casefold()
+
+
+class IngredientIndex:
+    """Maps normalized ingredient names to the ids of the drinks using them.
+
+    The index is stamped with the data version it was built at. Writes made
+    in this process are applied as they commit; any other change to the
+    version means the index has to be loaded again.
+
+    Attributes:
+        version: A hashable representing the data version the index matches,
+            or None if it has to be loaded
+    """
+
+    def __init__(self):
+        """Set-up for IngredientIndex."""
+        self.version = None
+        self._drinks = {}
+        self._recipes = {}
+        self._lock = threading.Lock()
+
+    def load(self, version, rows):
+        """Replaces the index with the given recipes.
+
+        Args:
+            version: A hashable representing the data version of the rows
+            rows: An iterable of tuples of a drink id and an ingredient name,
+                with a name of None for drinks without ingredients
+        """
+        drinks = {}
+        recipes = {}
+
+        for drink_id, name in rows:
+            recipe = recipes.setdefault(drink_id, set())
+            if name is not None:
+                name = normalize_ingredient(name)
+                recipe.add(name)
+                drinks.setdefault(name, set()).add(drink_id)
+
+        with self._lock:
+            self._drinks = drinks
+            self._recipes = recipes
+            self.version = version
+
+    def update(self, from_version, to_version, recipes):
+        """Applies the recipes changed between two data versions.
+
+        Args:
+            from_version: A hashable representing the version the changes
+                were made on top of
+            to_version: A hashable representing the version they produced
+            recipes: A dict mapping each changed drink id to a list of its
+                ingredient names, or to None if the drink was deleted
+
+        Returns:
+            updated: A bool representing whether the changes were applied,
+                the index is marked for loading again otherwise
+        """
+        with self._lock:
+            if self.version is None or self.version != from_version:
+                self.version = None
+                return False
+
+            for drink_id, names in recipes.items():
+                for name in self._recipes.pop(drink_id, ()):
+                    drink_ids = self._drinks[name]
+                    drink_ids.discard(drink_id)
+                    if not drink_ids:
+                        del self._drinks[name]
+
+                if names is None:
+                    continue
+
+                recipe = {normalize_ingredient(name) for name in names}
+                self._recipes[drink_id] = recipe
+                for name in recipe:
+                    self._drinks.setdefault(name, set()).add(drink_id)
+
+            self.version = to_version
+
+        return True
+
+    def find(self, include=(), exclude=()):
+        """Finds the drinks matching every include group and no exclusion.
+
+        Args:
+            include: An iterable of groups of ingredient names, a drink has to
+                use at least one ingredient from every group
+            exclude: An iterable of ingredient names a drink must not use
+
+        Returns:
+            drink_ids: A sorted list of ints representing the matching drinks
+        """
+        with self._lock:
+            drink_ids = None
+
+            for group in include:
+                matches = set().union(
+                    *(
+                        self._drinks.get(normalize_ingredient(name), ())
+                        for name in group
+                    )
+                )
+                if drink_ids is None:
+                    drink_ids = matches
+                else:
+                    drink_ids &= matches
+
+            if drink_ids is None:
+                drink_ids = set(self._recipes)
+
+            for name in exclude:
+                drink_ids -= self._drinks.get(
+                    normalize_ingredient(name), set()
+                )
+
+        return sorted(drink_ids)
+
+    def clear(self):
+        """Empties the index so it is loaded again on next use."""
+        with self._lock:
+            self._drinks = {}
+            self._recipes = {}
+            self.version = None
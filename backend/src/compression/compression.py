@@ -0,0 +1,136 @@
+"""Compression of response bodies negotiated with Accept-Encoding.
+
+Responses are compressed with brotli, when it is installed, or gzip if the
+client accepts it and the body is large enough to be worth it. Bodies served
+from a cache can keep their compressed variants so each is only built once.
+
+Attributes:
+    COMPRESSION_MIN_SIZE: An int representing the smallest body in bytes that
+        is compressed
+    GZIP_LEVEL: An int representing the gzip compression level
+    BROTLI_QUALITY: An int representing the brotli compression quality
+    COMPRESSIBLE_MIMETYPES: A tuple of the mimetypes that are compressed
+    ENCODINGS: A tuple of the supported encodings in order of preference
+"""
+
+import gzip
+import os
+
+from flask import request
+
+from src.timing import timing
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+COMPRESSIBLE_MIMETYPES = ("application/json", "text/plain")
+ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+
+def negotiate(accept_encodings):
+    """Picks the encoding to compress a response with.
+
+    Args:
+        accept_encodings: A werkzeug Accept of the encodings the client
+            accepts
+
+    Returns:
+        encoding: A str representing the preferred supported encoding the
+            client accepts, or None if it accepts none of them
+    """
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(body, encoding):
+    """Compresses a body.
+
+    Args:
+        body: A bytes object representing the body to compress
+        encoding: A str representing the encoding, one of ENCODINGS
+
+    Returns:
+        body: A bytes object representing the compressed body
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compressed_body(body, encoding, variants=None):
+    """Compresses a body, reusing a variant compressed before.
+
+    Args:
+        body: A bytes object representing the body to compress
+        encoding: A str representing the encoding, one of ENCODINGS
+        variants: A dict mapping encodings to the body compressed with them,
+            filled in as variants are built, or None to not keep them
+
+    Returns:
+        body: A bytes object representing the compressed body
+    """
+    if variants is None:
+        return compress(body, encoding)
+
+    compressed = variants.get(encoding)
+
+    if compressed is None:
+        compressed = compress(body, encoding)
+        variants[encoding] = compressed
+
+    return compressed
+
+
+def init_app(app):
+    """Registers the request hook compressing responses.
+
+    Args:
+        app: The flask app whose responses are compressed
+    """
+    app.after_request(_compress_response)
+
+
+def _compress_response(response):
+    if (
+        response.mimetype not in COMPRESSIBLE_MIMETYPES
+        or response.direct_passthrough
+        or response.is_streamed
+    ):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    if (
+        response.status_code != 200
+        or "Content-Encoding" in response.headers
+        or response.content_length is None
+        or response.content_length < COMPRESSION_MIN_SIZE
+    ):
+        return response
+
+    encoding = negotiate(request.accept_encodings)
+
+    if encoding is None:
+        return response
+
+    with timing.phase("compress"):
+        body = compressed_body(
+            response.get_data(),
+            encoding,
+            getattr(response, "compressed_variants", None),
+        )
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+
+    if etag is not None:
+        response.set_etag(f"{etag}-{encoding}", weak)
+        response.make_conditional(request)
+
+    return response
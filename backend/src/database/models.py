@@ -3,39 +3,796 @@
 Attributes:
     DB_NAME: A str representing the db in which to connect to
     DB_PATH: A str representing the location of the db
+    DB_POOL_SIZE: An int representing the number of pooled connections kept
+        open per process, or 0 to open a new connection for every session
+    DB_MAX_OVERFLOW: An int representing the number of connections that may
+        be opened beyond the pool size under load
+    DB_POOL_TIMEOUT: A float representing the number of seconds to wait for a
+        pooled connection before giving up
+    SQLITE_PRAGMAS: A dict of the pragmas applied to every new sqlite
+        connection
+    REPLICA_BIND: A str naming the bind of the read-only replica of the db
+    REPLICA_DB_PATH: A str representing the location of the replica, or None
+        to read everything from the db
+    REPLICA_PRAGMAS: A dict of the pragmas applied on top of SQLITE_PRAGMAS
+        to every new connection to the replica
+    SEARCH_TABLE: A str representing the name of the fts5 table indexing
+        drink titles and ingredient names
+    ORPHAN_BATCH_SIZE: An int representing the number of orphaned
+        ingredients deleted per transaction when purging them
+    INGREDIENT_FIELDS: A tuple of the ingredient fields a recipe sets
     db: A SQLAlchemy service
+    ingredient_index: An IngredientIndex of the drinks using each ingredient
 
 Classes:
     Drink()
     Ingredient()
+    DrinkDocument()
+    MenuVersion()
 """
 
+import json
 import os
+import sqlite3
+import threading
+import weakref
+from itertools import chain
 
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.orm import relationship
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import (
+    Column,
+    ForeignKey,
+    Integer,
+    String,
+    Text,
+    bindparam,
+    event,
+    inspect,
+    select,
+    text,
+)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import TextClause, UpdateBase
+
+from src.cache.index import IngredientIndex
 
 DB_NAME = "database.db"
 PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = f"sqlite:///{os.path.join(PROJECT_DIR, DB_NAME)}"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-20000")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "foreign_keys": "ON",
+}
+REPLICA_BIND = "replica"
+REPLICA_DB_PATH = os.getenv("REPLICA_DB_PATH")
+REPLICA_PRAGMAS = {"query_only": "ON"}
+SEARCH_TABLE = "drinks_fts"
+ORPHAN_BATCH_SIZE = 1000
+INGREDIENT_FIELDS = ("name", "parts", "color")
+
+
+class _RoutingSession(SignallingSession):
+    """A session reading from the replica in requests whose view allows it.
+
+    Writes always go to the db. Once the session has written, it reads from
+    the db too, so a request sees its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        """Picks the engine a statement is run against.
+
+        Args:
+            mapper: The mapper of the model the statement is for, or None
+            clause: The statement to run, or None
+
+        Returns:
+            engine: A sqlalchemy Engine
+        """
+        if self._flushing or isinstance(clause, (UpdateBase, TextClause)):
+            self.info["wrote"] = True
+
+        if not self.info.get("wrote") and _reads_from_replica(self.app):
+            return db.get_engine(self.app, bind=REPLICA_BIND)
+
+        return super().get_bind(mapper, clause)
+
+
+def _reads_from_replica(app):
+    if REPLICA_BIND not in (app.config.get("SQLALCHEMY_BINDS") or ()):
+        return False
+
+    if not has_request_context():
+        return False
+
+    view = app.view_functions.get(request.endpoint)
+
+    return getattr(view, "reads_from_replica", False)
+
+
+class _SQLAlchemy(SQLAlchemy):
+    """A SQLAlchemy service applying pragmas and routing reads to replicas."""
+
+    def create_engine(self, sa_url, engine_opts):
+        """Creates an engine, hooking pragmas into each new connection.
+
+        Args:
+            sa_url: A sqlalchemy URL representing the db to connect to
+            engine_opts: A dict of options for sqlalchemy.create_engine,
+                optionally with the pragmas to apply under 'sqlite_pragmas'
+                and the pragmas of specific dbs, by url, under
+                'sqlite_bind_pragmas'
+
+        Returns:
+            engine: A sqlalchemy Engine
+        """
+        pragmas = engine_opts.pop("sqlite_pragmas", None)
+        bind_pragmas = engine_opts.pop("sqlite_bind_pragmas", {})
+        pragmas = bind_pragmas.get(str(sa_url), pragmas)
+        engine = super().create_engine(sa_url, engine_opts)
+        _engines.add(engine)
+
+        if pragmas and engine.dialect.name == "sqlite":
+
+            @event.listens_for(engine, "connect")
+            def apply_pragmas(
+                dbapi_connection, connection_record
+            ):  # pylint: disable=unused-argument
+                cursor = dbapi_connection.cursor()
+                for name, value in pragmas.items():
+                    if value is not None:
+                        cursor.execute(f"PRAGMA {name} = {value}")
+                cursor.close()
+
+        return engine
+
+    def create_session(self, options):
+        """Creates the factory of the sessions that route reads.
+
+        Args:
+            options: A dict of keyword arguments for the sessions
+
+        Returns:
+            factory: A sessionmaker of _RoutingSession
+        """
+        return sessionmaker(class_=_RoutingSession, db=self, **options)
+
+
+_engines = weakref.WeakSet()
+_inherited_pools = []
+db = _SQLAlchemy()
+ingredient_index = IngredientIndex()
+_migrated_dbs = set()
+_migrate_lock = threading.Lock()
+_searchable_dbs = set()
+
+
+def _replace_pools_after_fork():
+    # Closing a sqlite connection the parent opened could disturb the parent,
+    # so the child keeps the inherited connections open but never uses them
+    for engine in list(_engines):
+        _inherited_pools.append(engine.pool)
+        engine.pool = engine.pool.recreate()
+
+
+os.register_at_fork(after_in_child=_replace_pools_after_fork)
+
+
+def get_engine_options(db_path, engine_options=None, pragmas=None):
+    """Builds the engine options used to connect to the given db.
+
+    File-based sqlite dbs get a pool of DB_POOL_SIZE connections that may be
+    shared between threads unless another poolclass is given, and every
+    sqlite connection gets SQLITE_PRAGMAS.
+
+    Args:
+        db_path: A str representing the location of the db
+        engine_options: A dict of options for sqlalchemy.create_engine that
+            override the defaults
+        pragmas: A dict of sqlite pragmas that override SQLITE_PRAGMAS, with
+            None values skipping a pragma
+
+    Returns:
+        options: A dict of engine options
+    """
+    options = {}
+    url = make_url(db_path)
+    is_file_db = url.database not in (None, "", ":memory:")
+
+    if url.drivername.startswith("sqlite"):
+        options["sqlite_pragmas"] = dict(SQLITE_PRAGMAS, **(pragmas or {}))
+
+        custom_pool = "poolclass" in (engine_options or {})
 
-db = SQLAlchemy()
+        if is_file_db and DB_POOL_SIZE > 0 and not custom_pool:
+            options.update(
+                poolclass=QueuePool,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT,
+                connect_args={"check_same_thread": False},
+            )
 
+    options.update(engine_options or {})
 
-def setup_db(app, db_path=DB_PATH):
+    return options
+
+
+def init_db(
+    app,
+    db_path=DB_PATH,
+    engine_options=None,
+    pragmas=None,
+    replica_path=REPLICA_DB_PATH,
+):
     """Binds a flask application and a SQLAlchemy service.
 
+    The engine is created the first time the app uses the db, and the db is
+    migrated before the first request made against it. Outside of requests
+    and commands, the db is used within the app's context.
+
+    With a replica, the requests to views marked with reads_from_replica
+    read from it until they write, and everything else uses the db. The
+    replica is kept up to date with copy_to_replica.
+
     Args:
         app: A flask app
         db_path: A str representing the location of the db (default: global
             DB_PATH)
+        engine_options: A dict of options for sqlalchemy.create_engine that
+            override the defaults (default: None)
+        pragmas: A dict of sqlite pragmas that override SQLITE_PRAGMAS
+            (default: None)
+        replica_path: A str representing the location of a read-only
+            replica of the db, or None (default: global REPLICA_DB_PATH)
     """
+    options = get_engine_options(db_path, engine_options, pragmas)
+
+    if replica_path and "sqlite_pragmas" in options:
+        options["sqlite_bind_pragmas"] = {
+            str(make_url(replica_path)): dict(
+                options["sqlite_pragmas"], **REPLICA_PRAGMAS
+            )
+        }
+
     app.config["SQLALCHEMY_DATABASE_URI"] = db_path
+    app.config["SQLALCHEMY_BINDS"] = (
+        {REPLICA_BIND: replica_path} if replica_path else None
+    )
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-    db.app = app
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
     db.init_app(app)
 
+    if migrate_db_once not in app.before_request_funcs.get(None, []):
+        app.before_request(migrate_db_once)
+
+
+def setup_db(
+    app,
+    db_path=DB_PATH,
+    engine_options=None,
+    pragmas=None,
+    replica_path=REPLICA_DB_PATH,
+):
+    """Binds a flask application and a SQLAlchemy service for scripts.
+
+    Like init_db, but the app is also used whenever the db is used outside
+    of any app's context. Only one app can be bound this way at a time.
+
+    Args:
+        app: A flask app
+        db_path: A str representing the location of the db (default: global
+            DB_PATH)
+        engine_options: A dict of options for sqlalchemy.create_engine that
+            override the defaults (default: None)
+        pragmas: A dict of sqlite pragmas that override SQLITE_PRAGMAS
+            (default: None)
+        replica_path: A str representing the location of a read-only
+            replica of the db, or None (default: global REPLICA_DB_PATH)
+    """
+    init_db(app, db_path, engine_options, pragmas, replica_path)
+    db.app = app
+
+
+def reads_from_replica(view):
+    """Marks a view whose requests may read from the replica.
+
+    Args:
+        view: A view function that doesn't need to see writes made by other
+            requests until they are copied to the replica
+
+    Returns:
+        view: The view function, marked
+    """
+    view.reads_from_replica = True
+
+    return view
+
+
+def copy_to_replica():
+    """Copies the db over the replica with sqlite's online backup.
+
+    The db is migrated first, so the replica has every table the views
+    reading it need. Readers of the replica, in this process or any other,
+    keep seeing the old copy until the new one is complete.
+
+    Raises:
+        RuntimeError: No replica is bound to the app
+    """
+    if REPLICA_BIND not in (db.get_app().config.get("SQLALCHEMY_BINDS") or ()):
+        raise RuntimeError("no replica is bound to the app")
+
+    migrate_db_once()
+    replica = db.get_engine(bind=REPLICA_BIND)
+    source = db.engine.raw_connection()
+
+    try:
+        target = sqlite3.connect(
+            replica.url.database, timeout=SQLITE_PRAGMAS["busy_timeout"] / 1000
+        )
+        try:
+            source.connection.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+_SEARCH_DOCUMENTS = (
+    "SELECT drinks.id, drinks.title, COALESCE(("
+    "SELECT group_concat(ingredients.name, ' ') FROM ingredients "
+    "WHERE ingredients.drink_id = drinks.id), '') FROM drinks"
+)
+
+
+def migrate_db():
+    """Creates any missing tables, indexes and rows the models rely on.
+
+    Safe to run any number of times against new or existing dbs. Everything
+    is checked and created in one transaction on the db, which takes
+    sqlite's write lock up front, so workers migrating the same db at once
+    wait for each other and the later ones find nothing left to do.
+    """
+    with db.engine.connect() as connection, connection.begin():
+        if connection.dialect.name == "sqlite":
+            connection.execute("BEGIN IMMEDIATE")
+
+        tables = set(inspect(connection).get_table_names())
+        db.Model.metadata.create_all(connection)
+        inspector = inspect(connection)
+
+        for table in db.Model.metadata.sorted_tables:
+            existing = {
+                index["name"] for index in inspector.get_indexes(table.name)
+            }
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(connection)
+
+        if connection.dialect.name == "sqlite" and SEARCH_TABLE not in tables:
+            connection.execute(
+                f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+                "title, ingredients, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+            )
+            fill_search_index(connection)
+
+        if DrinkDocument.__tablename__ not in tables:
+            fill_documents(connection)
+
+        menu_version = MenuVersion.__table__
+        exists = connection.execute(
+            select([menu_version.c.id]).where(menu_version.c.id == 1)
+        ).scalar()
+        if exists is None:
+            connection.execute(menu_version.insert().values(id=1, version=0))
+
+
+def has_search_table(session=None):
+    """Checks whether the bound db has the full-text search table.
+
+    Args:
+        session: The session to check through (default: db.session)
+
+    Returns:
+        searchable: A bool representing whether the search table exists
+    """
+    session = session or db.session
+    db_url = str(session.get_bind().url)
+
+    if db_url not in _searchable_dbs:
+        if session.get_bind().dialect.name != "sqlite":
+            return False
+
+        exists = session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name = :name"),
+            {"name": SEARCH_TABLE},
+        ).scalar()
+        if not exists:
+            return False
+        _searchable_dbs.add(db_url)
+
+    return True
+
+
+def rebuild_search_index():
+    """Reindexes every drink, including ones inserted around the models.
+
+    The menu version is bumped in the same transaction, so cached menus and
+    the ingredient index are rebuilt from the drinks as they are now.
+    """
+    if not has_search_table():
+        return
+
+    fill_search_index(db.session)
+    MenuVersion.bump(db.session)
+    commit_session()
+
+
+def fill_search_index(session):
+    """Replaces the full-text search entries with those of every drink.
+
+    Args:
+        session: The session or connection to run the statements on
+    """
+    session.execute(f"DELETE FROM {SEARCH_TABLE}")
+    session.execute(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, title, ingredients) "
+        f"{_SEARCH_DOCUMENTS}"
+    )
+
+
+def reindex_drinks(session, drink_ids):
+    """Rebuilds the full-text search entries of the given drinks.
+
+    Runs within the session's transaction so the search table can't drift
+    from the drinks it indexes.
+
+    Args:
+        session: The session that changed the drinks
+        drink_ids: An iterable of ints representing the drinks to reindex
+    """
+    if not has_search_table(session):
+        return
+
+    drink_ids = list(drink_ids)
+    delete = text(
+        f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+    insert = text(
+        f"INSERT INTO {SEARCH_TABLE} (rowid, title, ingredients) "
+        f"{_SEARCH_DOCUMENTS} WHERE drinks.id IN :ids"
+    ).bindparams(bindparam("ids", expanding=True))
+
+    for start in range(0, len(drink_ids), 500):
+        params = {"ids": drink_ids[start : start + 500]}
+        session.execute(delete, params)
+        session.execute(insert, params)
+
+
+def recipe_rows(drinks):
+    """Selects drinks joined to their recipes in the order they're formatted.
+
+    Args:
+        drinks: A table or alias of the drinks to select, with id and title
+            columns
+
+    Returns:
+        query: A select of tuples of a drink id and title and an ingredient
+            id, name, parts and color, ordered by drink and then ingredient
+            id, with None ingredient fields for drinks without ingredients
+    """
+    ingredients = Ingredient.__table__
+    query = (
+        select(
+            [
+                drinks.c.id,
+                drinks.c.title,
+                ingredients.c.id,
+                ingredients.c.name,
+                ingredients.c.parts,
+                ingredients.c.color,
+            ]
+        )
+        .select_from(
+            drinks.outerjoin(
+                ingredients, ingredients.c.drink_id == drinks.c.id
+            )
+        )
+        .order_by(drinks.c.id, ingredients.c.id)
+    )
+
+    return query
+
+
+def format_drinks(rows, format_name):
+    """Groups rows of drinks and ingredients into formatted drinks.
+
+    Builds the same dicts as Drink.short_format and Drink.long_format in a
+    single pass, without creating any objects for the rows.
+
+    Args:
+        rows: An iterable of tuples selected by recipe_rows
+        format_name: A str naming the format, short_format or long_format
+
+    Returns:
+        drinks: A list of tuples of a drink id and the formatted drink
+    """
+    long_format = format_name == "long_format"
+    drinks = []
+    last_id = None
+    recipe = None
+
+    for drink_id, title, ingredient_id, name, parts, color in rows:
+        if drink_id != last_id:
+            recipe = []
+            drinks.append(
+                (drink_id, {"id": drink_id, "title": title, "recipe": recipe})
+            )
+            last_id = drink_id
+        if ingredient_id is None:
+            continue
+        if long_format:
+            recipe.append({"name": name, "parts": parts, "color": color})
+        else:
+            recipe.append({"parts": parts, "color": color})
+
+    return drinks
+
+
+def build_documents(rows):
+    """Formats drinks as the documents stored for them.
+
+    The documents are the drinks' short and long formats as compact json
+    with sorted keys, which is how jsonify writes them by default.
+
+    Args:
+        rows: An iterable of tuples selected by recipe_rows
+
+    Returns:
+        documents: A list of dicts representing the drink_documents rows
+    """
+    rows = list(rows)
+    documents = [
+        {
+            "drink_id": drink_id,
+            "short_format": _dump_document(short),
+            "long_format": _dump_document(long),
+        }
+        for (drink_id, short), (_, long) in zip(
+            format_drinks(rows, "short_format"),
+            format_drinks(rows, "long_format"),
+        )
+    ]
+
+    return documents
+
+
+def _dump_document(document):
+    return json.dumps(document, separators=(",", ":"), sort_keys=True)
+
+
+def refresh_documents(session, drink_ids):
+    """Rebuilds the stored documents of the given drinks.
+
+    Runs within the session's transaction so the documents can't drift from
+    the drinks they were built from.
+
+    Args:
+        session: The session that changed the drinks, or a connection
+        drink_ids: An iterable of ints representing the drinks to refresh
+    """
+    drink_ids = list(drink_ids)
+    table = DrinkDocument.__table__
+    query = recipe_rows(Drink.__table__)
+
+    for start in range(0, len(drink_ids), 500):
+        chunk = drink_ids[start : start + 500]
+        session.execute(table.delete().where(table.c.drink_id.in_(chunk)))
+        documents = build_documents(
+            session.execute(query.where(Drink.id.in_(chunk)))
+        )
+        if documents:
+            session.execute(table.insert(), documents)
+
+
+def rebuild_documents():
+    """Rebuilds every stored document from the drinks they were built from.
+
+    Recovers from drift, such as drinks inserted around the models. The menu
+    version is bumped in the same transaction, so no cached menu outlives the
+    documents it was served from.
+
+    Returns:
+        drinks: An int representing the number of documents built
+    """
+    built = fill_documents(db.session)
+    MenuVersion.bump(db.session)
+    commit_session()
+
+    return built
+
+
+def fill_documents(session):
+    """Replaces the stored documents with those of every drink.
+
+    Args:
+        session: The session or connection to run the statements on
+
+    Returns:
+        drinks: An int representing the number of documents built
+    """
+    session.execute(DrinkDocument.__table__.delete())
+    drink_ids = [row[0] for row in session.execute(select([Drink.id]))]
+    refresh_documents(session, drink_ids)
+
+    return len(drink_ids)
+
+
+def match_ingredients(ingredients, recipe):
+    """Matches a recipe's ingredients to the fewest writes that apply it.
+
+    Ingredients are listed in id order and new ones get the highest ids, so
+    the start of the recipe is matched, in order, to a subsequence of the
+    ingredients and the rest of it is inserted. Of the matchings that write
+    the fewest rows, the one renaming the fewest ingredients is picked, so
+    ingredients keep their ids when others are removed around them.
+
+    Args:
+        ingredients: A list of the Ingredients of the recipe in id order
+        recipe: A list of dicts representing the ingredients of the new
+            recipe in long format
+
+    Returns:
+        matches: A list of tuples of an Ingredient and the dict it is to be
+            updated to, for the start of the recipe in order
+        surplus: A list of the Ingredients left unmatched, to be deleted
+    """
+    # costs[i][j] is the fewest (writes, renames) placing the first i dicts
+    # on the first j ingredients, with moves[i][j] the step that got there
+    costs = [[None] * (len(ingredients) + 1) for _ in range(len(recipe) + 1)]
+    moves = [[None] * (len(ingredients) + 1) for _ in range(len(recipe) + 1)]
+    costs[0][0] = (0, 0)
+
+    for j, ingredient in enumerate(ingredients):
+        for i in range(min(j, len(recipe)) + 1):
+            steps = [(i, (1, 0), "delete")]
+            if i < len(recipe):
+                steps.append(
+                    (i + 1, _match_cost(ingredient, recipe[i]), "match")
+                )
+            for row, (writes, renames), move in steps:
+                cost = (costs[i][j][0] + writes, costs[i][j][1] + renames)
+                if costs[row][j + 1] is None or cost < costs[row][j + 1]:
+                    costs[row][j + 1] = cost
+                    moves[row][j + 1] = move
+
+    last = len(ingredients)
+    i = min(
+        (i for i in range(len(recipe) + 1) if costs[i][last] is not None),
+        key=lambda i: (costs[i][last][0] + len(recipe) - i, costs[i][last][1]),
+    )
+    matches, surplus = [], []
+
+    for j in range(last, 0, -1):
+        if moves[i][j] == "match":
+            i -= 1
+            matches.append((ingredients[j - 1], recipe[i]))
+        else:
+            surplus.append(ingredients[j - 1])
+
+    return matches[::-1], surplus[::-1]
+
+
+def _match_cost(ingredient, fields):
+    if all(
+        getattr(ingredient, field) == fields.get(field)
+        for field in INGREDIENT_FIELDS
+    ):
+        return (0, 0)
+
+    return (1, int(ingredient.name != fields.get("name")))
+
+
+def commit_session():
+    """Commits the current transaction, rolling it back if the commit fails."""
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def purge_orphaned_ingredients(batch_size=ORPHAN_BATCH_SIZE):
+    """Deletes the ingredients that don't belong to any drink.
+
+    Orphans are deleted a batch per transaction so writers are never locked
+    out for long. They aren't on the menu, so the menu version is unchanged.
+
+    Args:
+        batch_size: An int representing the most orphans deleted per
+            transaction
+
+    Returns:
+        purged: An int representing the number of orphans deleted
+    """
+    orphans = (
+        select([Ingredient.id])
+        .select_from(Ingredient.__table__.outerjoin(Drink.__table__))
+        .where(Drink.id.is_(None))
+        .limit(batch_size)
+    )
+    delete = Ingredient.__table__.delete().where(Ingredient.id.in_(orphans))
+    purged = 0
+
+    while True:
+        deleted = db.session.execute(delete).rowcount
+        commit_session()
+        purged += deleted
+
+        if deleted < batch_size:
+            return purged
+
+
+def vacuum_db(incremental=False):
+    """Returns the free pages of the bound sqlite db to the file system.
+
+    An incremental vacuum only frees pages, but the first one has to rebuild
+    the file to turn incremental vacuuming on.
+
+    Args:
+        incremental: A bool representing whether to vacuum incrementally
+            rather than rebuild the whole file (default: False)
+
+    Returns:
+        reclaimed: An int representing the number of bytes the db shrank by
+    """
+    if db.engine.dialect.name != "sqlite":
+        return 0
+
+    with db.engine.connect() as connection:
+        size = _db_size(connection)
+
+        if incremental and connection.execute("PRAGMA auto_vacuum").scalar():
+            connection.execute("PRAGMA incremental_vacuum")
+        else:
+            if incremental:
+                connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+
+        reclaimed = size - _db_size(connection)
+
+    return reclaimed
+
+
+def _db_size(connection):
+    return (
+        connection.execute("PRAGMA page_count").scalar()
+        * connection.execute("PRAGMA page_size").scalar()
+    )
+
+
+def migrate_db_once():
+    """Migrates the bound db the first time it is used by this process."""
+    db_url = str(db.engine.url)
+
+    if db_url in _migrated_dbs:
+        return
+
+    with _migrate_lock:
+        if db_url not in _migrated_dbs:
+            migrate_db()
+            _migrated_dbs.add(db_url)
+
 
 class Drink(db.Model):
     """A model representing a drink.
@@ -48,23 +805,174 @@ class Drink(db.Model):
     __tablename__ = "drinks"
 
     id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
-    title = Column(String(80))
-    recipe = relationship("Ingredient", backref="drink")
+    title = Column(String(80), index=True)
+    recipe = relationship(
+        "Ingredient",
+        backref="drink",
+        order_by="Ingredient.id",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+    def insert(self, commit=True):
+        """Inserts a new drink object and its recipe into the db.
 
-    def insert(self):
-        """Inserts a new drink object into the db."""
+        The drink and every ingredient in its recipe are flushed together.
+
+        Args:
+            commit: A bool representing whether to commit the transaction
+                (default: True)
+        """
         db.session.add(self)
-        db.session.commit()
+
+        if commit:
+            commit_session()
 
     @staticmethod
     def update():
-        """Updates an existing question object in the db."""
-        db.session.commit()
+        """Commits every pending change to drinks as a single transaction."""
+        commit_session()
+
+    def delete(self, commit=True):
+        """Deletes an existing drink object and its recipe from the db.
 
-    def delete(self):
-        """Deletes an existing drink object from the db."""
+        The recipe is deleted with a single statement rather than one per
+        ingredient.
+
+        Args:
+            commit: A bool representing whether to commit the transaction
+                (default: True)
+        """
+        db.session.query(Ingredient).filter(
+            Ingredient.drink_id == self.id
+        ).delete(synchronize_session=False)
+        db.session.expire(self, ["recipe"])
         db.session.delete(self)
-        db.session.commit()
+
+        if commit:
+            commit_session()
+
+    @staticmethod
+    def search(terms, limit, offset=0):
+        """Finds the drinks whose title or ingredients match the search terms.
+
+        Every term must match the start of a word in the drink's title or
+        ingredient names. Matches in the title rank higher.
+
+        Args:
+            terms: A str representing the search terms
+            limit: An int representing the most drinks to return
+            offset: An int representing the number of best matches to skip
+
+        Returns:
+            drink_ids: A list of ints representing the matching drinks, best
+                match first
+        """
+        match = " ".join(
+            '"' + term.replace('"', '""') + '"*' for term in terms.split()
+        )
+        rows = db.session.execute(
+            text(
+                f"SELECT rowid FROM {SEARCH_TABLE} "
+                f"WHERE {SEARCH_TABLE} MATCH :match "
+                f"ORDER BY bm25({SEARCH_TABLE}, 10.0, 1.0), rowid "
+                "LIMIT :limit OFFSET :offset"
+            ),
+            {"match": match, "limit": limit, "offset": offset},
+        )
+        drink_ids = [row[0] for row in rows]
+
+        return drink_ids
+
+    @staticmethod
+    def format_page(format_name, after_id=None, limit=None):
+        """Formats a page of drinks in id order without loading them.
+
+        The drinks and their recipes are read with a single statement and
+        grouped into the dicts short_format and long_format build.
+
+        Args:
+            format_name: A str naming the format, short_format or long_format
+            after_id: An int representing the id the page starts after, or
+                None to start from the first drink
+            limit: An int representing the most drinks to return, or None
+                for every drink
+
+        Returns:
+            drinks: A list of tuples of a drink id and the formatted drink
+        """
+        page = select([Drink.id, Drink.title])
+
+        if after_id is not None:
+            page = page.where(Drink.id > after_id)
+
+        page = page.order_by(Drink.id)
+
+        if limit is not None:
+            page = page.limit(limit)
+
+        rows = db.session.execute(recipe_rows(page.alias("page")))
+
+        return format_drinks(rows, format_name)
+
+    @staticmethod
+    def format_many(format_name, drink_ids):
+        """Formats the given drinks without loading them.
+
+        Args:
+            format_name: A str naming the format, short_format or long_format
+            drink_ids: A list of ints representing the drinks to format
+
+        Returns:
+            drinks: A list of dicts representing the drinks that exist, in
+                the order given
+        """
+        query = recipe_rows(Drink.__table__)
+        drinks = {}
+
+        for start in range(0, len(drink_ids), 500):
+            rows = db.session.execute(
+                query.where(Drink.id.in_(drink_ids[start : start + 500]))
+            )
+            drinks.update(format_drinks(rows, format_name))
+
+        return [
+            drinks[drink_id] for drink_id in drink_ids if drink_id in drinks
+        ]
+
+    def update_recipe(self, recipe):
+        """Changes the recipe to match the given one with minimal writes.
+
+        Recipes are kept in id order, so ingredients are matched in order
+        with match_ingredients. Matched ingredients are only updated where
+        they differ, unmatched ones are deleted and the rest of the recipe is
+        inserted after them, so unchanged ingredients keep their ids.
+        Nothing is committed.
+
+        Args:
+            recipe: A list of dicts representing the ingredients of the new
+                recipe in long format
+        """
+        matches, surplus = match_ingredients(list(self.recipe), recipe)
+
+        for ingredient, fields in matches:
+            for field in INGREDIENT_FIELDS:
+                value = fields.get(field)
+                if getattr(ingredient, field) != value:
+                    setattr(ingredient, field, value)
+
+        for ingredient in surplus:
+            self.recipe.remove(ingredient)
+            ingredient.delete(commit=False)
+
+        for fields in recipe[len(matches) :]:
+            self.recipe.append(
+                Ingredient(
+                    name=fields.get("name"),
+                    parts=fields.get("parts"),
+                    color=fields.get("color"),
+                )
+            )
 
     def short_format(self):
         """Formats the drink as a dict with the recipe in short format.
@@ -116,18 +1024,34 @@ class Ingredient(db.Model):
     parts = Column(Integer().with_variant(Integer, "sqlite"))
     color = Column(String(80))
     drink_id = Column(
-        Integer().with_variant(Integer, "sqlite"), ForeignKey("drinks.id")
+        Integer().with_variant(Integer, "sqlite"),
+        ForeignKey("drinks.id", ondelete="CASCADE"),
+        index=True,
     )
 
-    def insert(self):
-        """Inserts a new ingredient object into the db."""
+    def insert(self, commit=True):
+        """Inserts a new ingredient object into the db.
+
+        Args:
+            commit: A bool representing whether to commit the transaction
+                (default: True)
+        """
         db.session.add(self)
-        db.session.commit()
 
-    def delete(self):
-        """Deletes an existing ingredient object from the db."""
+        if commit:
+            commit_session()
+
+    def delete(self, commit=True):
+        """Deletes an existing ingredient object from the db.
+
+        Args:
+            commit: A bool representing whether to commit the transaction
+                (default: True)
+        """
         db.session.delete(self)
-        db.session.commit()
+
+        if commit:
+            commit_session()
 
     def short_format(self):
         """Formats the ingredient as a dict in a short format.
@@ -155,3 +1079,288 @@ class Ingredient(db.Model):
         }
 
         return ingredient
+
+
+class DrinkDocument(db.Model):
+    """A model holding the prebuilt documents of a drink.
+
+    The documents are rebuilt in the same transaction as any write to the
+    drink or its recipe, so listing drinks doesn't load or format them.
+
+    Attributes:
+        drink_id: The id of the drink the documents were built from
+        short_format: A str representing the drink's short format as json
+        long_format: A str representing the drink's long format as json
+    """
+
+    __tablename__ = "drink_documents"
+
+    drink_id = Column(
+        Integer().with_variant(Integer, "sqlite"),
+        ForeignKey("drinks.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    short_format = Column(Text, nullable=False)
+    long_format = Column(Text, nullable=False)
+
+    @staticmethod
+    def page(format_name, after_id=None, limit=None):
+        """Retrieves the documents of a page of drinks in id order.
+
+        Args:
+            format_name: A str naming the format, short_format or long_format
+            after_id: An int representing the id the page starts after, or
+                None to start from the first drink
+            limit: An int representing the most documents to return, or None
+                for every drink
+
+        Returns:
+            rows: A list of tuples of a drink id and its document
+        """
+        column = getattr(DrinkDocument, format_name)
+        query = db.session.query(DrinkDocument.drink_id, column)
+
+        if after_id is not None:
+            query = query.filter(DrinkDocument.drink_id > after_id)
+
+        query = query.order_by(DrinkDocument.drink_id)
+
+        if limit is not None:
+            query = query.limit(limit)
+
+        return query.all()
+
+    @staticmethod
+    def get_many(format_name, drink_ids):
+        """Retrieves the documents of the given drinks.
+
+        Args:
+            format_name: A str naming the format, short_format or long_format
+            drink_ids: A list of ints representing the drinks
+
+        Returns:
+            documents: A list of str representing the documents of the drinks
+                that exist, in the order given
+        """
+        column = getattr(DrinkDocument, format_name)
+        documents = {}
+
+        for start in range(0, len(drink_ids), 500):
+            documents.update(
+                db.session.query(DrinkDocument.drink_id, column).filter(
+                    DrinkDocument.drink_id.in_(drink_ids[start : start + 500])
+                )
+            )
+
+        return [
+            documents[drink_id]
+            for drink_id in drink_ids
+            if drink_id in documents
+        ]
+
+
+class MenuVersion(db.Model):
+    """A model holding a counter that changes whenever the menu changes.
+
+    The counter lives in the db so that every worker process sharing the db
+    sees the same version, and it is bumped in the same flush as the write
+    that changed the menu.
+
+    Attributes:
+        id: An int that serves as the unique identifier for the counter
+        version: An int representing the current version of the menu
+    """
+
+    __tablename__ = "menu_version"
+
+    id = Column(Integer().with_variant(Integer, "sqlite"), primary_key=True)
+    version = Column(Integer().with_variant(Integer, "sqlite"), nullable=False)
+
+    @staticmethod
+    def current():
+        """Retrieves the current version of the menu.
+
+        Returns:
+            version: An int representing the current version of the menu
+        """
+        version = (
+            db.session.query(MenuVersion.version)
+            .filter(MenuVersion.id == 1)
+            .scalar()
+        )
+
+        return version
+
+    @staticmethod
+    def bump(session):
+        """Increments the version of the menu within the session's transaction.
+
+        Args:
+            session: The session that is changing the menu
+        """
+        session.execute(
+            MenuVersion.__table__.update()
+            .where(MenuVersion.id == 1)
+            .values(version=MenuVersion.version + 1)
+        )
+
+
+@event.listens_for(db.session, "before_flush")
+def bump_menu_version(
+    session, flush_context, instances
+):  # pylint: disable=unused-argument
+    """Bumps the menu version when a flush changes drinks or ingredients.
+
+    Args:
+        session: The session being flushed
+        flush_context: unused
+        instances: unused
+    """
+    modified = (obj for obj in session.dirty if session.is_modified(obj))
+    changes = chain(session.new, modified, session.deleted)
+
+    if any(isinstance(obj, (Drink, Ingredient)) for obj in changes):
+        MenuVersion.bump(session)
+        session.info["menu_bumps"] = session.info.get("menu_bumps", 0) + 1
+
+
+def changed_drink_ids(session):
+    """Collects the drinks whose title or recipe the session is flushing.
+
+    Args:
+        session: The session being flushed
+
+    Returns:
+        drink_ids: A set of ints representing the changed drinks
+    """
+    modified = (obj for obj in session.dirty if session.is_modified(obj))
+    drink_ids = set()
+
+    for obj in chain(session.new, modified, session.deleted):
+        if isinstance(obj, Drink):
+            drink_ids.add(obj.id)
+        elif isinstance(obj, Ingredient):
+            drink_ids.add(obj.drink_id)
+            drink_ids.update(inspect(obj).attrs.drink_id.history.deleted)
+
+    drink_ids.discard(None)
+
+    return drink_ids
+
+
+@event.listens_for(db.session, "after_flush")
+def sync_search_index(
+    session, flush_context
+):  # pylint: disable=unused-argument
+    """Reindexes the drinks whose title or recipe a flush changed.
+
+    Args:
+        session: The session that was flushed
+        flush_context: unused
+    """
+    drink_ids = changed_drink_ids(session)
+
+    if drink_ids:
+        reindex_drinks(session, drink_ids)
+
+
+@event.listens_for(db.session, "after_flush")
+def sync_documents(session, flush_context):  # pylint: disable=unused-argument
+    """Rebuilds the documents of the drinks a flush changed.
+
+    Args:
+        session: The session that was flushed
+        flush_context: unused
+    """
+    drink_ids = changed_drink_ids(session)
+
+    if drink_ids:
+        refresh_documents(session, drink_ids)
+
+
+@event.listens_for(db.session, "after_flush")
+def track_recipe_changes(
+    session, flush_context
+):  # pylint: disable=unused-argument
+    """Records the recipes a flush changed for the ingredient index.
+
+    Args:
+        session: The session that was flushed
+        flush_context: unused
+    """
+    drink_ids = sorted(changed_drink_ids(session))
+
+    if not drink_ids:
+        return
+
+    recipes = session.info.setdefault("recipe_changes", {})
+    recipes.update(dict.fromkeys(drink_ids))
+    query = (
+        select([Drink.id, Ingredient.name])
+        .select_from(Drink.__table__.outerjoin(Ingredient.__table__))
+        .order_by(Ingredient.id)
+    )
+
+    for start in range(0, len(drink_ids), 500):
+        rows = session.execute(
+            query.where(Drink.id.in_(drink_ids[start : start + 500]))
+        )
+        for drink_id, name in rows:
+            recipe = recipes[drink_id] = recipes[drink_id] or []
+            if name is not None:
+                recipe.append(name)
+
+    session.info["menu_version"] = (
+        str(session.get_bind().url),
+        session.execute(
+            select([MenuVersion.version]).where(MenuVersion.id == 1)
+        ).scalar(),
+    )
+
+
+@event.listens_for(db.session, "after_commit")
+def apply_recipe_changes(session):
+    """Applies the recipes a transaction changed to the ingredient index.
+
+    Args:
+        session: The session that committed
+    """
+    recipes = session.info.pop("recipe_changes", None)
+    bumps = session.info.pop("menu_bumps", 0)
+    version = session.info.pop("menu_version", None)
+
+    if recipes is None or version is None:
+        return
+
+    db_url, to_version = version
+    ingredient_index.update((db_url, to_version - bumps), version, recipes)
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_recipe_changes(session):
+    """Forgets the recipe changes of a transaction that was rolled back.
+
+    Args:
+        session: The session that rolled back
+    """
+    for key in ("recipe_changes", "menu_bumps", "menu_version"):
+        session.info.pop(key, None)
+
+
+def load_ingredient_index():
+    """Retrieves the ingredient index, loading it again if it is stale.
+
+    Returns:
+        ingredient_index: The IngredientIndex matching the current menu
+    """
+    version = (str(db.session.get_bind().url), MenuVersion.current())
+
+    if ingredient_index.version != version:
+        rows = (
+            db.session.query(Drink.id, Ingredient.name)
+            .outerjoin(Drink.recipe)
+            .order_by(Ingredient.id)
+        )
+        ingredient_index.load(version, rows)
+
+    return ingredient_index
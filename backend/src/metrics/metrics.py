@@ -0,0 +1,502 @@
+"""Request, sql, auth and cache metrics in the prometheus text format.
+
+Every process counts into its own registry. When METRICS_DIR is set each
+process also writes its counts to a file there, at most once per flush
+interval, and a scrape of any process sums the files of all of them.
+
+Attributes:
+    METRICS_DIR: A str representing the directory shared by the worker
+        processes for their counts, or None to only report this process
+    METRICS_FLUSH_INTERVAL: A float representing the minimum number of
+        seconds between two writes of a process's counts
+    LATENCY_BUCKETS: A tuple of the request latency histogram bounds
+    QUERY_DURATION_BUCKETS: A tuple of the sql statement duration histogram
+        bounds
+    QUERY_COUNT_BUCKETS: A tuple of the statements per request histogram
+        bounds
+    FAMILIES: A dict mapping metric names to their type, help text and
+        histogram buckets
+    registry: The MetricsRegistry of this process
+
+Classes:
+    MetricsRegistry()
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+METRICS_DIR = os.getenv("METRICS_DIR") or None
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "1"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    1,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+FAMILIES = {
+    "cafe_requests_total": ("counter", "Requests by route and status.", None),
+    "cafe_request_duration_seconds": (
+        "histogram",
+        "Request latency by route.",
+        LATENCY_BUCKETS,
+    ),
+    "cafe_db_queries_per_request": (
+        "histogram",
+        "Sql statements executed per request by route.",
+        QUERY_COUNT_BUCKETS,
+    ),
+    "cafe_db_query_duration_seconds": (
+        "histogram",
+        "Sql statement execution time.",
+        QUERY_DURATION_BUCKETS,
+    ),
+    "cafe_auth_failures_total": (
+        "counter",
+        "Rejected requests by auth error code.",
+        None,
+    ),
+    "cafe_cache_lookups_total": (
+        "counter",
+        "Cache lookups by cache and result.",
+        None,
+    ),
+    "cafe_cache_hit_ratio": (
+        "gauge",
+        "Share of cache lookups that were hits.",
+        None,
+    ),
+}
+
+
+class MetricsRegistry:
+    """The counts of one process, optionally shared through a directory.
+
+    Histograms keep a count per bucket rather than cumulative counts, so an
+    observation touches a single sample; buckets are accumulated when the
+    metrics are rendered.
+
+    Attributes:
+        directory: A str representing the directory the counts of every
+            process are written to, or None
+        flush_interval: A float representing the minimum number of seconds
+            between two writes of this process's counts
+        clock: A callable returning the current time in seconds
+        process_id: A str naming this process's file, or None to use the pid
+    """
+
+    def __init__(
+        self,
+        directory=METRICS_DIR,
+        flush_interval=METRICS_FLUSH_INTERVAL,
+        clock=time.monotonic,
+        process_id=None,
+    ):
+        """Set-up for MetricsRegistry."""
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.process_id = process_id
+        self._samples = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flushed_at = None
+
+    def inc(self, name, labels=(), amount=1):
+        """Increments a counter.
+
+        Args:
+            name: A str representing the sample name
+            labels: A tuple of label name and value pairs
+            amount: A number to add to the counter
+        """
+        key = (name, labels)
+
+        with self._lock:
+            self._samples[key] = self._samples.get(key, 0) + amount
+
+    def observe(self, name, value, buckets, labels=()):
+        """Records an observation in a histogram.
+
+        Args:
+            name: A str representing the histogram name
+            value: A number representing the observed value
+            buckets: A tuple of the ascending bucket bounds
+            labels: A tuple of label name and value pairs
+        """
+        bound = next((b for b in buckets if value <= b), "+Inf")
+        bucket_key = (f"{name}_bucket", labels + (("le", str(bound)),))
+        sum_key = (f"{name}_sum", labels)
+        count_key = (f"{name}_count", labels)
+
+        with self._lock:
+            samples = self._samples
+            samples[bucket_key] = samples.get(bucket_key, 0) + 1
+            samples[sum_key] = samples.get(sum_key, 0) + value
+            samples[count_key] = samples.get(count_key, 0) + 1
+
+    def add_collector(self, collector):
+        """Registers a function reporting samples counted elsewhere.
+
+        Args:
+            collector: A callable returning a dict mapping sample keys to
+                their current values
+        """
+        self._collectors.append(collector)
+
+    def reset_after_fork(self):
+        """Drops counts inherited from a parent process."""
+        if os.getpid() != self._pid:
+            with self._lock:
+                self._samples = {}
+                self._pid = os.getpid()
+                self._flushed_at = None
+
+    def snapshot(self):
+        """Copies the current counts of this process.
+
+        Returns:
+            samples: A dict mapping sample keys to their values
+        """
+        with self._lock:
+            samples = dict(self._samples)
+
+        for collector in self._collectors:
+            for key, value in collector().items():
+                samples[key] = samples.get(key, 0) + value
+
+        return samples
+
+    def flush(self, force=False):
+        """Writes this process's counts to the shared directory if due.
+
+        Args:
+            force: A bool representing whether to ignore the flush interval
+        """
+        if self.directory is None:
+            return
+
+        now = self.clock()
+
+        if not force and self._flushed_at is not None:
+            if now - self._flushed_at < self.flush_interval:
+                return
+
+        self._flushed_at = now
+        samples = [
+            [name, list(labels), value]
+            for (name, labels), value in self.snapshot().items()
+        ]
+
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as metrics_file:
+                json.dump(samples, metrics_file)
+            os.replace(tmp_path, self._path())
+        except OSError:
+            # The next flush will try again
+            pass
+
+    def collect(self):
+        """Sums the counts of every process sharing the directory.
+
+        Returns:
+            samples: A dict mapping sample keys to their summed values
+        """
+        samples = self.snapshot()
+
+        if self.directory is None:
+            return samples
+
+        own_path = self._path()
+
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if not file_name.endswith(".json") or path == own_path:
+                continue
+            try:
+                with open(path) as metrics_file:
+                    rows = json.load(metrics_file)
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in rows:
+                key = (name, tuple(tuple(label) for label in labels))
+                samples[key] = samples.get(key, 0) + value
+
+        return samples
+
+    def render(self):
+        """Formats the metrics of every process in the prometheus format.
+
+        Returns:
+            text: A str representing the metrics exposition
+        """
+        samples = self.collect()
+        add_hit_ratios(samples)
+        lines = []
+
+        for family, (metric_type, help_text, buckets) in FAMILIES.items():
+            if metric_type == "histogram":
+                family_samples = cumulate_buckets(family, buckets, samples)
+            else:
+                family_samples = sorted(
+                    (key, value)
+                    for key, value in samples.items()
+                    if key[0] == family
+                )
+
+            if not family_samples:
+                continue
+
+            lines.append(f"# HELP {family} {help_text}")
+            lines.append(f"# TYPE {family} {metric_type}")
+            lines.extend(
+                f"{name}{format_labels(labels)} {format_value(value)}"
+                for (name, labels), value in family_samples
+            )
+
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """Drops the counts of this process."""
+        with self._lock:
+            self._samples = {}
+            self._flushed_at = None
+
+    def _path(self):
+        process_id = self.process_id or str(os.getpid())
+        return os.path.join(self.directory, f"{process_id}.json")
+
+
+registry = MetricsRegistry()
+
+
+def add_hit_ratios(samples):
+    """Adds a hit ratio gauge for every cache with lookups.
+
+    Args:
+        samples: A dict mapping sample keys to their values
+    """
+    lookups = {}
+
+    for (name, labels), value in list(samples.items()):
+        if name == "cafe_cache_lookups_total":
+            labels = dict(labels)
+            totals = lookups.setdefault(labels["cache"], [0, 0])
+            totals[labels["result"] == "hit"] += value
+
+    for cache, (misses, hits) in lookups.items():
+        if hits + misses:
+            key = ("cafe_cache_hit_ratio", (("cache", cache),))
+            samples[key] = hits / (hits + misses)
+
+
+def cumulate_buckets(family, buckets, samples):
+    """Lists the samples of a histogram with cumulative bucket counts.
+
+    Args:
+        family: A str representing the histogram name
+        buckets: A tuple of the ascending bucket bounds
+        samples: A dict mapping sample keys to their values
+
+    Returns:
+        samples: A sorted list of the histogram's sample keys and values
+    """
+    series = {}
+
+    for (name, labels), value in samples.items():
+        if name == f"{family}_bucket":
+            bound = dict(labels)["le"]
+            labels = tuple(label for label in labels if label[0] != "le")
+            counts = series.setdefault(labels, {})
+            counts[bound] = counts.get(bound, 0) + value
+        elif name in (f"{family}_sum", f"{family}_count"):
+            series.setdefault(labels, {})
+
+    family_samples = []
+    bounds = [str(bound) for bound in buckets] + ["+Inf"]
+
+    for labels in sorted(series):
+        total = 0
+        for bound in bounds:
+            total += series[labels].get(bound, 0)
+            key = (f"{family}_bucket", labels + (("le", bound),))
+            family_samples.append((key, total))
+        for suffix in ("_sum", "_count"):
+            key = (f"{family}{suffix}", labels)
+            family_samples.append((key, samples.get(key, 0)))
+
+    return family_samples
+
+
+def format_labels(labels):
+    """Formats labels for the prometheus text format.
+
+    Args:
+        labels: A tuple of label name and value pairs
+
+    Returns:
+        text: A str representing the labels in braces, or an empty str
+    """
+    if not labels:
+        return ""
+
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+
+    return f"{{{pairs}}}"
+
+
+def format_value(value):
+    """Formats a sample value for the prometheus text format.
+
+    Args:
+        value: A number representing the sample value
+
+    Returns:
+        text: A str representing the value
+    """
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+
+    return str(int(value))
+
+
+def cache_collector(caches):
+    """Builds a collector reporting the lookups of the given caches.
+
+    Args:
+        caches: A dict mapping cache names to objects counting hits and
+            misses
+
+    Returns:
+        collector: A callable returning the caches' lookup samples
+    """
+
+    def collector():
+        samples = {}
+        for name, cache in caches.items():
+            for result, value in (("hit", cache.hits), ("miss", cache.misses)):
+                labels = (("cache", name), ("result", result))
+                samples[("cafe_cache_lookups_total", labels)] = value
+        return samples
+
+    return collector
+
+
+def init_app(app, caches=None):
+    """Registers the hooks counting the requests and sql of the app.
+
+    Args:
+        app: The flask app to count
+        caches: A dict mapping cache names to objects counting hits and
+            misses (default: None)
+    """
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    if caches:
+        registry.add_collector(cache_collector(caches))
+
+    if not event.contains(Engine, "before_cursor_execute", _before_execute):
+        event.listen(Engine, "before_cursor_execute", _before_execute)
+        event.listen(Engine, "after_cursor_execute", _after_execute)
+        event.listen(Engine, "handle_error", _handle_error)
+
+
+def record_auth_failure(error_code):
+    """Counts a request rejected by authentication or authorization.
+
+    Args:
+        error_code: A str representing the error code of the AuthError
+    """
+    registry.inc("cafe_auth_failures_total", (("error_code", error_code),))
+
+
+def _start_request():
+    registry.reset_after_fork()
+    g.metrics_started = time.perf_counter()
+    g.metrics_queries = 0
+
+
+def _finish_request(response):
+    started = g.pop("metrics_started", None)
+
+    if started is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    labels = (("method", request.method), ("route", route))
+    registry.inc(
+        "cafe_requests_total",
+        labels + (("status", str(response.status_code)),),
+    )
+    registry.observe(
+        "cafe_request_duration_seconds",
+        time.perf_counter() - started,
+        LATENCY_BUCKETS,
+        labels,
+    )
+    registry.observe(
+        "cafe_db_queries_per_request",
+        g.pop("metrics_queries", 0),
+        QUERY_COUNT_BUCKETS,
+        labels,
+    )
+    registry.flush()
+
+    return response
+
+
+def _before_execute(
+    conn, cursor, statement, parameters, context, executemany
+):  # pylint: disable=unused-argument,too-many-arguments
+    conn.info.setdefault("metrics_starts", []).append(time.perf_counter())
+
+
+def _after_execute(
+    conn, cursor, statement, parameters, context, executemany
+):  # pylint: disable=unused-argument,too-many-arguments
+    starts = conn.info.get("metrics_starts")
+
+    if not starts:
+        return
+
+    registry.observe(
+        "cafe_db_query_duration_seconds",
+        time.perf_counter() - starts.pop(),
+        QUERY_DURATION_BUCKETS,
+    )
+
+    if has_request_context() and "metrics_queries" in g:
+        g.metrics_queries += 1
+
+
+def _handle_error(context):
+    if context.connection is not None:
+        starts = context.connection.info.get("metrics_starts")
+        if starts:
+            starts.pop()
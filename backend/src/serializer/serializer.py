@@ -0,0 +1,179 @@
+"""Json responses built with orjson when it is installed.
+
+The bodies are byte for byte the ones flask's jsonify builds. Payloads
+orjson would write differently, such as floats it would not write with an
+exponent the way python does, ints wider than 64 bits, keys that are not
+strs and pretty printed responses, are serialized by flask's json module
+instead. The one difference left is that nan and infinity are written as
+null rather than as the invalid NaN and Infinity tokens.
+
+Attributes:
+    JSON_SERIALIZER: A str naming the serializer chosen at startup, one of
+        SERIALIZERS
+    SERIALIZERS: A tuple of the serializer names, auto uses orjson when it is
+        installed
+"""
+
+import os
+import re
+
+from flask import current_app, json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+SERIALIZERS = ("auto", "orjson", "json")
+JSON_SERIALIZER = os.getenv("JSON_SERIALIZER", "auto")
+
+_ORJSON_OPTIONS = (
+    orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+    if orjson
+    else 0
+)
+_DIGITS_AS_ZERO = bytes.maketrans(b"123456789", b"000000000")
+_NON_ASCII = re.compile("[\x7f-\U0010ffff]")
+_use_orjson = False
+
+
+def set_serializer(name):
+    """Chooses the serializer building json responses.
+
+    Args:
+        name: A str naming the serializer, one of SERIALIZERS
+
+    Raises:
+        ValueError: The serializer is unknown or orjson is not installed
+    """
+    global _use_orjson  # pylint: disable=global-statement
+
+    if name not in SERIALIZERS:
+        raise ValueError(f"unknown json serializer: {name}")
+
+    if name == "orjson" and orjson is None:
+        raise ValueError("orjson is not installed")
+
+    _use_orjson = name != "json" and orjson is not None
+
+
+def get_serializer():
+    """Names the serializer building json responses.
+
+    Returns:
+        name: A str representing either orjson or json
+    """
+    return "orjson" if _use_orjson else "json"
+
+
+def is_canonical():
+    """Checks whether responses are compact json with sorted keys.
+
+    Json built that way with every non-ascii character escaped can be
+    spliced into a response as it is.
+
+    Returns:
+        canonical: A bool representing whether responses are canonical json
+    """
+    config = current_app.config
+
+    return (
+        config["JSON_SORT_KEYS"]
+        and config["JSON_AS_ASCII"]
+        and not config["JSONIFY_PRETTYPRINT_REGULAR"]
+        and not current_app.debug
+    )
+
+
+def _escape_non_ascii(match):
+    code = ord(match.group())
+
+    if code < 0x10000:
+        return f"\\u{code:04x}"
+
+    code -= 0x10000
+
+    return f"\\u{0xD800 | code >> 10:04x}\\u{0xDC00 | code & 0x3FF:04x}"
+
+
+def _orjson_dumps(obj, sort_keys, ensure_ascii):
+    options = _ORJSON_OPTIONS
+
+    if sort_keys:
+        options |= orjson.OPT_SORT_KEYS
+
+    try:
+        body = orjson.dumps(
+            obj, default=current_app.json_encoder().default, option=options
+        )
+    except orjson.JSONEncodeError:
+        return None
+
+    # python writes floats under 1e-4 and from 1e16 with a signed exponent,
+    # strings that happen to look alike are only serialized again
+    digits = body.translate(_DIGITS_AS_ZERO)
+
+    if b"0.0000" in body or b"0e0" in digits or b"0e-0" in digits:
+        return None
+
+    if ensure_ascii and (not body.isascii() or b"\x7f" in body):
+        body = _NON_ASCII.sub(_escape_non_ascii, body.decode()).encode()
+
+    return body
+
+
+def dumps(obj):
+    """Serializes an object the way flask's jsonify does.
+
+    Args:
+        obj: The object to serialize
+
+    Returns:
+        body: A bytes object representing the json followed by a newline
+    """
+    config = current_app.config
+    pretty = config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug
+
+    if _use_orjson and not pretty:
+        body = _orjson_dumps(
+            obj, config["JSON_SORT_KEYS"], config["JSON_AS_ASCII"]
+        )
+        if body is not None:
+            return body + b"\n"
+
+    indent, separators = (2, (", ", ": ")) if pretty else (None, (",", ":"))
+
+    return (
+        json.dumps(obj, indent=indent, separators=separators) + "\n"
+    ).encode()
+
+
+def jsonify(*args, **kwargs):
+    """Builds a json response, standing in for flask's jsonify.
+
+    Args:
+        args: A single object to serialize, or several serialized as a list
+        kwargs: Keys and values serialized as an object instead of args
+
+    Returns:
+        response: A flask Response with the serialized json
+
+    Raises:
+        TypeError: Both args and kwargs were given
+    """
+    if args and kwargs:
+        raise TypeError(
+            "jsonify() behavior undefined when passed both args and kwargs"
+        )
+
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+
+    return current_app.response_class(
+        dumps(data), mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
+
+
+set_serializer(JSON_SERIALIZER)
@@ -0,0 +1,236 @@
+"""Opt-in timing of the phases of each request.
+
+When enabled, the time spent authenticating, running sql, formatting and
+serializing is collected per request and reported in a Server-Timing header
+and a json log line. When disabled, a timed phase costs a single check.
+
+Attributes:
+    SERVER_TIMING: A bool representing whether timing is enabled at startup
+    logger: A logging.Logger receiving a json line per timed request
+
+Classes:
+    RequestTimings()
+"""
+
+import json
+import logging
+import os
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0") == "1"
+
+logger = logging.getLogger(__name__)
+_enabled = False
+
+
+class RequestTimings:
+    """The phases timed during a single request.
+
+    Attributes:
+        started: A float representing when the request started
+        phases: A dict mapping phase names to their total seconds
+        queries: An int representing the number of sql statements executed
+        query_time: A float representing the seconds spent executing them
+    """
+
+    __slots__ = ("started", "phases", "queries", "query_time")
+
+    def __init__(self):
+        """Set-up for RequestTimings."""
+        self.started = time.perf_counter()
+        self.phases = {}
+        self.queries = 0
+        self.query_time = 0.0
+
+    def add(self, name, seconds):
+        """Adds time to a phase.
+
+        Args:
+            name: A str representing the phase
+            seconds: A float representing the time spent in it
+        """
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def durations(self):
+        """Lists every timed phase, the sql executed and the total.
+
+        Returns:
+            durations: A dict mapping metric names to milliseconds
+        """
+        durations = {
+            name: round(seconds * 1000, 3)
+            for name, seconds in self.phases.items()
+        }
+        durations["db"] = round(self.query_time * 1000, 3)
+        durations["total"] = round(
+            (time.perf_counter() - self.started) * 1000, 3
+        )
+
+        return durations
+
+    def header(self, durations):
+        """Formats the durations as a Server-Timing header value.
+
+        Args:
+            durations: A dict mapping metric names to milliseconds
+
+        Returns:
+            header: A str representing the Server-Timing header value
+        """
+        metrics = []
+
+        for name, duration in durations.items():
+            metric = f"{name};dur={duration}"
+            if name == "db":
+                metric = f'{metric};desc="{self.queries} queries"'
+            metrics.append(metric)
+
+        return ", ".join(metrics)
+
+
+class _Phase:
+    """Times the body of a with statement as a phase of a request."""
+
+    __slots__ = ("timings", "name", "started")
+
+    def __init__(self, timings, name):
+        """Set-up for _Phase."""
+        self.timings = timings
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        """Starts timing the phase."""
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        """Adds the elapsed time to the phase."""
+        self.timings.add(self.name, time.perf_counter() - self.started)
+
+
+class _NullPhase:
+    """Stands in for a phase when timing is disabled."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        """Does nothing."""
+
+    def __exit__(self, *exc_info):
+        """Does nothing."""
+
+
+_NULL_PHASE = _NullPhase()
+
+
+def phase(name):
+    """Times the body of a with statement as a phase of the current request.
+
+    Args:
+        name: A str representing the phase, used as its Server-Timing name
+
+    Returns:
+        phase: A context manager timing its body
+    """
+    if not _enabled:
+        return _NULL_PHASE
+
+    timings = g.get("server_timings") if has_request_context() else None
+
+    if timings is None:
+        return _NULL_PHASE
+
+    return _Phase(timings, name)
+
+
+def is_enabled():
+    """Checks whether requests are being timed.
+
+    Returns:
+        enabled: A bool representing whether requests are timed
+    """
+    return _enabled
+
+
+def enable():
+    """Starts timing requests and the sql statements they execute."""
+    global _enabled  # pylint: disable=global-statement
+
+    if not _enabled:
+        event.listen(Engine, "before_cursor_execute", _before_execute)
+        event.listen(Engine, "after_cursor_execute", _after_execute)
+        _enabled = True
+
+
+def disable():
+    """Stops timing requests."""
+    global _enabled  # pylint: disable=global-statement
+
+    if _enabled:
+        event.remove(Engine, "before_cursor_execute", _before_execute)
+        event.remove(Engine, "after_cursor_execute", _after_execute)
+        _enabled = False
+
+
+def init_app(app):
+    """Registers the request hooks that collect and report timings.
+
+    Args:
+        app: The flask app to time
+    """
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+    if SERVER_TIMING:
+        enable()
+
+
+def _start_request():
+    if _enabled:
+        g.server_timings = RequestTimings()
+
+
+def _finish_request(response):
+    timings = g.pop("server_timings", None)
+
+    if timings is None:
+        return response
+
+    durations = timings.durations()
+    response.headers["Server-Timing"] = timings.header(durations)
+    logger.info(
+        json.dumps(
+            {
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "queries": timings.queries,
+                "timings_ms": durations,
+            }
+        )
+    )
+
+    return response
+
+
+def _before_execute(
+    conn, cursor, statement, parameters, context, executemany
+):  # pylint: disable=unused-argument,too-many-arguments
+    if has_request_context() and "server_timings" in g:
+        conn.info.setdefault("server_timing_starts", []).append(
+            time.perf_counter()
+        )
+
+
+def _after_execute(
+    conn, cursor, statement, parameters, context, executemany
+):  # pylint: disable=unused-argument,too-many-arguments
+    starts = conn.info.get("server_timing_starts")
+
+    if starts and has_request_context() and "server_timings" in g:
+        g.server_timings.queries += 1
+        g.server_timings.query_time += time.perf_counter() - starts.pop()
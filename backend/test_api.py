@@ -12,18 +12,102 @@ Classes:
     PublicDrinkTestCase()
     BaristaDrinkTestCase()
     ManagerDrinkTestCase()
+    StubAuthTestCase()
+    QueryCountTestCase()
+    MenuCacheTestCase()
+    TransactionTestCase()
+    RecipeDiffTestCase()
+    BulkImportTestCase()
+    StreamTestCase()
+    SearchTestCase()
+    IngredientFilterTestCase()
+    ServerTimingTestCase()
+    EngineSetupTestCase()
+    MigrationTestCase()
+    OrphanTestCase()
+    DrinkDocumentTestCase()
+    AppFactoryTestCase()
+    ReplicaTestCase()
 """
 
+import json
 import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-
-from src.api import app
-from src.database.models import PROJECT_DIR, Drink, setup_db
+from contextlib import contextmanager
+
+import sqlalchemy
+from sqlalchemy import event, inspect
+
+from jwks_stub import BARISTA_PERMISSIONS, MANAGER_PERMISSIONS, StubJWKSServer
+from src import api
+from src.api import app, menu_cache
+from src.auth import auth
+from src.database.models import (
+    PROJECT_DIR,
+    REPLICA_BIND,
+    SEARCH_TABLE,
+    Drink,
+    DrinkDocument,
+    Ingredient,
+    copy_to_replica,
+    db,
+    ingredient_index,
+    migrate_db,
+    migrate_db_once,
+    setup_db,
+)
+from src.timing import timing
 
 BARISTA_TOKEN = os.getenv("BARISTA_TOKEN")
 MANAGER_TOKEN = os.getenv("MANAGER_TOKEN")
 
 
+@contextmanager
+def count_queries():
+    """Counts the sql statements executed against the db.
+
+    Yields:
+        statements: A list that collects each executed sql statement
+    """
+    statements = []
+
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):  # pylint: disable=unused-argument,too-many-arguments
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+
+
+@contextmanager
+def count_commits():
+    """Counts the transactions committed to the db.
+
+    Yields:
+        commits: A list that collects an entry for each commit
+    """
+    commits = []
+
+    def commit(conn):  # pylint: disable=unused-argument
+        commits.append(conn)
+
+    event.listen(db.engine, "commit", commit)
+    try:
+        yield commits
+    finally:
+        event.remove(db.engine, "commit", commit)
+
+
 class PublicDrinkTestCase(unittest.TestCase):
     """This class contains the test cases for the public drink endpoints.
 
@@ -55,6 +139,51 @@ class PublicDrinkTestCase(unittest.TestCase):
         self.assertTrue(response.json.get("drinks"))
         self.assertIsNone(response.json["drinks"][0]["recipe"][0].get("name"))
 
+    def test_get_drinks_paginated_success(self):
+        """Test paging through drinks with a limit and cursor."""
+        all_drinks = self.client().get("/drinks").json["drinks"]
+        drinks = []
+        cursor = None
+
+        while True:
+            url = "/drinks?limit=2"
+            if cursor is not None:
+                url = f"{url}&cursor={cursor}"
+            response = self.client().get(url)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.json["drinks"]), 2)
+            drinks += response.json["drinks"]
+            cursor = response.json.get("next_cursor")
+            if cursor is None:
+                break
+
+        self.assertEqual(drinks, all_drinks)
+
+    def test_get_drinks_invalid_limit_fail(self):
+        """Test failed retrieval of drinks with an invalid limit."""
+        for limit in ("0", "-1", "abc", "1000000"):
+            response = self.client().get(f"/drinks?limit={limit}")
+
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json.get("error_code"), "bad_request")
+
+    def test_get_drinks_invalid_cursor_fail(self):
+        """Test failed retrieval of drinks with an invalid cursor."""
+        for path in (
+            "/drinks?limit=2&cursor=@@@",
+            f"/drinks?limit=2&cursor={api.encode_cursor(2 ** 63)}",
+            f"/drinks?limit=2&cursor={api.encode_cursor(-1)}",
+            f"/drinks/search?q=water&cursor={api.encode_cursor(2 ** 64)}",
+        ):
+            with self.subTest(path=path):
+                response = self.client().get(path)
+
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(
+                    response.json.get("error_code"), "bad_request"
+                )
+
     def test_drinks_patch_method_not_allowed_fail(self):
         """Test that patch method is not allowed at /drinks endpoint."""
         response = self.client().patch("/drinks")
@@ -330,5 +459,1683 @@ class ManagerDrinkTestCase(unittest.TestCase):
         )
 
 
+class StubAuthTestCase(unittest.TestCase):
+    """A base for test cases that call the API with tokens of a stub Auth0.
+
+    Attributes:
+        permissions: A list of str representing the permissions of the token
+            sent with requests
+        server: A StubJWKSServer standing in for Auth0
+        headers: A dict representing the auth headers to be sent with requests
+        app: A flask app from api.py
+        client: A test client for the flask app to use while testing
+        db_name: A str representing the name of the test database
+        db_path: A str representing the location of the test database
+    """
+
+    permissions = MANAGER_PERMISSIONS
+
+    def setUp(self):
+        """Set-up for StubAuthTestCase."""
+        self.server = StubJWKSServer()
+        self.server.start()
+        self._jwks_cache = auth.jwks_cache
+        auth.jwks_cache = auth.JWKSCache(self.server.url)
+        token = self.server.mint_token(self.permissions)
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.app = app
+        app.config["DEBUG"] = False
+        self.client = self.app.test_client
+        self.db_name = "test.db"
+        self.db_path = f"sqlite:///{os.path.join(PROJECT_DIR, self.db_name)}"
+        setup_db(self.app, self.db_path)
+        with self.app.app_context():
+            migrate_db_once()
+        db.session.remove()
+
+    def tearDown(self):
+        """Executed after each test."""
+        auth.jwks_cache.clear()
+        auth.jwks_cache = self._jwks_cache
+        self.server.stop()
+
+
+class QueryCountTestCase(StubAuthTestCase):
+    """This class contains test cases for the queries made per request."""
+
+    permissions = BARISTA_PERMISSIONS
+
+    def setUp(self):
+        """Set-up for QueryCountTestCase."""
+        super().setUp()
+        menu_cache.clear()
+
+    def test_get_drinks_query_count(self):
+        """Test that the menu reads the version and the stored documents."""
+        with count_queries() as statements:
+            response = self.client().get("/drinks")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.json["drinks"]), 1)
+        self.assertEqual(len(statements), 2)
+        self.assertIn("drink_documents", statements[1])
+
+    def test_get_drinks_page_query_count(self):
+        """Test that a page of drinks is a single read of its documents."""
+        with count_queries() as statements:
+            response = self.client().get("/drinks?limit=2")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+
+    def test_get_drinks_detail_query_count(self):
+        """Test that drinks detail is loaded in a fixed number of queries."""
+        with count_queries() as statements:
+            response = self.client().get(
+                "/drinks-detail", headers=self.headers
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.json["drinks"]), 1)
+        self.assertEqual(len(statements), 2)
+
+    def test_get_cached_drinks_query_count(self):
+        """Test that a cached menu only reads the menu version."""
+        self.client().get("/drinks")
+
+        with count_queries() as statements:
+            response = self.client().get("/drinks")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(statements), 1)
+        self.assertIn("menu_version", statements[0])
+
+
+class MenuCacheTestCase(StubAuthTestCase):
+    """This class contains test cases for the cached menu responses."""
+
+    def setUp(self):
+        """Set-up for MenuCacheTestCase."""
+        super().setUp()
+        menu_cache.clear()
+
+    def test_get_drinks_not_modified(self):
+        """Test that a matching etag is answered without reading drinks."""
+        response = self.client().get("/drinks")
+        etag = response.headers["ETag"]
+
+        with count_queries() as statements:
+            response = self.client().get(
+                "/drinks", headers={"If-None-Match": etag}
+            )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertEqual(len(statements), 1)
+
+    def test_get_drinks_detail_not_modified(self):
+        """Test that drinks detail honors If-None-Match."""
+        response = self.client().get("/drinks-detail", headers=self.headers)
+        headers = dict(
+            self.headers, **{"If-None-Match": response.headers["ETag"]}
+        )
+
+        response = self.client().get("/drinks-detail", headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_writes_invalidate_menu(self):
+        """Test that creating and deleting a drink changes the etag."""
+        etag = self.client().get("/drinks").headers["ETag"]
+        new_drink = {
+            "title": "Water",
+            "recipe": [{"name": "Water", "parts": 1, "color": "blue"}],
+        }
+
+        response = self.client().post(
+            "/drinks", json=new_drink, headers=self.headers
+        )
+        drink_id = response.json["created_drink_id"]
+        response = self.client().get(
+            "/drinks", headers={"If-None-Match": etag}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            drink_id, [drink["id"] for drink in response.json["drinks"]]
+        )
+
+        self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+        response = self.client().get("/drinks")
+
+        self.assertEqual(response.headers["ETag"], etag)
+        self.assertNotIn(
+            drink_id, [drink["id"] for drink in response.json["drinks"]]
+        )
+
+    def test_other_process_write_invalidates_menu(self):
+        """Test that a version bump by another process is seen."""
+        self.client().get("/drinks")
+        connection = sqlite3.connect(os.path.join(PROJECT_DIR, self.db_name))
+        with connection:
+            connection.execute(
+                "UPDATE drinks SET title = title || '!' WHERE id = 1"
+            )
+            connection.execute(
+                "UPDATE drink_documents SET short_format = json_set("
+                "short_format, '$.title', "
+                "json_extract(short_format, '$.title') || '!') "
+                "WHERE drink_id = 1"
+            )
+            connection.execute("UPDATE menu_version SET version = version + 1")
+
+        response = self.client().get("/drinks")
+
+        with connection:
+            connection.execute(
+                "UPDATE drinks SET title = substr(title, 1, length(title) - 1)"
+                " WHERE id = 1"
+            )
+            connection.execute(
+                "UPDATE drink_documents SET short_format = json_set("
+                "short_format, '$.title', "
+                "rtrim(json_extract(short_format, '$.title'), '!')) "
+                "WHERE drink_id = 1"
+            )
+            connection.execute("UPDATE menu_version SET version = version + 1")
+        connection.close()
+
+        self.assertTrue(response.json["drinks"][0]["title"].endswith("!"))
+
+
+class TransactionTestCase(StubAuthTestCase):
+    """This class contains test cases for the transactions made by writes."""
+
+    def test_create_drink_single_commit(self):
+        """Test that a drink and its recipe are committed together."""
+        new_drink = {
+            "title": "Flat White",
+            "recipe": [
+                {"name": "Espresso", "parts": 1, "color": "#371808"},
+                {"name": "Milk", "parts": 2, "color": "#e8ddb8"},
+                {"name": "Foam", "parts": 1, "color": "#f4f6ea"},
+            ],
+        }
+
+        with count_commits() as commits:
+            response = self.client().post(
+                "/drinks", json=new_drink, headers=self.headers
+            )
+        drink_id = response.json["created_drink_id"]
+        self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json["new_drink"]["recipe"], new_drink["recipe"]
+        )
+        self.assertEqual(len(commits), 1)
+
+    def test_create_drink_bad_recipe_rolled_back(self):
+        """Test that a malformed recipe leaves no partial drink behind."""
+        drink_count = Drink.query.count()
+        new_drink = {
+            "title": "Broken",
+            "recipe": [{"name": "Milk", "parts": 1, "color": "white"}, "Foam"],
+        }
+
+        response = self.client().post(
+            "/drinks", json=new_drink, headers=self.headers
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Drink.query.count(), drink_count)
+
+    def test_update_drink_single_commit(self):
+        """Test that replacing a recipe is committed in one transaction."""
+        old_drink = Drink.query.get(1).long_format()
+
+        with count_commits() as commits:
+            response = self.client().patch(
+                "/drinks/1",
+                json={"recipe": old_drink["recipe"][::-1]},
+                headers=self.headers,
+            )
+        self.client().patch(
+            "/drinks/1",
+            json={"recipe": old_drink["recipe"]},
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(commits), 1)
+
+    def test_update_drink_bad_recipe_rolled_back(self):
+        """Test that a malformed recipe leaves the drink unchanged."""
+        old_drink = Drink.query.get(1).long_format()
+        db.session.remove()
+
+        response = self.client().patch(
+            "/drinks/1",
+            json={"title": "Broken", "recipe": ["Foam"]},
+            headers=self.headers,
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Drink.query.get(1).long_format(), old_drink)
+
+
+class RecipeDiffTestCase(StubAuthTestCase):
+    """This class contains test cases for the writes made by recipe edits.
+
+    Attributes:
+        drink: A dict representing the drink being edited in long format
+    """
+
+    def setUp(self):
+        """Set-up for RecipeDiffTestCase."""
+        super().setUp()
+        self.drink = Drink.query.get(1).long_format()
+        db.session.remove()
+
+    def tearDown(self):
+        """Executed after each test."""
+        self.client().patch(
+            "/drinks/1",
+            json={"recipe": self.drink["recipe"]},
+            headers=self.headers,
+        )
+        super().tearDown()
+
+    def patch_recipe(self, recipe):
+        """Patches the recipe of the drink being edited.
+
+        Args:
+            recipe: A list of dicts representing the new recipe
+
+        Returns:
+            response: The response to the patch request
+            writes: A list of str representing the write statements emitted
+                against the ingredients table
+        """
+        with count_queries() as statements:
+            response = self.client().patch(
+                "/drinks/1", json={"recipe": recipe}, headers=self.headers
+            )
+
+        writes = [
+            statement.split()[0]
+            for statement in statements
+            if "ingredients" in statement
+            and SEARCH_TABLE not in statement
+            and not statement.startswith("SELECT")
+        ]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json["new_drink"]["recipe"], recipe)
+        self.assertEqual(response.json["old_drink"], self.drink)
+
+        return response, writes
+
+    def test_unchanged_recipe_no_writes(self):
+        """Test that resending the same recipe writes nothing."""
+        _, writes = self.patch_recipe(self.drink["recipe"])
+
+        self.assertEqual(writes, [])
+
+    def test_change_parts_single_update(self):
+        """Test that changing one ingredient's parts is a single update."""
+        recipe = [dict(ingredient) for ingredient in self.drink["recipe"]]
+        recipe[0]["parts"] += 1
+
+        _, writes = self.patch_recipe(recipe)
+
+        self.assertEqual(writes, ["UPDATE"])
+
+    def test_append_ingredient_single_insert(self):
+        """Test that adding an ingredient is a single insert."""
+        recipe = self.drink["recipe"] + [
+            {"name": "Cinnamon", "parts": 1, "color": "#d2691e"}
+        ]
+
+        _, writes = self.patch_recipe(recipe)
+
+        self.assertEqual(writes, ["INSERT"])
+
+    def test_remove_ingredient_single_delete(self):
+        """Test that removing the last ingredient is a single delete."""
+        _, writes = self.patch_recipe(self.drink["recipe"][:-1])
+
+        self.assertEqual(writes, ["DELETE"])
+
+    def test_remove_first_ingredient_single_delete(self):
+        """Test that removing the first ingredient is a single delete."""
+        old_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+        db.session.remove()
+
+        _, writes = self.patch_recipe(self.drink["recipe"][1:])
+        new_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+
+        self.assertEqual(writes, ["DELETE"])
+        self.assertEqual(new_ids, old_ids[1:])
+
+    def test_remove_middle_ingredient_single_delete(self):
+        """Test that removing a middle ingredient is a single delete."""
+        recipe = self.drink["recipe"][:1] + self.drink["recipe"][2:]
+
+        _, writes = self.patch_recipe(recipe)
+
+        self.assertEqual(writes, ["DELETE"])
+
+    def test_insert_first_ingredient_keeps_rows(self):
+        """Test that inserting a first ingredient reuses every row."""
+        old_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+        db.session.remove()
+        recipe = [
+            {"name": "Cinnamon", "parts": 1, "color": "#d2691e"}
+        ] + self.drink["recipe"]
+
+        _, writes = self.patch_recipe(recipe)
+        new_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+
+        self.assertEqual(writes.count("INSERT"), 1)
+        self.assertNotIn("DELETE", writes)
+        self.assertEqual(new_ids[:-1], old_ids)
+
+    def test_replace_first_ingredient_single_update(self):
+        """Test that replacing the first ingredient is a single update."""
+        recipe = [
+            {"name": "Cinnamon", "parts": 1, "color": "#d2691e"}
+        ] + self.drink["recipe"][1:]
+
+        _, writes = self.patch_recipe(recipe)
+
+        self.assertEqual(writes, ["UPDATE"])
+
+    def test_unchanged_ingredients_keep_ids(self):
+        """Test that ingredients that were not edited keep their ids."""
+        old_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+        db.session.remove()
+        recipe = [dict(ingredient) for ingredient in self.drink["recipe"]]
+        recipe[-1]["color"] = "#000000"
+
+        self.patch_recipe(recipe)
+        new_ids = [ingredient.id for ingredient in Drink.query.get(1).recipe]
+
+        self.assertEqual(new_ids, old_ids)
+
+
+class BulkImportTestCase(StubAuthTestCase):
+    """This class contains test cases for the bulk drink import endpoint.
+
+    Attributes:
+        created_ids: A list of the drink ids created by a test
+    """
+
+    def setUp(self):
+        """Set-up for BulkImportTestCase."""
+        super().setUp()
+        self.created_ids = []
+
+    def tearDown(self):
+        """Executed after each test."""
+        for drink_id in self.created_ids:
+            self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+        super().tearDown()
+
+    def test_bulk_import_json_array_success(self):
+        """Test importing a json array of drinks with one bad item."""
+        drinks = [
+            {
+                "title": f"Bulk {i}",
+                "recipe": [
+                    {"name": "Espresso", "parts": 1, "color": "#371808"},
+                    {"name": "Milk", "parts": i, "color": "#e8ddb8"},
+                ],
+            }
+            for i in range(3)
+        ]
+        drinks.insert(1, {"title": "No recipe"})
+
+        with count_queries() as statements:
+            response = self.client().post(
+                "/drinks/bulk", json=drinks, headers=self.headers
+            )
+        created = response.json["created"]
+        self.created_ids = [item["drink_id"] for item in created]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item["index"] for item in created], [0, 2, 3])
+        self.assertEqual(
+            [error["index"] for error in response.json["errors"]], [1]
+        )
+        for item in created:
+            drink = Drink.query.get(item["drink_id"]).long_format()
+            del drink["id"]
+            self.assertEqual(drink, drinks[item["index"]])
+        inserts = [
+            s
+            for s in statements
+            if s.startswith("INSERT")
+            and SEARCH_TABLE not in s
+            and "drink_documents" not in s
+        ]
+        self.assertEqual(len(inserts), 2)
+
+    def test_bulk_import_invalid_ingredients(self):
+        """Test that badly typed drinks are reported and the rest kept."""
+        good = {
+            "title": "Cortado",
+            "recipe": [{"name": "Espresso", "parts": 1, "color": "#371808"}],
+        }
+        drinks = [
+            good,
+            {"title": "x", "recipe": [{"name": {"a": 1}, "parts": 1}]},
+            {"title": "x", "recipe": [{"name": "Milk", "parts": "1"}]},
+            {"title": "x", "recipe": [{"name": "Milk", "color": 1}]},
+            {"title": "x" * 81, "recipe": []},
+            good,
+        ]
+
+        response = self.client().post(
+            "/drinks/bulk", json=drinks, headers=self.headers
+        )
+        self.created_ids = [
+            item["drink_id"] for item in response.json["created"]
+        ]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [item["index"] for item in response.json["created"]], [0, 5]
+        )
+        self.assertEqual(
+            [error["index"] for error in response.json["errors"]],
+            [1, 2, 3, 4],
+        )
+
+    def test_bulk_import_ndjson_success(self):
+        """Test importing newline delimited drinks."""
+        drinks = [
+            {"title": "Tea", "recipe": [{"name": "Tea", "parts": 1}]},
+            {"title": "Water", "recipe": []},
+        ]
+        body = "\n".join(json.dumps(drink) for drink in drinks)
+
+        response = self.client().post(
+            "/drinks/bulk",
+            data=body,
+            content_type="application/x-ndjson",
+            headers=self.headers,
+        )
+        self.created_ids = [
+            item["drink_id"] for item in response.json["created"]
+        ]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.created_ids), 2)
+        self.assertEqual(response.json["errors"], [])
+
+    def test_bulk_import_truncated_body(self):
+        """Test that drinks before a malformed part of the body are kept."""
+        body = '[{"title": "Tea", "recipe": []}, {"title": '
+
+        response = self.client().post(
+            "/drinks/bulk",
+            data=body,
+            content_type="application/json",
+            headers=self.headers,
+        )
+        self.created_ids = [
+            item["drink_id"] for item in response.json["created"]
+        ]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.created_ids), 1)
+        self.assertEqual(response.json["errors"][0]["index"], 1)
+
+    def test_bulk_import_not_array_fail(self):
+        """Test failed bulk import when the body is not a json array."""
+        response = self.client().post(
+            "/drinks/bulk", json={"title": "Tea"}, headers=self.headers
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json.get("error_code"), "bad_request")
+
+    def test_bulk_import_auth_fail(self):
+        """Test failed bulk import without the post:drinks permission."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = self.client().post("/drinks/bulk", json=[], headers=headers)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json.get("error_code"), "forbidden")
+
+
+class StreamTestCase(StubAuthTestCase):
+    """This class contains test cases for streaming drinks detail."""
+
+    permissions = BARISTA_PERMISSIONS
+
+    def setUp(self):
+        """Set-up for StreamTestCase."""
+        super().setUp()
+        self._stream_chunk_size = api.STREAM_CHUNK_SIZE
+        api.STREAM_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        """Executed after each test."""
+        api.STREAM_CHUNK_SIZE = self._stream_chunk_size
+        super().tearDown()
+
+    def test_stream_drinks_detail_accept_success(self):
+        """Test streaming drinks detail when ndjson is accepted."""
+        drinks = (
+            self.client()
+            .get("/drinks-detail", headers=self.headers)
+            .json["drinks"]
+        )
+        headers = dict(self.headers, Accept="application/x-ndjson")
+
+        response = self.client().get("/drinks-detail", headers=headers)
+        lines = response.data.decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual([json.loads(line) for line in lines], drinks)
+
+    def test_stream_drinks_detail_query_success(self):
+        """Test streaming drinks detail with the stream query parameter."""
+        with count_queries() as statements:
+            response = self.client().get(
+                "/drinks-detail?stream=1", headers=self.headers
+            )
+            lines = response.data.decode().splitlines()
+
+        chunks = -(-len(lines) // api.STREAM_CHUNK_SIZE)
+
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertGreater(len(lines), api.STREAM_CHUNK_SIZE)
+        self.assertLessEqual(len(statements), 2 * chunks + 2)
+
+    def test_stream_drinks_detail_auth_fail(self):
+        """Test failed streaming of drinks detail when not authenticated."""
+        response = self.client().get("/drinks-detail?stream=1")
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(
+            response.json.get("error_code"), "authorization_header_missing"
+        )
+
+
+class SearchTestCase(StubAuthTestCase):
+    """This class contains test cases for searching drinks.
+
+    Attributes:
+        created_ids: A list of the drink ids created by a test
+    """
+
+    def setUp(self):
+        """Set-up for SearchTestCase."""
+        super().setUp()
+        self.created_ids = []
+
+    def tearDown(self):
+        """Executed after each test."""
+        for drink_id in self.created_ids:
+            self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+        super().tearDown()
+
+    def create_drink(self, title, *names):
+        """Creates a drink through the api.
+
+        Args:
+            title: A str representing the title of the drink
+            names: The strs representing the names of its ingredients
+
+        Returns:
+            drink_id: An int representing the id of the created drink
+        """
+        recipe = [
+            {"name": name, "parts": 1, "color": "#e8ddb8"} for name in names
+        ]
+        response = self.client().post(
+            "/drinks",
+            json={"title": title, "recipe": recipe},
+            headers=self.headers,
+        )
+        drink_id = response.json["created_drink_id"]
+        self.created_ids.append(drink_id)
+
+        return drink_id
+
+    def search(self, query):
+        """Lists the ids of the drinks found by a search.
+
+        Args:
+            query: A str representing the query string of the search
+
+        Returns:
+            drink_ids: A list of ints representing the matching drinks
+        """
+        response = self.client().get(f"/drinks/search?{query}")
+
+        return [drink["id"] for drink in response.json["drinks"]]
+
+    def test_search_ranks_title_matches_first(self):
+        """Test that matches in the title rank above ingredient matches."""
+        in_recipe = self.create_drink("Vesper", "Zyxquince Syrup")
+        in_title = self.create_drink("Zyxquince Fizz", "Soda")
+
+        response = self.client().get("/drinks/search?q=zyxquince")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.search("q=zyxquince"), [in_title, in_recipe])
+        self.assertIsNone(response.json["next_cursor"])
+        self.assertNotIn("name", response.json["drinks"][0]["recipe"][0])
+
+    def test_search_prefix_and_all_terms(self):
+        """Test that every term must match the start of a word."""
+        both = self.create_drink("Zyxmint Julep", "Zyxlime")
+        self.create_drink("Zyxmint Tea", "Water")
+
+        self.assertEqual(self.search("q=zyxmi zyxli"), [both])
+        self.assertEqual(self.search("q=zyxm"), self.search("q=zyxmint"))
+        self.assertEqual(self.search("q=yxmint"), [])
+
+    def test_search_pagination(self):
+        """Test paging through matches with the limit and cursor."""
+        for i in range(5):
+            self.create_drink(f"Zyxpage {i}", "Milk")
+        drink_ids = self.search("q=zyxpage&limit=5")
+
+        response = self.client().get("/drinks/search?q=zyxpage&limit=2")
+        pages = [[drink["id"] for drink in response.json["drinks"]]]
+        while response.json["next_cursor"]:
+            cursor = response.json["next_cursor"]
+            response = self.client().get(
+                f"/drinks/search?q=zyxpage&limit=2&cursor={cursor}"
+            )
+            pages.append([drink["id"] for drink in response.json["drinks"]])
+
+        self.assertEqual(sorted(drink_ids), self.created_ids)
+        self.assertEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertEqual(sum(pages, []), drink_ids)
+
+    def test_search_follows_writes(self):
+        """Test that the index follows created, edited and deleted drinks."""
+        drink_id = self.create_drink("Zyxold", "Zyxberry")
+        recipe = [{"name": "Zyxcherry", "parts": 1, "color": "#ff0000"}]
+
+        self.client().patch(
+            f"/drinks/{drink_id}",
+            json={"title": "Zyxnew", "recipe": recipe},
+            headers=self.headers,
+        )
+
+        self.assertEqual(self.search("q=zyxold"), [])
+        self.assertEqual(self.search("q=zyxberry"), [])
+        self.assertEqual(self.search("q=zyxnew zyxcherry"), [drink_id])
+
+        self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+        self.created_ids.remove(drink_id)
+
+        self.assertEqual(self.search("q=zyxnew"), [])
+
+    def test_search_bulk_import_indexed(self):
+        """Test that drinks created by a bulk import can be found."""
+        response = self.client().post(
+            "/drinks/bulk",
+            json=[{"title": "Zyxbulk", "recipe": []}],
+            headers=self.headers,
+        )
+        drink_id = response.json["created"][0]["drink_id"]
+        self.created_ids.append(drink_id)
+
+        self.assertEqual(self.search("q=zyxbulk"), [drink_id])
+
+    def test_search_special_characters(self):
+        """Test that query syntax characters are searched for literally."""
+        response = self.client().get('/drinks/search?q="* OR -')
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_search_empty_query_fail(self):
+        """Test failed search without any search terms."""
+        response = self.client().get("/drinks/search?q=%20")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json["success"])
+
+
+class IngredientFilterTestCase(StubAuthTestCase):
+    """This class contains test cases for filtering drinks by ingredient.
+
+    Attributes:
+        created_ids: A list of the drink ids created by a test
+    """
+
+    def setUp(self):
+        """Set-up for IngredientFilterTestCase."""
+        super().setUp()
+        self.created_ids = []
+        self.create_drink("Zyx Flat White", "Zyx Espresso", "Zyx Milk")
+        self.create_drink("Zyx Oat Latte", "zyx espresso", "Zyx  Oat Milk")
+        self.create_drink("Zyx Matcha", "Zyx Matcha", "Zyx Oat Milk")
+        self.create_drink("Zyx Water")
+
+    def tearDown(self):
+        """Executed after each test."""
+        for drink_id in self.created_ids:
+            self.client().delete(f"/drinks/{drink_id}", headers=self.headers)
+        super().tearDown()
+
+    def create_drink(self, title, *names):
+        """Creates a drink through the api.
+
+        Args:
+            title: A str representing the title of the drink
+            names: The strs representing the names of its ingredients
+
+        Returns:
+            drink_id: An int representing the id of the created drink
+        """
+        recipe = [
+            {"name": name, "parts": 1, "color": "#e8ddb8"} for name in names
+        ]
+        response = self.client().post(
+            "/drinks",
+            json={"title": title, "recipe": recipe},
+            headers=self.headers,
+        )
+        drink_id = response.json["created_drink_id"]
+        self.created_ids.append(drink_id)
+
+        return drink_id
+
+    def filter_titles(self, query):
+        """Lists the titles of this test's drinks found by a filter.
+
+        Args:
+            query: A str representing the query string of the filter
+
+        Returns:
+            titles: A list of str representing the matching drink titles
+        """
+        response = self.client().get(f"/drinks?{query}")
+
+        return [
+            drink["title"]
+            for drink in response.json["drinks"]
+            if drink["id"] in self.created_ids
+        ]
+
+    def test_filter_ingredient_normalized(self):
+        """Test that ingredient names match regardless of case and spaces."""
+        self.assertEqual(
+            self.filter_titles("ingredient=ZYX%20ESPRESSO"),
+            ["Zyx Flat White", "Zyx Oat Latte"],
+        )
+        self.assertEqual(
+            self.filter_titles("ingredient=zyx%20oat%20milk"),
+            ["Zyx Oat Latte", "Zyx Matcha"],
+        )
+
+    def test_filter_and_or(self):
+        """Test that ingredient args are and-ed and alternatives or-ed."""
+        self.assertEqual(
+            self.filter_titles(
+                "ingredient=zyx espresso&ingredient=zyx oat milk"
+            ),
+            ["Zyx Oat Latte"],
+        )
+        self.assertEqual(
+            self.filter_titles("ingredient=zyx milk|zyx matcha"),
+            ["Zyx Flat White", "Zyx Matcha"],
+        )
+
+    def test_filter_exclude_ingredient(self):
+        """Test leaving out the drinks that use an ingredient."""
+        self.assertEqual(
+            self.filter_titles("exclude_ingredient=zyx oat milk"),
+            ["Zyx Flat White", "Zyx Water"],
+        )
+        self.assertEqual(
+            self.filter_titles(
+                "ingredient=zyx espresso&exclude_ingredient=zyx oat milk"
+            ),
+            ["Zyx Flat White"],
+        )
+
+    def test_filter_empty_ingredient_fail(self):
+        """Test failed filtering by a blank ingredient name."""
+        for query in (
+            "ingredient=",
+            "ingredient=zyx milk|",
+            "ingredient=%20",
+            "exclude_ingredient=",
+        ):
+            with self.subTest(query=query):
+                response = self.client().get(f"/drinks?{query}")
+
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(response.json["success"])
+
+    def test_filter_pagination(self):
+        """Test paging through filtered drinks with the limit and cursor."""
+        query = "ingredient=zyx oat milk|zyx milk&limit=2"
+        response = self.client().get(f"/drinks?{query}")
+        cursor = response.json["next_cursor"]
+        next_page = self.client().get(f"/drinks?{query}&cursor={cursor}")
+
+        self.assertEqual(
+            [drink["id"] for drink in response.json["drinks"]],
+            self.created_ids[:2],
+        )
+        self.assertEqual(
+            [drink["id"] for drink in next_page.json["drinks"]],
+            self.created_ids[2:3],
+        )
+        self.assertIsNone(next_page.json["next_cursor"])
+
+    def test_filter_follows_writes_without_reload(self):
+        """Test that local writes update the index in place."""
+        self.filter_titles("ingredient=zyx milk")
+        drink_id = self.created_ids[-1]
+        recipe = [{"name": "Zyx Milk", "parts": 1, "color": "#e8ddb8"}]
+
+        self.client().patch(
+            f"/drinks/{drink_id}",
+            json={"recipe": recipe},
+            headers=self.headers,
+        )
+        version = ingredient_index.version
+
+        with count_queries() as statements:
+            titles = self.filter_titles("ingredient=zyx milk")
+
+        self.assertEqual(titles, ["Zyx Flat White", "Zyx Water"])
+        self.assertEqual(ingredient_index.version, version)
+        self.assertEqual(len(statements), 2)
+
+    def test_filter_follows_other_process_writes(self):
+        """Test that a version bump by another process reloads the index."""
+        self.filter_titles("ingredient=zyx milk")
+        connection = sqlite3.connect(os.path.join(PROJECT_DIR, self.db_name))
+        with connection:
+            connection.execute(
+                "UPDATE ingredients SET name = 'Zyx Milk' WHERE drink_id = ?",
+                (self.created_ids[2],),
+            )
+            connection.execute("UPDATE menu_version SET version = version + 1")
+        connection.close()
+
+        self.assertEqual(
+            self.filter_titles("ingredient=zyx milk"),
+            ["Zyx Flat White", "Zyx Matcha"],
+        )
+
+
+class ServerTimingTestCase(StubAuthTestCase):
+    """This class contains test cases for per request timing."""
+
+    permissions = BARISTA_PERMISSIONS
+
+    def setUp(self):
+        """Set-up for ServerTimingTestCase."""
+        super().setUp()
+        auth.token_cache.clear()
+        timing.enable()
+
+    def tearDown(self):
+        """Executed after each test."""
+        timing.disable()
+        auth.token_cache.clear()
+        super().tearDown()
+
+    @staticmethod
+    def parse_metrics(header):
+        """Parses a Server-Timing header.
+
+        Args:
+            header: A str representing the Server-Timing header value
+
+        Returns:
+            metrics: A dict mapping metric names to dicts of their params
+        """
+        metrics = {}
+
+        for metric in header.split(", "):
+            name, *params = metric.split(";")
+            metrics[name] = dict(param.split("=", 1) for param in params)
+
+        return metrics
+
+    def test_server_timing_phases(self):
+        """Test that auth, sql and serialization phases are reported."""
+        with self.assertLogs(timing.logger, "INFO") as logs:
+            response = self.client().get(
+                "/drinks-detail?limit=2", headers=self.headers
+            )
+        metrics = self.parse_metrics(response.headers["Server-Timing"])
+        record = json.loads(logs.records[-1].getMessage())
+
+        self.assertEqual(
+            set(metrics),
+            {
+                "auth-header",
+                "auth-key",
+                "auth-decode",
+                "auth-permissions",
+                "serialize",
+                "db",
+                "total",
+            },
+        )
+        self.assertEqual(metrics["db"]["desc"], '"1 queries"')
+        self.assertEqual(record["path"], "/drinks-detail")
+        self.assertEqual(record["queries"], 1)
+        self.assertEqual(set(record["timings_ms"]), set(metrics))
+
+    def test_server_timing_cached_token(self):
+        """Test that a cached token skips the key lookup and decode phases."""
+        self.client().get("/drinks-detail?limit=1", headers=self.headers)
+
+        response = self.client().get(
+            "/drinks-detail?limit=1", headers=self.headers
+        )
+        metrics = self.parse_metrics(response.headers["Server-Timing"])
+
+        self.assertNotIn("auth-key", metrics)
+        self.assertNotIn("auth-decode", metrics)
+
+    def test_server_timing_disabled(self):
+        """Test that nothing is reported unless timing is enabled."""
+        timing.disable()
+
+        response = self.client().get("/drinks")
+
+        self.assertNotIn("Server-Timing", response.headers)
+
+
+class EngineSetupTestCase(unittest.TestCase):
+    """This class contains test cases for the engine built by setup_db.
+
+    Attributes:
+        app: A flask app from api.py
+        tmpdir: A TemporaryDirectory holding the db
+        db_path: A str representing the location of the temporary database
+    """
+
+    def setUp(self):
+        """Set-up for EngineSetupTestCase."""
+        self.app = app
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = f"sqlite:///{os.path.join(self.tmpdir.name, 'e.db')}"
+
+    def tearDown(self):
+        """Executed after each test."""
+        db.session.remove()
+        db.engine.dispose()
+        setup_db(self.app, f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}")
+        self.tmpdir.cleanup()
+
+    def get_pragma(self, name):
+        """Reads a pragma from a pooled connection.
+
+        Args:
+            name: A str representing the pragma to read
+
+        Returns:
+            value: The value of the pragma
+        """
+        with db.engine.connect() as connection:
+            return connection.execute(f"PRAGMA {name}").scalar()
+
+    def test_default_pragmas_applied(self):
+        """Test that every connection gets the default pragmas."""
+        setup_db(self.app, self.db_path)
+
+        self.assertEqual(self.get_pragma("journal_mode"), "wal")
+        self.assertEqual(self.get_pragma("synchronous"), 1)
+        self.assertEqual(self.get_pragma("busy_timeout"), 5000)
+        self.assertEqual(self.get_pragma("cache_size"), -20000)
+        self.assertEqual(db.engine.pool.size(), 5)
+
+    def test_overridden_options_applied(self):
+        """Test that pragmas and engine options can be overridden."""
+        setup_db(
+            self.app,
+            self.db_path,
+            engine_options={"pool_size": 2},
+            pragmas={"busy_timeout": 1234, "journal_mode": None},
+        )
+
+        self.assertEqual(self.get_pragma("busy_timeout"), 1234)
+        self.assertEqual(self.get_pragma("journal_mode"), "delete")
+        self.assertEqual(db.engine.pool.size(), 2)
+
+
+class MigrationTestCase(unittest.TestCase):
+    """This class contains test cases for migrating existing dbs.
+
+    Attributes:
+        app: A flask app from api.py
+        tmpdir: A TemporaryDirectory holding a copy of the starter db
+        db_file: A str representing the path of the copied starter db
+    """
+
+    def setUp(self):
+        """Set-up for MigrationTestCase."""
+        self.app = app
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmpdir.name, "starter.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), self.db_file)
+        setup_db(self.app, f"sqlite:///{self.db_file}")
+
+    def tearDown(self):
+        """Executed after each test."""
+        db.session.remove()
+        db.engine.dispose()
+        setup_db(self.app, f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}")
+        self.tmpdir.cleanup()
+
+    def get_indexes(self):
+        """Lists the indexes in the copied starter db.
+
+        Returns:
+            indexes: A set of str representing the index names
+        """
+        connection = sqlite3.connect(self.db_file)
+        rows = connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        ).fetchall()
+        connection.close()
+
+        return {row[0] for row in rows if not row[0].startswith("sqlite_")}
+
+    def test_migration_adds_indexes(self):
+        """Test that migrating an existing db adds the missing indexes."""
+        self.assertEqual(self.get_indexes(), set())
+
+        with self.app.app_context():
+            migrate_db()
+            migrate_db()
+            drinks = Drink.query.count()
+
+        self.assertEqual(
+            self.get_indexes(), {"ix_drinks_title", "ix_ingredients_drink_id"}
+        )
+        self.assertEqual(drinks, 5)
+
+    def test_recipe_lookup_uses_index(self):
+        """Test that loading a recipe no longer scans every ingredient."""
+        with self.app.app_context():
+            migrate_db()
+            plan = db.session.execute(
+                "EXPLAIN QUERY PLAN SELECT * FROM ingredients "
+                "WHERE drink_id = 1 ORDER BY id"
+            ).fetchall()
+
+        self.assertIn("ix_ingredients_drink_id", " ".join(map(str, plan)))
+
+    def test_concurrent_first_requests(self):
+        """Test that workers migrating a db at once all serve the menu."""
+        go_file = os.path.join(self.tmpdir.name, "go")
+        script = (
+            "import os, sys, time\n"
+            "from src import api\n"
+            "app = api.create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})\n"
+            "client = app.test_client()\n"
+            "print('ready', flush=True)\n"
+            "while not os.path.exists(sys.argv[2]):\n"
+            "    time.sleep(0.001)\n"
+            "print(client.get('/drinks').status_code)\n"
+        )
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    script,
+                    f"sqlite:///{self.db_file}",
+                    go_file,
+                ],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            for _ in range(4)
+        ]
+        for worker in workers:
+            worker.stdout.readline()
+        open(go_file, "w").close()
+        results = [worker.communicate(timeout=60) for worker in workers]
+
+        self.assertEqual(
+            [stdout.strip() for stdout, _ in results], ["200"] * 4, results
+        )
+
+    def test_concurrent_first_requests_in_threads(self):
+        """Test that threads migrating a db at once all serve the menu."""
+        barrier = threading.Barrier(8)
+        statuses = []
+
+        def first_request():
+            barrier.wait()
+            statuses.append(self.app.test_client().get("/drinks").status_code)
+
+        threads = [threading.Thread(target=first_request) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(statuses, [200] * 8)
+
+
+class OrphanTestCase(unittest.TestCase):
+    """This class contains test cases for deleting and purging ingredients.
+
+    Attributes:
+        app: A flask app from api.py
+        tmpdir: A TemporaryDirectory holding a copy of the starter db
+        db_file: A str representing the path of the copied starter db
+    """
+
+    def setUp(self):
+        """Set-up for OrphanTestCase."""
+        self.app = app
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmpdir.name, "starter.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), self.db_file)
+        setup_db(self.app, f"sqlite:///{self.db_file}")
+        with self.app.app_context():
+            migrate_db()
+
+    def tearDown(self):
+        """Executed after each test."""
+        db.session.remove()
+        db.engine.dispose()
+        setup_db(self.app, f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}")
+        self.tmpdir.cleanup()
+
+    def add_orphans(self, count):
+        """Inserts ingredients that don't belong to any drink.
+
+        They're inserted without enforcing foreign keys, as older versions of
+        the app did.
+
+        Args:
+            count: An int representing the number of orphans to insert
+        """
+        rows = [("Orphan", 1, "#fff", None) for _ in range(count - 1)]
+        rows.append(("Orphan", 1, "#fff", 10 ** 6))
+
+        connection = sqlite3.connect(self.db_file)
+        with connection:
+            connection.executemany(
+                "INSERT INTO ingredients (name, parts, color, drink_id) "
+                "VALUES (?, ?, ?, ?)",
+                rows,
+            )
+        connection.close()
+
+    def test_delete_drink_deletes_recipe_in_one_statement(self):
+        """Test that a drink's recipe is deleted with a single statement."""
+        with self.app.app_context():
+            drink = Drink.query.get(1)
+            drink.long_format()
+            with count_queries() as statements:
+                drink.delete()
+            remaining = Ingredient.query.filter_by(drink_id=1).count()
+            orphans = Ingredient.query.filter_by(drink_id=None).count()
+
+        writes = [
+            statement.split()[0]
+            for statement in statements
+            if "ingredients" in statement
+            and SEARCH_TABLE not in statement
+            and not statement.startswith("SELECT")
+        ]
+
+        self.assertEqual(writes, ["DELETE"])
+        self.assertEqual(remaining, 0)
+        self.assertEqual(orphans, 0)
+
+    def test_deleting_drink_around_models_cascades(self):
+        """Test that the db deletes the recipe of a drink deleted directly."""
+        setup_db(self.app, f"sqlite:///{self.tmpdir.name}/new.db")
+        with self.app.app_context():
+            migrate_db()
+            drink = Drink(title="Café")
+            drink.recipe.append(Ingredient(name="Milk", parts=1, color="#fff"))
+            drink.insert()
+
+            db.session.execute(Drink.__table__.delete())
+            db.session.commit()
+            ingredients = Ingredient.query.count()
+            documents = DrinkDocument.query.count()
+
+        self.assertEqual(ingredients, 0)
+        self.assertEqual(documents, 0)
+
+    def test_purge_orphans_in_batches(self):
+        """Test that the purge command deletes only orphaned ingredients."""
+        with self.app.app_context():
+            recipes = Ingredient.query.count()
+        self.add_orphans(5)
+
+        result = self.app.test_cli_runner().invoke(
+            args=["purge-orphans", "--batch-size", "2"]
+        )
+
+        with self.app.app_context():
+            remaining = Ingredient.query.count()
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Purged 5 orphaned ingredients", result.output)
+        self.assertEqual(remaining, recipes)
+
+    def test_purge_orphans_vacuum(self):
+        """Test that vacuuming after a purge reports the bytes reclaimed."""
+        self.add_orphans(5000)
+        runner = self.app.test_cli_runner()
+
+        result = runner.invoke(args=["purge-orphans", "--vacuum", "full"])
+        self.add_orphans(5000)
+        runner.invoke(args=["purge-orphans", "--vacuum", "incremental"])
+        self.add_orphans(5000)
+        incremental = runner.invoke(
+            args=["purge-orphans", "--vacuum", "incremental"]
+        )
+
+        for output in (result.output, incremental.output):
+            reclaimed = int(output.split("reclaimed ")[1].split()[0])
+            self.assertIn("Purged 5000 orphaned ingredients", output)
+            self.assertGreater(reclaimed, 0)
+
+
+class DrinkDocumentTestCase(unittest.TestCase):
+    """This class contains test cases for the stored drink documents.
+
+    Attributes:
+        app: A flask app from api.py
+        client: A test client for the flask app to use while testing
+        tmpdir: A TemporaryDirectory holding a copy of the starter db
+        db_file: A str representing the path of the copied starter db
+    """
+
+    def setUp(self):
+        """Set-up for DrinkDocumentTestCase."""
+        self.app = app
+        app.config["DEBUG"] = False
+        self.client = self.app.test_client
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_file = os.path.join(self.tmpdir.name, "starter.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), self.db_file)
+        setup_db(self.app, f"sqlite:///{self.db_file}")
+        menu_cache.clear()
+        with self.app.app_context():
+            migrate_db_once()
+
+    def tearDown(self):
+        """Executed after each test."""
+        app.config["JSONIFY_PRETTYPRINT_REGULAR"] = False
+        menu_cache.clear()
+        db.session.remove()
+        db.engine.dispose()
+        setup_db(self.app, f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}")
+        self.tmpdir.cleanup()
+
+    def assert_documents_match(self):
+        """Asserts every stored document matches its drink's formats."""
+        with self.app.app_context():
+            drinks = Drink.query.order_by(Drink.id).all()
+            documents = DrinkDocument.query.order_by(
+                DrinkDocument.drink_id
+            ).all()
+
+            self.assertEqual(
+                [document.drink_id for document in documents],
+                [drink.id for drink in drinks],
+            )
+            for drink, document in zip(drinks, documents):
+                self.assertEqual(
+                    json.loads(document.short_format), drink.short_format()
+                )
+                self.assertEqual(
+                    json.loads(document.long_format), drink.long_format()
+                )
+
+    def test_migration_builds_documents(self):
+        """Test that migrating an existing db builds every document."""
+        self.assert_documents_match()
+
+    def test_documents_served_as_jsonify_builds_them(self):
+        """Test that served documents match the formatted drinks' json."""
+        pages = {
+            "/drinks": (0, None),
+            "/drinks?limit=2": (0, 2),
+            "/drinks?cursor=Mg": (2, None),
+        }
+        for url, (after_id, limit) in pages.items():
+            response = self.client().get(url)
+            app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+            menu_cache.clear()
+            formatted = self.client().get(url)
+            app.config["JSONIFY_PRETTYPRINT_REGULAR"] = False
+
+            self.assertEqual(response.json, formatted.json)
+            with self.app.test_request_context(url):
+                drinks = (
+                    Drink.query.filter(Drink.id > after_id)
+                    .order_by(Drink.id)
+                    .limit(limit)
+                    .all()
+                )
+                expected = api.jsonify(
+                    {
+                        "success": True,
+                        "drinks": [drink.short_format() for drink in drinks],
+                        "next_cursor": response.json["next_cursor"],
+                    }
+                ).get_data()
+            self.assertEqual(response.data, expected)
+
+    def test_rows_formatted_as_objects_are(self):
+        """Test that drinks formatted from rows match the drinks' formats."""
+        with self.app.app_context():
+            Drink(title="Empty").insert()
+            drinks = Drink.query.order_by(Drink.id).all()
+            drink_ids = [drink.id for drink in reversed(drinks)]
+
+            for format_name in ("short_format", "long_format"):
+                expected = [getattr(drink, format_name)() for drink in drinks]
+                page = Drink.format_page(format_name)
+
+                self.assertEqual([drink for _, drink in page], expected)
+                self.assertEqual(
+                    Drink.format_many(format_name, drink_ids), expected[::-1],
+                )
+                self.assertEqual(
+                    Drink.format_page(format_name, drinks[1].id, 2), page[2:4],
+                )
+
+    def test_writes_keep_documents_in_sync(self):
+        """Test that inserts, updates and deletes refresh the documents."""
+        with self.app.app_context():
+            drink = Drink(title="Café")
+            drink.recipe.append(Ingredient(name="Milk", parts=1, color="#fff"))
+            drink.insert()
+            drink_id = drink.id
+        self.assert_documents_match()
+
+        with self.app.app_context():
+            drink = Drink.query.get(drink_id)
+            drink.title = "Flat White"
+            drink.update_recipe(
+                [{"name": "Foam", "parts": 2, "color": "#eee"}]
+            )
+            Drink.update()
+        self.assert_documents_match()
+
+        with self.app.app_context():
+            Drink.query.get(drink_id).delete()
+        self.assert_documents_match()
+
+    def test_rebuild_command_repairs_drift(self):
+        """Test that rebuilding restores documents changed around the app."""
+        etag = self.client().get("/drinks").headers["ETag"]
+        connection = sqlite3.connect(self.db_file)
+        with connection:
+            connection.execute(
+                "UPDATE drink_documents SET short_format = '{}'"
+            )
+            connection.execute(
+                "DELETE FROM drink_documents WHERE drink_id = 1"
+            )
+            connection.execute(
+                "UPDATE drinks SET title = 'Mocha' WHERE id = 2"
+            )
+        connection.close()
+
+        result = self.app.test_cli_runner().invoke(args=["rebuild-documents"])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Rebuilt the documents of 5 drinks", result.output)
+        self.assert_documents_match()
+
+        response = self.client().get(
+            "/drinks", headers={"If-None-Match": etag}
+        )
+        with self.app.app_context():
+            drinks = [drink.short_format() for drink in Drink.query.all()]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        self.assertEqual(response.json["drinks"], drinks)
+
+
+class AppFactoryTestCase(unittest.TestCase):
+    """This class contains test cases for creating apps with create_app.
+
+    Attributes:
+        tmpdir: A TemporaryDirectory holding copies of the starter db
+        apps: A list of the apps created by the test
+    """
+
+    def setUp(self):
+        """Set-up for AppFactoryTestCase."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.apps = []
+        menu_cache.clear()
+
+    def tearDown(self):
+        """Executed after each test."""
+        for test_app in self.apps:
+            with test_app.app_context():
+                db.session.remove()
+                db.engine.dispose()
+        menu_cache.clear()
+        self.tmpdir.cleanup()
+
+    def create_app(self, name):
+        """Creates an app bound to its own copy of the starter db.
+
+        Args:
+            name: A str naming the copy of the db
+
+        Returns:
+            app: A flask app from create_app
+        """
+        db_file = os.path.join(self.tmpdir.name, f"{name}.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), db_file)
+        test_app = api.create_app(
+            {"SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_file}"}
+        )
+        self.apps.append(test_app)
+
+        return test_app
+
+    def test_import_creates_nothing(self):
+        """Test that importing the api creates no app, engine or jose."""
+        script = (
+            "import sys\n"
+            "from src import api\n"
+            "from src.database import models\n"
+            "assert 'app' not in vars(api)\n"
+            "assert not list(models._engines)\n"
+            "assert 'jose' not in sys.modules\n"
+            "assert api.app is api.app\n"
+        )
+
+        result = subprocess.run(
+            [sys.executable, "-c", script],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        )
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+    def test_apps_use_their_own_dbs(self):
+        """Test that apps created side by side don't share a db."""
+        first, second = self.create_app("first"), self.create_app("second")
+        with first.app_context():
+            migrate_db_once()
+            Drink(title="Only First").insert()
+
+        first_titles = [
+            drink["title"]
+            for drink in first.test_client().get("/drinks").json["drinks"]
+        ]
+        second_titles = [
+            drink["title"]
+            for drink in second.test_client().get("/drinks").json["drinks"]
+        ]
+
+        self.assertIn("Only First", first_titles)
+        self.assertNotIn("Only First", second_titles)
+        self.assertEqual(len(first_titles), len(second_titles) + 1)
+
+    @unittest.skipUnless(hasattr(os, "fork"), "os.fork is not available")
+    def test_fork_gets_new_pool(self):
+        """Test that a forked worker doesn't reuse the parent's connections."""
+        test_app = self.create_app("fork")
+
+        with test_app.app_context():
+            drinks = Drink.query.count()
+            pool = db.engine.pool
+            pid = os.fork()
+
+            if pid == 0:  # pragma: no cover
+                try:
+                    fresh = db.engine.pool is not pool
+                    os._exit(
+                        0 if fresh and Drink.query.count() == drinks else 1
+                    )
+                except BaseException:  # pylint: disable=broad-except
+                    os._exit(2)
+
+            _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+class ReplicaTestCase(unittest.TestCase):
+    """This class contains test cases for reading drinks from a replica.
+
+    Attributes:
+        tmpdir: A TemporaryDirectory holding the db and its replica
+        app: A flask app from create_app reading from the replica
+        client: A test client for the flask app to use while testing
+    """
+
+    def setUp(self):
+        """Set-up for ReplicaTestCase."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, "primary.db")
+        replica_file = os.path.join(self.tmpdir.name, "replica.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), db_file)
+        self.app = api.create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": f"sqlite:///{db_file}",
+                "REPLICA_DATABASE_URI": f"sqlite:///{replica_file}",
+            }
+        )
+        self.client = self.app.test_client
+        menu_cache.clear()
+
+        with self.app.app_context():
+            copy_to_replica()
+
+    def tearDown(self):
+        """Executed after each test."""
+        with self.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+            db.get_engine(bind=REPLICA_BIND).dispose()
+        menu_cache.clear()
+        self.tmpdir.cleanup()
+
+    def get_titles(self, path):
+        """Lists the titles of the drinks an endpoint responds with.
+
+        Args:
+            path: A str representing the path of the endpoint
+
+        Returns:
+            titles: A list of str representing the titles of the drinks
+        """
+        response = self.client().get(path)
+
+        return [drink["title"] for drink in response.json["drinks"]]
+
+    def test_menu_read_from_replica(self):
+        """Test that the menu shows new drinks once they are copied."""
+        with self.app.app_context():
+            Drink(title="Cortado").insert()
+
+        stale = self.get_titles("/drinks")
+        stale_page = self.get_titles("/drinks?limit=100")
+        searched = self.get_titles("/drinks/search?q=cortado")
+        result = self.app.test_cli_runner().invoke(args=["copy-replica"])
+        fresh = self.get_titles("/drinks")
+
+        self.assertNotIn("Cortado", stale)
+        self.assertNotIn("Cortado", stale_page)
+        self.assertEqual(searched, ["Cortado"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Cortado", fresh)
+
+    def test_copy_migrates_db_first(self):
+        """Test that a replica copied from an unmigrated db has its tables."""
+        statuses = [
+            self.client().get(path).status_code
+            for path in ("/drinks", "/drinks", "/drinks?limit=2")
+        ]
+
+        self.assertEqual(statuses, [200, 200, 200])
+        with self.app.app_context():
+            tables = inspect(
+                db.get_engine(bind=REPLICA_BIND)
+            ).get_table_names()
+        self.assertIn("menu_version", tables)
+        self.assertIn("drink_documents", tables)
+
+    def test_request_reads_its_own_writes(self):
+        """Test that a request reads from the db once it has written."""
+        with self.app.test_request_context("/drinks"):
+            replica = db.get_engine(bind=REPLICA_BIND)
+            read_bind = db.session.get_bind()
+            Drink(title="Cortado").insert()
+            titles = [
+                drink["title"]
+                for _, drink in Drink.format_page("short_format")
+            ]
+            write_bind = db.session.get_bind()
+            copied = replica.execute(
+                "SELECT COUNT(*) FROM drinks WHERE title = 'Cortado'"
+            ).scalar()
+
+        self.assertIs(read_bind, replica)
+        self.assertIs(write_bind, db.get_engine(self.app))
+        self.assertIn("Cortado", titles)
+        self.assertEqual(copied, 0)
+
+    def test_other_requests_read_db(self):
+        """Test that requests to unmarked views only use the db."""
+        with self.app.test_request_context("/drinks/search"):
+            self.assertIs(db.session.get_bind(), db.engine)
+
+        with self.app.app_context():
+            self.assertIs(db.session.get_bind(), db.engine)
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                db.get_engine(bind=REPLICA_BIND).execute("DELETE FROM drinks")
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,318 @@
+"""Test objects used to test serving the app over ASGI with asgi.py.
+
+Usage: test_asgi.py
+
+Classes:
+    AsgiTestCase()
+"""
+
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from jwks_stub import BARISTA_PERMISSIONS, MANAGER_PERMISSIONS, StubJWKSServer
+from src.api import app, menu_cache
+from src.asgi import asgi
+from src.auth import auth
+from src.database.models import PROJECT_DIR, Drink, db, setup_db
+
+
+def http_scope(method, path, headers=None, query_string=b""):
+    """Builds the ASGI scope of an http request.
+
+    Args:
+        method: A str representing the request method
+        path: A str representing the request path
+        headers: A dict of the request headers, or None
+        query_string: A bytes object representing the query string
+
+    Returns:
+        scope: A dict representing the ASGI connection scope
+    """
+    return {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "root_path": "",
+        "query_string": query_string,
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+        "server": ("127.0.0.1", 8000),
+        "client": ("127.0.0.1", 50000),
+    }
+
+
+async def call_asgi(asgi_app, scope, body_chunks=(b"",)):
+    """Sends a request to an ASGI app and collects what it sends back.
+
+    Args:
+        asgi_app: The ASGI app to call
+        scope: A dict representing the ASGI connection scope
+        body_chunks: A sequence of bytes objects the body is received in
+
+    Returns:
+        messages: A list of dicts representing the messages the app sent
+    """
+    requests = [
+        {
+            "type": "http.request",
+            "body": chunk,
+            "more_body": i < len(body_chunks) - 1,
+        }
+        for i, chunk in enumerate(body_chunks)
+    ]
+    messages = []
+
+    async def receive():
+        await asyncio.sleep(0)
+        if requests:
+            return requests.pop(0)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await asgi_app(scope, receive, send)
+
+    return messages
+
+
+class AsgiTestCase(unittest.TestCase):
+    """This class contains the test cases for serving the app over ASGI.
+
+    Attributes:
+        server: A StubJWKSServer standing in for Auth0
+        asgi_app: An AsgiApp serving the flask app from api.py
+        client: A test client for the flask app to compare with
+        tmpdir: A TemporaryDirectory holding a copy of the starter db
+    """
+
+    def setUp(self):
+        """Set-up for AsgiTestCase."""
+        self.server = StubJWKSServer()
+        self.server.start()
+        self._jwks_cache = auth.jwks_cache
+        auth.jwks_cache = auth.JWKSCache(self.server.url)
+        auth.token_cache.clear()
+        app.config["DEBUG"] = False
+        self.asgi_app = asgi.AsgiApp(app, threads=4)
+        self.client = app.test_client
+        self.tmpdir = tempfile.TemporaryDirectory()
+        db_file = os.path.join(self.tmpdir.name, "starter.db")
+        shutil.copy(os.path.join(PROJECT_DIR, "starter.db"), db_file)
+        setup_db(app, f"sqlite:///{db_file}")
+        menu_cache.clear()
+
+    def tearDown(self):
+        """Executed after each test."""
+        self.asgi_app.executor.shutdown()
+        auth.jwks_cache.clear()
+        auth.jwks_cache = self._jwks_cache
+        auth.token_cache.clear()
+        self.server.stop()
+        menu_cache.clear()
+        db.session.remove()
+        db.engine.dispose()
+        setup_db(app, f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}")
+        self.tmpdir.cleanup()
+
+    def request(self, method, path, headers=None, body_chunks=(b"",)):
+        """Sends a request through the ASGI app.
+
+        Args:
+            method: A str representing the request method
+            path: A str representing the request path and query string
+            headers: A dict of the request headers, or None
+            body_chunks: A sequence of bytes objects the body is sent in
+
+        Returns:
+            status: An int representing the response status code
+            headers: A dict of the response headers
+            body: A bytes object representing the response body
+            messages: A list of dicts representing the messages sent
+        """
+        path, _, query_string = path.partition("?")
+        scope = http_scope(method, path, headers, query_string.encode())
+        messages = asyncio.run(call_asgi(self.asgi_app, scope, body_chunks))
+        start = messages[0]
+
+        self.assertEqual(start["type"], "http.response.start")
+        self.assertFalse(messages[-1].get("more_body", False))
+
+        return (
+            start["status"],
+            {
+                name.decode(): value.decode()
+                for name, value in start["headers"]
+            },
+            b"".join(message.get("body", b"") for message in messages[1:]),
+            messages,
+        )
+
+    def test_responses_match_wsgi(self):
+        """Test that routes and error handlers answer as they do over WSGI."""
+        for method, path in (
+            ("GET", "/drinks"),
+            ("GET", "/drinks?limit=2"),
+            ("GET", "/drinks-detail"),
+            ("DELETE", "/drinks/1"),
+            ("GET", "/missing"),
+        ):
+            with self.subTest(method=method, path=path):
+                status, headers, body, _ = self.request(method, path)
+                expected = self.client().open(path, method=method)
+
+                self.assertEqual(status, expected.status_code)
+                self.assertEqual(
+                    headers["content-type"], expected.content_type
+                )
+                self.assertEqual(body, expected.data)
+
+    def test_chunked_body_read(self):
+        """Test that bodies past the buffer size are read by the thread."""
+        token = self.server.mint_token(MANAGER_PERMISSIONS)
+        body = json.dumps(
+            {"title": "Cortado", "recipe": [{"name": "Milk", "parts": 1}]}
+        ).encode()
+        chunks = [body[i : i + 7] for i in range(0, len(body), 7)]
+
+        with mock.patch.object(asgi, "ASGI_BUFFER_SIZE", 16):
+            status, _, response, _ = self.request(
+                "POST",
+                "/drinks",
+                {
+                    "Authorization": f"Bearer {token}",
+                    "Content-Type": "application/json",
+                },
+                chunks,
+            )
+
+        self.assertEqual(status, 200, response)
+        self.assertEqual(json.loads(response)["new_drink"]["title"], "Cortado")
+
+    def test_stream_sent_as_produced(self):
+        """Test that a streamed response is sent in several messages."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+
+        status, headers, body, messages = self.request(
+            "GET",
+            "/drinks-detail",
+            {
+                "Authorization": f"Bearer {token}",
+                "Accept": "application/x-ndjson",
+            },
+        )
+
+        with app.app_context():
+            expected = [
+                drink.long_format()
+                for drink in Drink.query.order_by(Drink.id).all()
+            ]
+        self.assertEqual(status, 200)
+        self.assertEqual(headers["content-type"], "application/x-ndjson")
+        self.assertNotIn("content-length", headers)
+        self.assertGreater(len(messages), 2)
+        self.assertEqual(
+            [json.loads(line) for line in body.splitlines()], expected
+        )
+
+    def test_write_callable_sent_first(self):
+        """Test that data given to the write callable precedes the body."""
+
+        def legacy_app(environ, start_response):
+            headers = [("Content-Type", "text/plain")]
+            if environ["PATH_INFO"] == "/sized":
+                headers.append(("Content-Length", "12"))
+            write = start_response("200 OK", headers)
+            write(b"Hello")
+            write(b", ")
+            return [b"world"]
+
+        legacy = asgi.AsgiApp(legacy_app, threads=1, prefetch_keys=False)
+
+        try:
+            for path in ("/sized", "/streamed"):
+                with self.subTest(path=path):
+                    messages = asyncio.run(
+                        call_asgi(legacy, http_scope("GET", path))
+                    )
+
+                    self.assertEqual(messages[0]["status"], 200)
+                    self.assertEqual(
+                        b"".join(
+                            message.get("body", b"")
+                            for message in messages[1:]
+                        ),
+                        b"Hello, world",
+                    )
+        finally:
+            legacy.executor.shutdown()
+
+    def test_key_fetched_without_blocking_thread(self):
+        """Test that the key set is fetched on the loop, not by the thread."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+
+        with mock.patch.object(
+            auth.jwks_cache, "refresh", side_effect=AssertionError
+        ):
+            status, _, _, _ = self.request(
+                "GET", "/drinks-detail", {"Authorization": f"Bearer {token}"}
+            )
+
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.fetch_count, 1)
+
+    def test_lifespan_keeps_keys_fresh(self):
+        """Test that the key set is prefetched on the loop while serving."""
+        auth.jwks_cache = auth.JWKSCache(self.server.url, prefetch=True)
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+
+        async def serve():
+            queue = asyncio.Queue()
+            sent = []
+
+            async def send(message):
+                sent.append(message)
+
+            queue.put_nowait({"type": "lifespan.startup"})
+            lifespan = asyncio.ensure_future(
+                self.asgi_app({"type": "lifespan"}, queue.get, send)
+            )
+            for _ in range(500):
+                if self.server.fetch_count:
+                    break
+                await asyncio.sleep(0.01)
+            messages = await call_asgi(
+                self.asgi_app,
+                http_scope(
+                    "GET",
+                    "/drinks-detail",
+                    {"Authorization": f"Bearer {token}"},
+                ),
+            )
+            queue.put_nowait({"type": "lifespan.shutdown"})
+            await lifespan
+
+            return sent, messages
+
+        sent, messages = asyncio.run(serve())
+
+        self.assertEqual(messages[0]["status"], 200)
+        self.assertEqual(self.server.fetch_count, 1)
+        self.assertIsNone(auth.jwks_cache._refresher)
+        self.assertEqual(
+            [message["type"] for message in sent],
+            ["lifespan.startup.complete", "lifespan.shutdown.complete"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
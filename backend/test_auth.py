@@ -0,0 +1,414 @@
+"""Test objects used to test the behavior of the auth helpers in auth.py.
+
+Usage: test_auth.py
+
+Classes:
+    JWKSCacheTestCase()
+    JWKSSnapshotTestCase()
+    JWKSPrefetchTestCase()
+    TokenCacheTestCase()
+    RequiresAuthTestCase()
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from jwks_stub import BARISTA_PERMISSIONS, StubJWKSServer
+from src.api import app
+from src.auth import auth
+from src.database.models import PROJECT_DIR, setup_db
+
+
+class FakeClock:
+    """A manually advanced clock.
+
+    Attributes:
+        now: A float representing the current time in seconds
+    """
+
+    def __init__(self):
+        """Set-up for FakeClock."""
+        self.now = 0.0
+
+    def __call__(self):
+        """Returns the current time."""
+        return self.now
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class contains the test cases for the json web key set cache.
+
+    Attributes:
+        server: A StubJWKSServer standing in for Auth0
+        clock: A FakeClock driving the cache
+        cache: The JWKSCache under test
+    """
+
+    def setUp(self):
+        """Set-up for JWKSCacheTestCase."""
+        self.server = StubJWKSServer()
+        self.server.start()
+        self.clock = FakeClock()
+        self.cache = auth.JWKSCache(
+            self.server.url, ttl=60, min_refresh_interval=10, clock=self.clock
+        )
+
+    def tearDown(self):
+        """Executed after each test."""
+        self.cache.clear()
+        self.server.stop()
+
+    def test_fetches_once_per_ttl_under_load(self):
+        """Test that concurrent lookups share a single fetch per ttl."""
+
+        def lookup():
+            for _ in range(50):
+                self.assertIsNotNone(self.cache.get_key(self.server.kid))
+
+        threads = [threading.Thread(target=lookup) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.fetch_count, 1)
+
+        self.clock.now = 59
+        self.cache.get_key(self.server.kid)
+        self.assertEqual(self.server.fetch_count, 1)
+
+        self.clock.now = 60
+        self.cache.get_key(self.server.kid)
+        self.assertEqual(self.server.fetch_count, 2)
+
+    def test_unknown_kid_refresh_is_rate_limited(self):
+        """Test that unknown key ids can't trigger a fetch per request."""
+        self.cache.get_key(self.server.kid)
+
+        for _ in range(20):
+            self.assertIsNone(self.cache.get_key("unknown"))
+        self.assertEqual(self.server.fetch_count, 1)
+
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get_key("unknown"))
+        self.assertEqual(self.server.fetch_count, 2)
+
+    def test_refreshes_reuse_connection(self):
+        """Test that refreshes are made over one keep-alive connection."""
+        for second in range(0, 300, 60):
+            self.clock.now = second
+            self.cache.get_key(self.server.kid)
+
+        self.assertEqual(self.server.fetch_count, 5)
+        self.assertEqual(self.server.connection_count, 1)
+
+    def test_stale_keys_kept_when_refresh_fails(self):
+        """Test that cached keys survive a failed refresh."""
+        self.cache.get_key(self.server.kid)
+        self.server.stop()
+        self.clock.now = 60
+
+        self.assertIsNotNone(self.cache.get_key(self.server.kid))
+
+    def test_keys_rejected_past_max_stale(self):
+        """Test that keys that couldn't be refreshed are dropped in time."""
+        self.cache.get_key(self.server.kid)
+        self.server.available = False
+        self.clock.now = 659
+        self.assertIsNotNone(self.cache.get_key(self.server.kid))
+
+        self.clock.now = 660
+        self.assertIsNone(self.cache.get_key(self.server.kid))
+
+        self.server.available = True
+        self.clock.now = 670
+        self.assertIsNotNone(self.cache.get_key(self.server.kid))
+
+
+class JWKSSnapshotTestCase(unittest.TestCase):
+    """This class contains the test cases for the persisted key set.
+
+    Attributes:
+        server: A StubJWKSServer standing in for Auth0
+        clock: A FakeClock driving the caches
+        tmpdir: A TemporaryDirectory holding the snapshot
+        snapshot_path: A str representing the location of the snapshot
+    """
+
+    def setUp(self):
+        """Set-up for JWKSSnapshotTestCase."""
+        self.server = StubJWKSServer()
+        self.server.start()
+        self.clock = FakeClock()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.tmpdir.name, "jwks.json")
+
+    def tearDown(self):
+        """Executed after each test."""
+        self.server.stop()
+        self.tmpdir.cleanup()
+
+    def make_cache(self, **kwargs):
+        """Creates a cache sharing the snapshot, as a new process would.
+
+        Args:
+            kwargs: Any extra arguments passed to the cache
+
+        Returns:
+            cache: A JWKSCache pointed at the stub server
+        """
+        return auth.JWKSCache(
+            self.server.url,
+            ttl=60,
+            min_refresh_interval=10,
+            clock=self.clock,
+            snapshot_path=self.snapshot_path,
+            **kwargs,
+        )
+
+    def test_new_process_starts_from_snapshot(self):
+        """Test that a fresh snapshot spares new processes a fetch."""
+        self.make_cache().get_key(self.server.kid)
+        self.clock.now = 30
+
+        for _ in range(3):
+            self.assertIsNotNone(self.make_cache().get_key(self.server.kid))
+
+        self.assertEqual(self.server.fetch_count, 1)
+        self.assertEqual(os.stat(self.snapshot_path).st_mode & 0o077, 0)
+
+    def test_stale_snapshot_refetched(self):
+        """Test that a snapshot older than the ttl is fetched again."""
+        self.make_cache().get_key(self.server.kid)
+        self.clock.now = 60
+
+        self.make_cache().get_key(self.server.kid)
+
+        self.assertEqual(self.server.fetch_count, 2)
+
+    def test_corrupt_snapshot_ignored(self):
+        """Test that an unreadable snapshot falls back to fetching."""
+        with open(self.snapshot_path, "w") as snapshot_file:
+            snapshot_file.write('{"fetched_at": 0, "jwks": {"keys": [{}]}}')
+
+        self.assertIsNotNone(self.make_cache().get_key(self.server.kid))
+        self.assertEqual(self.server.fetch_count, 1)
+
+
+class JWKSPrefetchTestCase(JWKSSnapshotTestCase):
+    """This class contains the test cases for refreshing keys in advance.
+
+    Attributes:
+        server: A StubJWKSServer standing in for Auth0
+        clock: A FakeClock driving the caches
+        tmpdir: A TemporaryDirectory holding the snapshot
+        snapshot_path: A str representing the location of the snapshot
+    """
+
+    def test_prefetch_refreshes_ahead_of_ttl(self):
+        """Test that the key set is refreshed before it goes stale."""
+        cache = self.make_cache(refresh_ahead=10)
+        cache.prefetch_now()
+        self.assertEqual(cache.next_refresh_in(), 50)
+
+        self.clock.now = 49
+        cache.prefetch_now()
+        self.assertEqual(self.server.fetch_count, 1)
+
+        self.clock.now = 50
+        cache.prefetch_now()
+        self.assertEqual(self.server.fetch_count, 2)
+        self.assertEqual(cache.next_refresh_in(), 50)
+
+    def test_prefetch_adopts_other_process_refresh(self):
+        """Test that processes sharing a snapshot fetch only once per ttl."""
+        caches = [self.make_cache(refresh_ahead=10) for _ in range(4)]
+        caches[0].prefetch_now()
+        self.clock.now = 50
+
+        for cache in caches:
+            cache.prefetch_now()
+
+        self.assertEqual(self.server.fetch_count, 2)
+        for cache in caches:
+            self.assertEqual(cache.next_refresh_in(), 50)
+
+    def test_refresher_serves_stale_keys_without_fetching(self):
+        """Test that lookups leave refreshing to the background thread."""
+        cache = self.make_cache(prefetch=True, refresh_ahead=10)
+        self.assertIsNotNone(cache.get_key(self.server.kid))
+
+        self.clock.now = 120
+        self.assertIsNotNone(cache.get_key(self.server.kid))
+        cache.clear()
+
+        self.assertEqual(self.server.fetch_count, 1)
+
+    def test_refresher_keeps_retrying_when_auth0_is_down(self):
+        """Test that a failed prefetch keeps the keys and is retried."""
+        cache = self.make_cache()
+        cache.prefetch_now()
+        self.server.available = False
+        self.clock.now = 60
+
+        self.assertFalse(cache.prefetch_now())
+        self.assertIsNotNone(cache.get_key(self.server.kid))
+
+    def test_lookup_refreshes_when_refresher_falls_behind(self):
+        """Test that lookups stop waiting on a failing background thread."""
+        cache = self.make_cache(prefetch=True, refresh_ahead=10, max_stale=30)
+        cache.get_key(self.server.kid)
+        self.server.available = False
+        self.clock.now = 89
+        self.assertIsNotNone(cache.get_key(self.server.kid))
+        self.assertEqual(self.server.fetch_count, 1)
+
+        self.clock.now = 90
+        self.assertIsNone(cache.get_key(self.server.kid))
+        self.clock.now = 95
+        self.assertIsNone(cache.get_key(self.server.kid))
+        self.assertEqual(self.server.fetch_count, 2)
+
+        self.server.available = True
+        self.clock.now = 100
+        self.assertIsNotNone(cache.get_key(self.server.kid))
+        cache.clear()
+
+        self.assertEqual(self.server.fetch_count, 3)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class contains the test cases for the verified token cache.
+
+    Attributes:
+        clock: A FakeClock driving the cache
+        cache: The TokenCache under test
+    """
+
+    def setUp(self):
+        """Set-up for TokenCacheTestCase."""
+        self.clock = FakeClock()
+        self.cache = auth.TokenCache(max_size=2, clock=self.clock)
+
+    def tearDown(self):
+        """Executed after each test."""
+
+    def test_hit_until_expiry(self):
+        """Test that a payload is served until its token expires."""
+        payload = {"exp": 100, "permissions": []}
+        self.cache.put("token", payload)
+
+        self.clock.now = 99
+        self.assertEqual(self.cache.get("token"), payload)
+
+        self.clock.now = 100
+        self.assertIsNone(self.cache.get("token"))
+        self.assertEqual(self.cache.stats()["expirations"], 1)
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_least_recently_used_evicted(self):
+        """Test that the least recently used payload is evicted when full."""
+        for token in ("a", "b"):
+            self.cache.put(token, {"exp": 100})
+        self.cache.get("a")
+        self.cache.put("c", {"exp": 100})
+
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("c"))
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["size"], 2)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(stats["hits"], 3)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.75)
+
+    def test_payload_without_exp_not_cached(self):
+        """Test that tokens without an expiry are never cached."""
+        self.cache.put("token", {"permissions": []})
+
+        self.assertIsNone(self.cache.get("token"))
+
+
+class RequiresAuthTestCase(unittest.TestCase):
+    """This class contains test cases for authenticated requests.
+
+    Attributes:
+        server: A StubJWKSServer standing in for Auth0
+        app: A flask app from api.py
+        client: A test client for the flask app to use while testing
+        db_path: A str representing the location of the test database
+    """
+
+    def setUp(self):
+        """Set-up for RequiresAuthTestCase."""
+        self.server = StubJWKSServer()
+        self.server.start()
+        self._jwks_cache = auth.jwks_cache
+        auth.jwks_cache = auth.JWKSCache(self.server.url)
+        auth.token_cache.clear()
+        self.app = app
+        app.config["DEBUG"] = False
+        self.client = self.app.test_client
+        self.db_path = f"sqlite:///{PROJECT_DIR}/test.db"
+        setup_db(self.app, self.db_path)
+
+    def tearDown(self):
+        """Executed after each test."""
+        auth.jwks_cache.clear()
+        auth.jwks_cache = self._jwks_cache
+        auth.token_cache.clear()
+        self.server.stop()
+
+    def test_key_set_fetched_once_across_requests(self):
+        """Test that many authenticated requests share one key set fetch."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        for _ in range(10):
+            response = self.client().get("/drinks-detail", headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.server.fetch_count, 1)
+
+    def test_verified_token_cached(self):
+        """Test that a repeated token is verified only once."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        for _ in range(5):
+            response = self.client().get("/drinks-detail", headers=headers)
+            self.assertEqual(response.status_code, 200)
+
+        stats = auth.token_cache.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 4)
+
+    def test_cached_token_permissions_checked(self):
+        """Test that a cached token is still checked for permissions."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS)
+        headers = {"Authorization": f"Bearer {token}"}
+        self.client().get("/drinks-detail", headers=headers)
+
+        response = self.client().delete("/drinks/1", headers=headers)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response.json.get("error_code"), "forbidden")
+        self.assertEqual(auth.token_cache.stats()["hits"], 1)
+
+    def test_unknown_kid_fail(self):
+        """Test failed request when the token was signed by an unknown key."""
+        token = self.server.mint_token(BARISTA_PERMISSIONS, kid="unknown")
+        headers = {"Authorization": f"Bearer {token}"}
+
+        response = self.client().get("/drinks-detail", headers=headers)
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json.get("error_code"), "invalid_header")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+"""Test objects used to test the streaming parsers in bulk.py.
+
+Usage: test_bulk.py
+
+Classes:
+    IterJSONArrayTestCase()
+    IterNDJSONTestCase()
+"""
+
+import io
+import json
+import unittest
+
+from src.bulk.bulk import iter_json_array, iter_ndjson
+
+ITEMS = [
+    {"title": "Café au lait", "recipe": [{"name": "Milk", "parts": 1}]},
+    12345,
+    "text, with [brackets]",
+    [1, 2],
+    None,
+    True,
+]
+
+
+class IterJSONArrayTestCase(unittest.TestCase):
+    """This class contains the test cases for the json array parser."""
+
+    def test_items_split_across_chunks(self):
+        """Test that items are parsed whatever the chunk boundaries."""
+        body = json.dumps(ITEMS, ensure_ascii=False).encode()
+
+        for chunk_size in (1, 2, 3, 7, 64, 4096):
+            items = iter_json_array(io.BytesIO(body), chunk_size)
+            self.assertEqual(list(items), ITEMS)
+
+    def test_empty_array(self):
+        """Test that an empty array yields nothing."""
+        self.assertEqual(list(iter_json_array(io.BytesIO(b" [ ] "))), [])
+
+    def test_items_parsed_before_stream_ends(self):
+        """Test that an item is yielded without reading the whole body."""
+        body = io.BytesIO(b'[{"title": "Mocha"}, ' + b" " * 100000 + b"]")
+        items = iter_json_array(body, chunk_size=64)
+
+        self.assertEqual(next(items), {"title": "Mocha"})
+        self.assertLess(body.tell(), 1000)
+
+    def test_malformed_array_fail(self):
+        """Test that a malformed body raises a ValueError."""
+        for body in (b"", b"{}", b"[1,", b"[1 2]", b"[1]x", b"[1,]"):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.BytesIO(body), chunk_size=2))
+
+
+class IterNDJSONTestCase(unittest.TestCase):
+    """This class contains the test cases for the ndjson parser."""
+
+    def test_lines_split_across_chunks(self):
+        """Test that lines are parsed whatever the chunk boundaries."""
+        lines = [json.dumps(item, ensure_ascii=False) for item in ITEMS]
+        body = ("\n".join(lines) + "\n\n").encode()
+
+        for chunk_size in (1, 3, 64):
+            items = iter_ndjson(io.BytesIO(body), chunk_size)
+            self.assertEqual(list(items), ITEMS)
+
+    def test_malformed_line_fail(self):
+        """Test that a malformed line raises a ValueError."""
+        with self.assertRaises(ValueError):
+            list(iter_ndjson(io.BytesIO(b'{"title": "Mocha"}\n{"title"\n')))
+
+
+if __name__ == "__main__":
+    unittest.main()
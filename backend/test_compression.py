@@ -0,0 +1,119 @@
+"""Test objects used to test the response compression in compression.py.
+
+Usage: test_compression.py
+
+Classes:
+    CompressionTestCase()
+"""
+
+import gzip
+import os
+import unittest
+
+from src.api import app, menu_cache
+from src.compression import compression
+from src.database.models import PROJECT_DIR, MenuVersion, db, setup_db
+
+
+class CompressionTestCase(unittest.TestCase):
+    """This class contains the test cases for compressing responses.
+
+    Attributes:
+        app: A flask app from api.py
+        client: A test client for the flask app to use while testing
+        db_path: A str representing the location of the test database
+        min_size: An int representing the compression threshold to restore
+    """
+
+    def setUp(self):
+        """Set-up for CompressionTestCase."""
+        self.app = app
+        app.config["DEBUG"] = False
+        self.client = self.app.test_client
+        self.db_path = f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}"
+        setup_db(self.app, self.db_path)
+        menu_cache.clear()
+        self.min_size = compression.COMPRESSION_MIN_SIZE
+        compression.COMPRESSION_MIN_SIZE = 0
+
+    def tearDown(self):
+        """Executed after each test."""
+        compression.COMPRESSION_MIN_SIZE = self.min_size
+        menu_cache.clear()
+
+    def test_gzip_negotiated(self):
+        """Test that a client accepting gzip gets a gzipped menu."""
+        plain = self.client().get("/drinks")
+        response = self.client().get(
+            "/drinks", headers={"Accept-Encoding": "gzip"}
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertIn("Accept-Encoding", response.vary)
+        self.assertIn("Accept-Encoding", plain.vary)
+        self.assertEqual(response.get_etag()[0], f"{plain.get_etag()[0]}-gzip")
+
+    @unittest.skipIf(compression.brotli is None, "brotli is not installed")
+    def test_brotli_preferred(self):
+        """Test that brotli is picked over gzip when both are accepted."""
+        plain = self.client().get("/drinks")
+        response = self.client().get(
+            "/drinks", headers={"Accept-Encoding": "gzip, deflate, br"}
+        )
+
+        self.assertEqual(response.headers["Content-Encoding"], "br")
+        self.assertEqual(
+            compression.brotli.decompress(response.data), plain.data
+        )
+
+    def test_refused_encoding_not_used(self):
+        """Test that encodings with a quality of 0 are not used."""
+        response = self.client().get(
+            "/drinks", headers={"Accept-Encoding": "gzip;q=0, identity"}
+        )
+
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", response.vary)
+
+    def test_small_body_not_compressed(self):
+        """Test that bodies under the threshold are sent as they are."""
+        compression.COMPRESSION_MIN_SIZE = 1 << 30
+        response = self.client().get(
+            "/drinks", headers={"Accept-Encoding": "gzip"}
+        )
+
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertIn("Accept-Encoding", response.vary)
+
+    def test_cached_variant_reused(self):
+        """Test that a cached menu is compressed once per encoding."""
+        headers = {"Accept-Encoding": "gzip"}
+        self.client().get("/drinks", headers=headers)
+
+        with self.app.app_context():
+            key = (str(db.engine.url), "short_format")
+            cached_body = menu_cache.get(key, MenuVersion.current())
+        variant = cached_body.compressed_variants["gzip"]
+        cached_body.compressed_variants["gzip"] = gzip.compress(b"reused")
+        response = self.client().get("/drinks", headers=headers)
+
+        self.assertEqual(gzip.decompress(variant), cached_body.body)
+        self.assertEqual(gzip.decompress(response.data), b"reused")
+
+    def test_compressed_not_modified(self):
+        """Test that a compressed variant's etag gets a 304."""
+        headers = {"Accept-Encoding": "gzip"}
+        etag = self.client().get("/drinks", headers=headers).get_etag()[0]
+
+        response = self.client().get(
+            "/drinks", headers={**headers, "If-None-Match": f'"{etag}"'}
+        )
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+
+if __name__ == "__main__":
+    unittest.main()
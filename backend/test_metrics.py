@@ -0,0 +1,232 @@
+"""Test objects used to test the behavior of the metrics in metrics.py.
+
+Usage: test_metrics.py
+
+Classes:
+    MetricsRegistryTestCase()
+    MetricsEndpointTestCase()
+"""
+
+import os
+import tempfile
+import unittest
+
+from src.api import app
+from src.database.models import PROJECT_DIR, setup_db
+from src.metrics import metrics
+
+
+class FakeClock:
+    """A manually advanced clock.
+
+    Attributes:
+        now: A float representing the current time in seconds
+    """
+
+    def __init__(self):
+        """Set-up for FakeClock."""
+        self.now = 0.0
+
+    def __call__(self):
+        """Returns the current time."""
+        return self.now
+
+
+def parse_samples(text):
+    """Parses the samples out of a prometheus text exposition.
+
+    Args:
+        text: A str representing the metrics exposition
+
+    Returns:
+        samples: A dict mapping each sample line's name and labels to its
+            value
+    """
+    samples = {}
+
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            sample, value = line.rsplit(" ", 1)
+            samples[sample] = float(value)
+
+    return samples
+
+
+class MetricsRegistryTestCase(unittest.TestCase):
+    """This class contains the test cases for counting and sharing metrics.
+
+    Attributes:
+        tmpdir: A TemporaryDirectory shared by the registries
+        clock: A FakeClock driving the flush interval
+    """
+
+    def setUp(self):
+        """Set-up for MetricsRegistryTestCase."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        """Executed after each test."""
+        self.tmpdir.cleanup()
+
+    def make_registry(self, process_id):
+        """Creates a registry standing in for one worker process.
+
+        Args:
+            process_id: A str naming the worker
+
+        Returns:
+            registry: A MetricsRegistry sharing the temporary directory
+        """
+        return metrics.MetricsRegistry(
+            self.tmpdir.name,
+            flush_interval=1,
+            clock=self.clock,
+            process_id=process_id,
+        )
+
+    def test_histogram_buckets_cumulative(self):
+        """Test that histogram buckets are rendered cumulatively."""
+        registry = metrics.MetricsRegistry(None)
+        labels = (("method", "GET"), ("route", "/drinks"))
+        for seconds in (0.001, 0.02, 0.02, 30):
+            registry.observe(
+                "cafe_request_duration_seconds",
+                seconds,
+                metrics.LATENCY_BUCKETS,
+                labels,
+            )
+
+        samples = parse_samples(registry.render())
+        series = 'method="GET",route="/drinks"'
+
+        bucket = f"cafe_request_duration_seconds_bucket{{{series},le="
+        self.assertEqual(samples[f'{bucket}"0.005"}}'], 1)
+        self.assertEqual(samples[f'{bucket}"0.025"}}'], 3)
+        self.assertEqual(samples[f'{bucket}"10"}}'], 3)
+        self.assertEqual(samples[f'{bucket}"+Inf"}}'], 4)
+        self.assertEqual(
+            samples[f"cafe_request_duration_seconds_count{{{series}}}"], 4
+        )
+
+    def test_processes_summed_through_directory(self):
+        """Test that a scrape of any worker reports every worker's counts."""
+        workers = [self.make_registry(f"worker-{i}") for i in range(3)]
+        for i, registry in enumerate(workers):
+            registry.inc("cafe_auth_failures_total", (("error_code", "x"),), i)
+            registry.flush()
+
+        for registry in workers:
+            samples = parse_samples(registry.render())
+            self.assertEqual(
+                samples['cafe_auth_failures_total{error_code="x"}'], 3
+            )
+
+    def test_flush_rate_limited(self):
+        """Test that counts are written at most once per flush interval."""
+        worker, scraper = self.make_registry("a"), self.make_registry("b")
+        labels = (("error_code", "x"),)
+        worker.inc("cafe_auth_failures_total", labels)
+        worker.flush()
+        worker.inc("cafe_auth_failures_total", labels)
+        worker.flush()
+
+        samples = parse_samples(scraper.render())
+        self.assertEqual(
+            samples['cafe_auth_failures_total{error_code="x"}'], 1
+        )
+
+        self.clock.now = 1
+        worker.flush()
+
+        samples = parse_samples(scraper.render())
+        self.assertEqual(
+            samples['cafe_auth_failures_total{error_code="x"}'], 2
+        )
+
+    def test_cache_hit_ratio(self):
+        """Test that hit ratios are derived from the summed lookups."""
+
+        class Cache:
+            hits = 3
+            misses = 1
+
+        registry = metrics.MetricsRegistry(None)
+        registry.add_collector(metrics.cache_collector({"menu": Cache}))
+
+        samples = parse_samples(registry.render())
+
+        self.assertEqual(samples['cafe_cache_hit_ratio{cache="menu"}'], 0.75)
+
+    def test_label_values_escaped(self):
+        """Test that quotes and backslashes in label values are escaped."""
+        self.assertEqual(
+            metrics.format_labels((("route", 'a"b\\c'),)),
+            '{route="a\\"b\\\\c"}',
+        )
+
+
+class MetricsEndpointTestCase(unittest.TestCase):
+    """This class contains test cases for the metrics endpoint.
+
+    Attributes:
+        app: A flask app from api.py
+        client: A test client for the flask app to use while testing
+        db_path: A str representing the location of the test database
+    """
+
+    def setUp(self):
+        """Set-up for MetricsEndpointTestCase."""
+        self.app = app
+        app.config["DEBUG"] = False
+        self.client = self.app.test_client
+        self.db_path = f"sqlite:///{os.path.join(PROJECT_DIR, 'test.db')}"
+        setup_db(self.app, self.db_path)
+        metrics.registry.clear()
+
+    def tearDown(self):
+        """Executed after each test."""
+        metrics.registry.clear()
+
+    def test_requests_and_queries_counted(self):
+        """Test that requests are counted per route, status and queries."""
+        self.client().get("/drinks")
+
+        response = self.client().get("/metrics")
+        samples = parse_samples(response.data.decode())
+        series = 'method="GET",route="/drinks"'
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        self.assertEqual(
+            samples[f'cafe_requests_total{{{series},status="200"}}'], 1
+        )
+        self.assertEqual(
+            samples[f"cafe_db_queries_per_request_count{{{series}}}"], 1
+        )
+        self.assertGreater(
+            samples[f"cafe_db_queries_per_request_sum{{{series}}}"], 0
+        )
+        self.assertIn('cafe_cache_hit_ratio{cache="menu"}', samples)
+
+    def test_auth_failures_counted(self):
+        """Test that rejected requests are counted by error code."""
+        self.client().get("/drinks-detail")
+        self.client().get("/drinks-detail", headers={"Authorization": "Basic"})
+
+        samples = parse_samples(self.client().get("/metrics").data.decode())
+
+        self.assertEqual(
+            samples[
+                'cafe_auth_failures_total{error_code="'
+                'authorization_header_missing"}'
+            ],
+            1,
+        )
+        self.assertEqual(
+            samples['cafe_auth_failures_total{error_code="invalid_header"}'], 1
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
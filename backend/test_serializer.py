@@ -0,0 +1,117 @@
+"""Test objects used to test the json responses built in serializer.py.
+
+Usage: test_serializer.py
+
+Classes:
+    SerializerTestCase()
+"""
+
+import datetime
+import unittest
+
+import flask
+
+from src.api import app
+from src.serializer import serializer
+
+PAYLOADS = {
+    "drinks": {
+        "success": True,
+        "drinks": [
+            {
+                "id": 1,
+                "title": "Water",
+                "recipe": [{"name": "Water", "color": "blue", "parts": 1}],
+            }
+        ],
+        "next_cursor": None,
+    },
+    "unicode": {"title": "Café ☕ 😀", "escaped": '"\\\n\t\x00\x1f\x7f'},
+    "unsorted keys": {"b": 1, "a": {"d": [], "c": {}}},
+    "floats": [0.1, -2.5, 1e-4, 1e-5, 1e16, 1.5e300, -0.0, 123456.789],
+    "wide ints": [2 ** 64, -(2 ** 64), 2 ** 63 - 1],
+    "int keys": {1: "a", 2: "b"},
+    "dates": {"at": datetime.datetime(2020, 5, 1, 12, 30)},
+    "scalar": 1e-7,
+}
+
+
+class SerializerTestCase(unittest.TestCase):
+    """This class contains the test cases for the json serializers.
+
+    Attributes:
+        app: A flask app from api.py
+        serializer: A str naming the serializer in use before the test
+    """
+
+    def setUp(self):
+        """Set-up for SerializerTestCase."""
+        self.app = app
+        app.config["DEBUG"] = False
+        self.serializer = serializer.get_serializer()
+
+    def tearDown(self):
+        """Executed after each test."""
+        serializer.set_serializer(self.serializer)
+        app.config["JSON_AS_ASCII"] = True
+        app.config["JSONIFY_PRETTYPRINT_REGULAR"] = False
+
+    def assert_matches_flask(self):
+        """Asserts every payload is serialized the way jsonify does."""
+        with self.app.app_context():
+            for name, payload in PAYLOADS.items():
+                with self.subTest(payload=name):
+                    expected = flask.jsonify(payload)
+                    response = serializer.jsonify(payload)
+
+                    self.assertEqual(response.data, expected.data)
+                    self.assertEqual(response.mimetype, expected.mimetype)
+
+    @unittest.skipIf(serializer.orjson is None, "orjson is not installed")
+    def test_orjson_matches_flask(self):
+        """Test that orjson builds the same bodies as flask's jsonify."""
+        serializer.set_serializer("orjson")
+
+        self.assert_matches_flask()
+
+    @unittest.skipIf(serializer.orjson is None, "orjson is not installed")
+    def test_orjson_matches_flask_unescaped(self):
+        """Test that orjson matches jsonify with unicode left unescaped."""
+        serializer.set_serializer("orjson")
+        app.config["JSON_AS_ASCII"] = False
+
+        self.assert_matches_flask()
+
+    def test_json_matches_flask(self):
+        """Test that the standard library builds the same bodies."""
+        serializer.set_serializer("json")
+
+        self.assert_matches_flask()
+
+    def test_pretty_print_matches_flask(self):
+        """Test that pretty printed responses match jsonify."""
+        serializer.set_serializer("auto")
+        app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+
+        self.assert_matches_flask()
+
+    def test_args_and_kwargs(self):
+        """Test that arguments are collected the way jsonify collects them."""
+        with self.app.app_context():
+            self.assertEqual(
+                serializer.jsonify(1, 2).data, flask.jsonify(1, 2).data
+            )
+            self.assertEqual(
+                serializer.jsonify(a=1).data, flask.jsonify(a=1).data
+            )
+            with self.assertRaises(TypeError):
+                serializer.jsonify(1, a=1)
+
+    def test_unknown_serializer(self):
+        """Test that an unknown serializer is rejected."""
+        with self.assertRaises(ValueError):
+            serializer.set_serializer("pickle")
+
+
+if __name__ == "__main__":
+    unittest.main()